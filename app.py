@@ -1,21 +1,36 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
 import io
+import os
 import time
 import math
 import json
 import base64
 import re
+import hashlib
+import tempfile
+import sqlite3
+import uuid
+import threading
+import copy
+import warnings
+import zipfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import xlsxwriter
 from reportlab.lib.pagesizes import A4, mm
 from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer
 from reportlab.lib.styles import getSampleStyleSheet
 from reportlab.lib import colors
 from reportlab.pdfgen import canvas
-from pypdf import PdfReader, PdfWriter, Transformation, PageObject
+from reportlab.graphics.barcode.code128 import Code128
+from pypdf import PdfReader, PdfWriter
+from pypdf.generic import ArrayObject, DecodedStreamObject, DictionaryObject, FloatObject, IndirectObject, NameObject, NumberObject
 
 # --- SERVER IMPORTS ---
-from github import Github
+from github import Github, GithubException
 import streamlit.components.v1 as components
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 
 # --- CONFIGURATION ---
 st.set_page_config(page_title="Hike Warehouse Manager", layout="wide")
@@ -27,8 +42,11 @@ SENDERS_FILE = "senders.xlsx"
 RECEIVERS_FILE = "receivers.xlsx"
 TEMPLATE_SINGLE_FILE = "active_listing_single.csv"
 TEMPLATE_MULTI_FILE = "active_listing_multi.csv"
+PLAN_CHANNELS_FILE = "plan_channels.json"  # per-channel FC codes and template files (see channel_config)
 SHEET_URL = "https://docs.google.com/spreadsheets/d/e/2PACX-1vRdLEddTZgmuUSswPp3A_HM7DGH8UCUWEmqd-cIbbJ7nb_Eq4YvZxO0vjWESlxX-9Y6VWRcVLPFlIVp/pub?gid=0&single=true&output=csv"
 ZONES_ORDER = ['South', 'West', 'East', 'North']
+# Server-local state (SQLite coordination files) shared by every session of this app; HIKE_STATE_DIR overrides
+STATE_DIR = os.environ.get("HIKE_STATE_DIR") or os.path.dirname(os.path.abspath(__file__))
 
 STATE_TO_ZONE = {
     'Arunachal Pradesh': ('east', 'ulub_bts'), 'Assam': ('east', 'ulub_bts'),
@@ -53,9 +71,27 @@ STATE_TO_ZONE = {
     'Chandigarh': ('north', 'gur_san_wh_nl_01nl'),
     'Dadra & Nagar Haveli & Daman & Diu': ('west', 'bhi_vas_wh_nl_01nl')
 }
+# Lookup keyed by whitespace-collapsed, case-folded state name (see state_zone_columns)
+STATE_ZONE_LOOKUP = {' '.join(k.split()).casefold(): v for k, v in STATE_TO_ZONE.items()}
+# Each zone is served by one warehouse; multi-warehouse plans use one column per warehouse in ZONES_ORDER
+ZONE_WAREHOUSE = {z.title(): wh for z, wh in STATE_TO_ZONE.values()}
+WAREHOUSES = [ZONE_WAREHOUSE[z] for z in ZONES_ORDER]
 
 # --- GITHUB STORAGE HANDLER ---
+LARGE_FILE_CHUNK_THRESHOLD = 20 * 1024 * 1024  # above this, files are stored as parts + manifest
+LARGE_FILE_PART_SIZE = 8 * 1024 * 1024
+SPOOL_MEMORY_LIMIT = 4 * 1024 * 1024  # downloads larger than this spill to a temp file
+
 class StorageHandler:
+    _worker = threading.local()  # last error of a call made off the script thread (see report)
+
+    @staticmethod
+    def report(message):
+        """Shows a storage error on the page; job workers have no page (no ScriptRunContext), so there the
+        message is kept for JobScheduler to attach to the failed job instead."""
+        if get_script_run_ctx(suppress_warning=True) is not None: st.error(message)
+        else: StorageHandler._worker.last_error = message
+
     @staticmethod
     def get_repo():
         try:
@@ -70,7 +106,7 @@ class StorageHandler:
     def upload_file(filename, data, message="Update file"):
         repo = StorageHandler.get_repo()
         if not repo: 
-            st.error("GitHub Secrets missing or invalid.")
+            StorageHandler.report("GitHub Secrets missing or invalid.")
             return False
         try:
             try:
@@ -79,77 +115,720 @@ class StorageHandler:
             except:
                 repo.create_file(filename, message, data)
         except Exception as e:
-            st.error(f"Cloud Save Error for {filename}: {e}")
+            StorageHandler.report(f"Cloud Save Error for {filename}: {e}")
             return False
         return True
 
     @staticmethod
-    def download_file(filename):
+    def upload_large_file(filename, data, message="Update file"):
+        """upload_file for payloads that may exceed what one contents API request carries. Above
+        LARGE_FILE_CHUNK_THRESHOLD the data (bytes or a file object) is stored as `<name>.partNNN` objects plus a
+        JSON manifest with per-part and whole-file sha256; only one part is held in memory at a time."""
+        src = io.BytesIO(data) if isinstance(data, (bytes, bytearray, memoryview)) else data
+        size = src.seek(0, io.SEEK_END)
+        src.seek(0)
+        manifest_name = StorageHandler.manifest_name(filename)
+        if size <= LARGE_FILE_CHUNK_THRESHOLD:
+            ok = StorageHandler.upload_file(filename, src.read(), message)
+            if ok: StorageHandler.delete_file(manifest_name, f"{message} (drop manifest)")
+            return ok
+        parts, total, k = [], hashlib.sha256(), 0
+        while True:
+            chunk = src.read(LARGE_FILE_PART_SIZE)
+            if not chunk: break
+            part_name = f"{filename}.part{k:03d}"
+            if not StorageHandler.upload_file(part_name, chunk, f"{message} (part {k + 1})"): return False
+            parts.append({'name': part_name, 'size': len(chunk), 'sha256': hashlib.sha256(chunk).hexdigest()})
+            total.update(chunk); k += 1
+        manifest = {'name': filename, 'size': size, 'sha256': total.hexdigest(), 'parts': parts}
+        ok = StorageHandler.upload_file(manifest_name, json.dumps(manifest, indent=1), message)
+        # Readers prefer the plain object, so drop any older single-object copy
+        if ok: StorageHandler.delete_file(filename, f"{message} (chunked)")
+        return ok
+
+    @staticmethod
+    def delete_file(filename, message="Delete file"):
         repo = StorageHandler.get_repo()
-        if not repo: return None
+        if not repo: return False
         try:
             contents = repo.get_contents(filename)
-            return contents.decoded_content
+            repo.delete_file(contents.path, message, contents.sha)
+            return True
         except:
+            return False
+
+    @staticmethod
+    def manifest_name(filename): return f"{filename}.manifest.json"
+
+    @staticmethod
+    def _contents_to_spool(repo, contents, spool):
+        # Inline content only exists below the contents API's 1 MB cut-off; larger files come from the blob API.
+        # Either way the git blob sha1 of what was written must match the sha GitHub reported.
+        digest = hashlib.sha1()
+        if contents.encoding == 'base64' and contents.content:
+            data = contents.decoded_content
+            digest.update(f"blob {len(data)}\0".encode()); digest.update(data); spool.write(data)
+        else:
+            blob = repo.get_git_blob(contents.sha)
+            digest.update(f"blob {blob.size}\0".encode())
+            _b64_decode_into(blob.content, spool, digest)
+        if digest.hexdigest() != contents.sha: raise ValueError(f"Checksum mismatch for {contents.path}")
+
+    @staticmethod
+    def download_to_spool(filename):
+        """Streams a stored file of any size into a SpooledTemporaryFile (positioned at 0), following the blob API
+        for >1 MB objects and part manifests written by upload_large_file. Returns None if missing or corrupt."""
+        repo = StorageHandler.get_repo()
+        if not repo: return None
+        spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_MEMORY_LIMIT)
+        try:
+            try: contents = repo.get_contents(filename)
+            except GithubException as e:
+                if e.status != 404: raise
+                contents = None
+            if contents is not None: StorageHandler._contents_to_spool(repo, contents, spool)
+            else:
+                manifest = json.loads(repo.get_contents(StorageHandler.manifest_name(filename)).decoded_content)
+                total = hashlib.sha256()
+                for part in manifest['parts']:
+                    part_spool = StorageHandler.download_to_spool(part['name'])
+                    if part_spool is None: raise ValueError(f"Missing part {part['name']}")
+                    digest = hashlib.sha256()
+                    with part_spool:
+                        for block in iter(lambda: part_spool.read(SPOOL_MEMORY_LIMIT), b''):
+                            digest.update(block); total.update(block); spool.write(block)
+                    if digest.hexdigest() != part['sha256']: raise ValueError(f"Checksum mismatch for {part['name']}")
+                if total.hexdigest() != manifest['sha256'] or spool.tell() != manifest['size']:
+                    raise ValueError(f"Checksum mismatch for {filename}")
+            spool.seek(0)
+            return spool
+        except ValueError as e:
+            spool.close(); StorageHandler.report(str(e))
+            return None
+        except Exception:
+            spool.close()
             return None
 
     @staticmethod
-    def file_exists(filename):
+    def download_file(filename):
+        spool = StorageHandler.download_to_spool(filename)
+        if spool is None: return None
+        with spool: return spool.read()
+
+    @staticmethod
+    def download_file_with_sha(filename):
         repo = StorageHandler.get_repo()
-        if not repo: return False
+        if not repo: return None, None
         try:
-            repo.get_contents(filename)
-            return True
+            # Same >1 MB blob fallback as download_to_spool: the history file outgrows inline content
+            contents = repo.get_contents(filename)
+            with tempfile.SpooledTemporaryFile(max_size=SPOOL_MEMORY_LIMIT) as spool:
+                StorageHandler._contents_to_spool(repo, contents, spool); spool.seek(0)
+                return spool.read(), contents.sha
         except:
-            return False
+            return None, None
+
+    @staticmethod
+    def upload_file_if_match(filename, data, base_sha, message="Update file"):
+        """Compare-and-swap write: only succeeds while the stored file is still at base_sha (None = must not exist).
+        Returns (status, new_sha) with status 'ok', 'conflict' or 'error'."""
+        repo = StorageHandler.get_repo()
+        if not repo:
+            StorageHandler.report("GitHub Secrets missing or invalid.")
+            return 'error', None
+        try:
+            if base_sha: res = repo.update_file(filename, message, data, base_sha)
+            else: res = repo.create_file(filename, message, data)
+            return 'ok', res['content'].sha
+        except GithubException as e:
+            if e.status in (409, 422): return 'conflict', None
+            StorageHandler.report(f"Cloud Save Error for {filename}: {e}")
+        except Exception as e:
+            StorageHandler.report(f"Cloud Save Error for {filename}: {e}")
+        return 'error', None
+
+    @staticmethod
+    def file_exists(filename):
+        repo = StorageHandler.get_repo()
+        if not repo: return False
+        for name in (filename, StorageHandler.manifest_name(filename)):
+            try:
+                repo.get_contents(name)
+                return True
+            except: pass
+        return False
+
+def _b64_decode_into(text, out, digest, step=4 * 1024 * 1024):
+    # Decodes a (line-wrapped) base64 string slice by slice so the decoded file is never held whole in memory
+    carry = ''
+    for pos in range(0, len(text), step):
+        piece = carry + text[pos:pos + step].replace('\n', '')
+        cut = len(piece) - len(piece) % 4
+        data = base64.b64decode(piece[:cut]); carry = piece[cut:]
+        digest.update(data); out.write(data)
+    if carry: raise ValueError("Truncated base64 blob")
+
+# --- EXCEL EXPORT ENGINE ---
+XLSX_MIME = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+XLSX_CHUNK_ROWS = 5000
+XLSX_NUM_FORMATS = {'int': '0', 'float': '0.00', 'text': '@'}
+
+def xlsx_sheet(name, frame, columns=None, rows=None, formats=None, widths=None):
+    """Sheet spec for export_xlsx. `columns` items are frame column names or (header, source) pairs where
+    source is a column name or an array aligned with `frame` (with rows=None, any array of the output length);
+    `rows` is an optional positional order/filter applied to every column."""
+    return {'name': name, 'frame': frame, 'columns': list(frame.columns) if columns is None else columns, 'rows': rows, 'formats': formats or {}, 'widths': widths or {}}
+
+def _xlsx_column(frame, source, rows):
+    arr = frame[source].to_numpy() if isinstance(source, str) else np.asarray(source)
+    if rows is not None: arr = arr[rows]
+    if arr.dtype.kind == 'M': arr = pd.Series(arr).dt.strftime('%Y-%m-%d').to_numpy(dtype=object)
+    return arr
+
+def _xlsx_kind(arr):
+    if arr.dtype.kind in 'iub': return 'int'
+    if arr.dtype.kind == 'f': return 'float'
+    return 'text'
+
+def _xlsx_cells(arr):
+    # Python natives for xlsxwriter; NaN/None become blank cells
+    if arr.dtype.kind == 'f':
+        nan = np.isnan(arr)
+        if nan.any(): arr = arr.astype(object); arr[nan] = None
+    elif arr.dtype.kind == 'O':
+        arr = np.where(pd.isna(arr), None, arr)
+    return arr.tolist()
+
+def export_xlsx(sheets, out=None):
+    """Writes all sheets in one pass with xlsxwriter constant-memory mode. Rows are streamed in chunks
+    straight from the column arrays, so no per-sheet DataFrame copies are made. Writes to `out` (file-like)
+    if given, otherwise returns the workbook bytes."""
+    target = out if out is not None else tempfile.SpooledTemporaryFile(max_size=8 * 1024 * 1024)
+    wb = xlsxwriter.Workbook(target, {'constant_memory': True, 'strings_to_formulas': False, 'strings_to_urls': False})
+    header_fmt = wb.add_format({'bold': True})
+    col_fmts = {k: wb.add_format({'num_format': v}) for k, v in XLSX_NUM_FORMATS.items()}
+    for spec in sheets:
+        ws = wb.add_worksheet(spec['name'][:31])
+        frame, rows = spec['frame'], spec['rows']
+        headers, arrays = [], []
+        for col in spec['columns']:
+            header, source = (col, col) if isinstance(col, str) else col
+            headers.append(header); arrays.append(_xlsx_column(frame, source, rows))
+        for ci, (header, arr) in enumerate(zip(headers, arrays)):
+            kind = spec['formats'].get(header, _xlsx_kind(arr))
+            ws.set_column(ci, ci, spec['widths'].get(header, max(10, len(str(header)) + 2)), col_fmts.get(kind))
+        ws.write_row(0, 0, headers, header_fmt)
+        n = len(arrays[0]) if arrays else 0
+        for start in range(0, n, XLSX_CHUNK_ROWS):
+            chunk = [_xlsx_cells(a[start:start + XLSX_CHUNK_ROWS]) for a in arrays]
+            for r, values in enumerate(zip(*chunk), start=start + 1): ws.write_row(r, 0, values)
+    wb.close()
+    if out is not None: return out
+    target.seek(0); data = target.read(); target.close()
+    return data
+
+def export_csv(frame, rows=None, overrides=None, out=None):
+    """CSV counterpart of export_xlsx: writes `frame` (optionally re-ordered/expanded by positional `rows`,
+    with whole columns replaced by `overrides` arrays) in chunks, so only one chunk is materialised at a time."""
+    target = out if out is not None else io.BytesIO()
+    overrides = overrides or {}
+    n = len(frame) if rows is None else len(rows)
+    step = XLSX_CHUNK_ROWS * 4
+    for start in range(0, max(n, 1), step):
+        part = frame.iloc[start:start + step] if rows is None else frame.take(rows[start:start + step])
+        if overrides:
+            part = part.copy()
+            for col, arr in overrides.items(): part[col] = np.asarray(arr)[start:start + len(part)]
+        part.to_csv(target, index=False, header=(start == 0))
+    if out is not None: return out
+    return target.getvalue()
+
+# --- CONSIGNMENT SCHEMA ---
+# Canonical columns of a consignment's `data` frame, whichever path (manual CSV or planner) created it.
+# Anything else (master-data columns, raw CSV fields, editor flags) lives row-aligned in `data_extras`.
+CONSIGNMENT_SCHEMA = {
+    'SKU Id': 'category', 'FSN': 'category', 'Zone': 'category', 'EAN': 'str', 'Product Name': 'category',
+    'Editable Qty': 'int32', 'Editable Boxes': 'int32', 'PPCN': 'int32',
+    'Required Qty': 'int32', 'Stock': 'int32', 'Qty_Booked': 'int32', 'Cost Price': 'float64'
+}
+CONSIGNMENT_REQUIRED = ['SKU Id', 'Editable Qty', 'Editable Boxes', 'PPCN']
+
+def _schema_column(s, dtype):
+    if dtype == 'int32': return np.floor(pd.to_numeric(s, errors='coerce').replace([np.inf, -np.inf], np.nan).fillna(0)).astype(np.int32)
+    if dtype == 'float64': return pd.to_numeric(s, errors='coerce').astype(np.float64)
+    if s.dtype.kind == 'f': text = s.astype(str).str.replace(r'\.0$', '', regex=True).where(s.notna())
+    else:
+        # numbers read into an object column (e.g. an EAN parsed as float) get the same '.0' strip
+        text = s.astype(object).where(s.notna())
+        num = text.map(lambda v: isinstance(v, (float, np.floating))).to_numpy(dtype=bool)
+        if num.any(): text[num] = text[num].astype(str).str.replace(r'\.0$', '', regex=True)
+    return text.astype('category') if dtype == 'category' else text.astype('str')
+
+def validate_consignment_frame(df):
+    """Returns a list of schema problems (empty when the frame is usable as consignment data)."""
+    problems = [f"missing column '{c}'" for c in CONSIGNMENT_REQUIRED if c not in df.columns]
+    if 'SKU Id' in df.columns and df['SKU Id'].isna().any(): problems.append(f"{int(df['SKU Id'].isna().sum())} rows without SKU Id")
+    for c in ['Editable Qty', 'Editable Boxes', 'PPCN']:
+        if c not in df.columns: continue
+        num = pd.to_numeric(df[c], errors='coerce')
+        # int32 columns floor and zero-fill, so 0.5 boxes or 'x' would silently become 0 (a MIX member)
+        if (df[c].notna() & num.isna()).any(): problems.append(f"non-numeric values in '{c}'")
+        if (num.notna() & (num % 1 != 0)).any(): problems.append(f"fractional values in '{c}'")
+        if c != 'PPCN' and (num.fillna(0) < 0).any(): problems.append(f"negative values in '{c}'")
+    return problems
+
+def normalize_consignment_frame(df, extras=None, strict=True):
+    """Maps a consignment frame onto CONSIGNMENT_SCHEMA. Returns (data, extras): typed canonical columns
+    (optional ones only if present) and the remaining columns, row-aligned. strict=True raises ValueError on
+    schema problems; strict=False (loading old history) fills missing required columns with defaults instead,
+    and counts that are fractional or not numbers are floored or zeroed as before."""
+    if not isinstance(df, pd.DataFrame): df = pd.DataFrame()
+    problems = validate_consignment_frame(df) if not df.empty else []
+    if strict and problems: raise ValueError("Invalid consignment data: " + "; ".join(problems))
+    df = df.reset_index(drop=True)
+    data = pd.DataFrame(index=df.index)
+    for col, dtype in CONSIGNMENT_SCHEMA.items():
+        if col in df.columns: data[col] = _schema_column(df[col], dtype)
+        elif col in CONSIGNMENT_REQUIRED: data[col] = _schema_column(pd.Series([''] * len(df) if col == 'SKU Id' else [0] * len(df), dtype=object), dtype)
+    rest = df.drop(columns=[c for c in df.columns if c in CONSIGNMENT_SCHEMA])
+    if isinstance(extras, pd.DataFrame) and len(extras) == len(df):
+        rest = pd.concat([extras.reset_index(drop=True).drop(columns=[c for c in rest.columns if c in extras.columns]), rest], axis=1)
+    return data, rest
+
+def is_canonical_frame(df):
+    return isinstance(df, pd.DataFrame) and all(c in df.columns and str(df[c].dtype) == CONSIGNMENT_SCHEMA[c] for c in CONSIGNMENT_REQUIRED)
+
+def set_consignment_data(h, df, strict=True):
+    """Stores `df` as the consignment's canonical data, keeping non-schema columns in h['data_extras']."""
+    h['data'], h['data_extras'] = normalize_consignment_frame(df, h.get('data_extras'), strict)
+    return h
+
+def consignment_frame(h, extra_cols=()):
+    """Canonical data joined with the requested extras columns (for exports that need raw/master fields)."""
+    extras = h.get('data_extras')
+    cols = [c for c in extra_cols if isinstance(extras, pd.DataFrame) and c in extras.columns and c not in h['data'].columns]
+    return pd.concat([h['data'], extras[cols].reset_index(drop=True)], axis=1) if cols else h['data']
+
+# --- EDIT HISTORY ---
+# Box-count edits are stored as deltas: h['edit_base'] holds the version-0 counts, h['edits'] one record per
+# version (changed rows with old/new boxes and qty, author, time), h['edit_snapshots'] the counts every
+# EDIT_SNAPSHOT_EVERY versions, and h['edit_head'] the version currently in h['data'].
+EDIT_SNAPSHOT_EVERY = 10
+EDIT_FIELDS = ['row', 'sku', 'old_boxes', 'new_boxes', 'old_qty', 'new_qty']
+
+def _edit_counts(df):
+    return {'qty': df['Editable Qty'].astype(np.int64).tolist(),
+            'boxes': df['Editable Boxes'].astype(np.int64).tolist()}
+
+def _with_counts(data, qty, boxes):
+    return data.assign(**{'Editable Qty': np.asarray(qty).astype(np.int32),
+                          'Editable Boxes': np.asarray(boxes).astype(np.int32)})
+
+def edit_head(h):
+    return int(h.get('edit_head', 0))
+
+def edit_history_valid(h):
+    return isinstance(h.get('edit_base'), dict) and len(h['edit_base'].get('qty', [])) == len(h['data'])
+
+def edit_author():
+    try: who = st.user.get('email') or st.user.get('name')
+    except Exception: who = None
+    return who or f"station {station_id()}"
+
+def compute_box_edit(data, upload):
+    """Delta that sets every row of each uploaded SKU to its 'Available Box (Edit)' count (qty = boxes x PPCN),
+    matched with a merge on SKU Id. Returns None when nothing changes; ValueError on non-numeric/negative boxes."""
+    upd = pd.DataFrame({
+        'SKU Id': upload['SKU Id'].astype(str).to_numpy(dtype=object),
+        'new_boxes': pd.to_numeric(upload['Available Box (Edit)'], errors='coerce').to_numpy(),
+    }).drop_duplicates('SKU Id', keep='last')
+    cur = pd.DataFrame({
+        'row': np.arange(len(data)),
+        'SKU Id': data['SKU Id'].astype(str).to_numpy(dtype=object),
+        'old_boxes': data['Editable Boxes'].to_numpy(np.int64),
+        'old_qty': data['Editable Qty'].to_numpy(np.int64),
+        'ppcn': data['PPCN'].to_numpy(np.int64),
+    })
+    m = cur.merge(upd, on='SKU Id', how='inner')
+    bad = m.loc[m['new_boxes'].isna() | (m['new_boxes'] < 0), 'SKU Id'].unique().tolist()
+    if bad:
+        more = ' ...' if len(bad) > 5 else ''
+        raise ValueError(f"'Available Box (Edit)' must be a non-negative number for {', '.join(bad[:5])}{more}")
+    m['new_boxes'] = np.trunc(m['new_boxes']).astype(np.int64)
+    m['new_qty'] = m['new_boxes'] * np.where(m['ppcn'] > 0, m['ppcn'], 1)
+    m = m[(m['new_boxes'] != m['old_boxes']) | (m['new_qty'] != m['old_qty'])]
+    m = m.sort_values('row').rename(columns={'SKU Id': 'sku'})
+    return {c: m[c].tolist() for c in EDIT_FIELDS} if len(m) else None
+
+def record_edit(h, delta, author, note=''):
+    """Applies `delta` as version edit_head + 1, discarding undone versions above the current head."""
+    if not edit_history_valid(h):
+        h.update({'edit_base': _edit_counts(h['data']), 'edits': [], 'edit_snapshots': {}, 'edit_head': 0})
+    head = edit_head(h)
+    v = head + 1
+    entry = {'v': v, 'at': pd.Timestamp.now().isoformat(timespec='seconds'), 'by': author, 'note': note, **delta}
+    edits = h.get('edits', [])[:head] + [entry]
+    snaps = {k: c for k, c in h.get('edit_snapshots', {}).items() if int(k) <= head}
+    qty = h['data']['Editable Qty'].to_numpy(np.int64).copy()
+    boxes = h['data']['Editable Boxes'].to_numpy(np.int64).copy()
+    qty[delta['row']] = delta['new_qty']
+    boxes[delta['row']] = delta['new_boxes']
+    h['data'] = _with_counts(h['data'], qty, boxes)
+    if v % EDIT_SNAPSHOT_EVERY == 0: snaps[str(v)] = {'qty': qty.tolist(), 'boxes': boxes.tolist()}
+    h.update({'edits': edits, 'edit_snapshots': snaps, 'edit_head': v,
+              'edit_timestamp': pd.Timestamp(entry['at']).strftime('%d-%b-%Y %I:%M %p')})
+    return h
+
+def edit_counts_at(h, version):
+    """(qty, boxes) arrays of `version`, replayed forward from the nearest snapshot at or below it."""
+    snaps = {int(k): c for k, c in h.get('edit_snapshots', {}).items() if int(k) <= version}
+    start = max(snaps, default=0)
+    base = snaps[start] if start else h['edit_base']
+    qty, boxes = np.array(base['qty'], dtype=np.int64), np.array(base['boxes'], dtype=np.int64)
+    for e in h.get('edits', [])[start:version]:
+        qty[e['row']] = e['new_qty']
+        boxes[e['row']] = e['new_boxes']
+    return qty, boxes
+
+def checkout_edit_version(h, version):
+    """Puts `version` into h['data'] (undo, redo or jump); later versions are kept until the next new edit."""
+    version = max(0, min(int(version), len(h.get('edits', []))))
+    h['data'] = _with_counts(h['data'], *edit_counts_at(h, version))
+    h['edit_head'] = version
+    if version: h['edit_timestamp'] = pd.Timestamp(h['edits'][version - 1]['at']).strftime('%d-%b-%Y %I:%M %p')
+    else: h.pop('edit_timestamp', None)
+    return h
+
+def edit_log_frame(h):
+    head = edit_head(h)
+    return pd.DataFrame([{
+        'Version': e['v'],
+        'When': pd.Timestamp(e['at']).strftime('%d-%b %I:%M %p'),
+        'By': e['by'],
+        'SKUs': len(set(e['sku'])),
+        'Box Change': int(sum(e['new_boxes']) - sum(e['old_boxes'])),
+        'Note': e.get('note', ''),
+        'State': 'current' if e['v'] == head else ('undone' if e['v'] > head else ''),
+    } for e in h.get('edits', [])])
+
+def _legacy_backup_to_edits(h):
+    """Older records kept one full `backup_data` copy; turn it into edit_base plus a single delta."""
+    bk = h.pop('backup_data', None)
+    if 'edit_base' in h or not isinstance(bk, pd.DataFrame) or bk.empty: return h
+    if len(bk) != len(h.get('data', [])): return h
+    try: bk = bk if is_canonical_frame(bk) else normalize_consignment_frame(bk, strict=False)[0]
+    except Exception: return h
+    base, cur = _edit_counts(bk), h['data']
+    old_q, old_b = np.array(base['qty']), np.array(base['boxes'])
+    new_q, new_b = cur['Editable Qty'].to_numpy(np.int64), cur['Editable Boxes'].to_numpy(np.int64)
+    rows = np.flatnonzero((old_q != new_q) | (old_b != new_b))
+    h.update({'edit_base': base, 'edits': [], 'edit_snapshots': {}, 'edit_head': 0})
+    if len(rows):
+        try: at = pd.to_datetime(h.get('edit_timestamp'), format='%d-%b-%Y %I:%M %p').isoformat(timespec='seconds')
+        except Exception: at = pd.Timestamp.now().isoformat(timespec='seconds')
+        h['edits'] = [{
+            'v': 1, 'at': at, 'by': 'unknown', 'note': 'migrated from single-level backup',
+            'row': rows.tolist(), 'sku': cur['SKU Id'].astype(str).to_numpy(dtype=object)[rows].tolist(),
+            'old_boxes': old_b[rows].tolist(), 'new_boxes': new_b[rows].tolist(),
+            'old_qty': old_q[rows].tolist(), 'new_qty': new_q[rows].tolist(),
+        }]
+        h['edit_head'] = 1
+    return h
 
 # --- DATA HELPERS ---
-def load_history():
-    data_bytes = StorageHandler.download_file(HISTORY_FILE)
+HISTORY_SAVE_RETRIES = 5
+_MISSING = object()
+
+def _hydrate_consignment(h):
+    # Reconstruct DataFrames from JSON records
+    for key in ['data', 'data_extras', 'original_data', 'backup_data']:
+        if key in h:
+            try: h[key] = pd.DataFrame(h[key])
+            except: h[key] = pd.DataFrame()
+    # Older records keep every column in `data`; bring them onto the canonical schema
+    if 'data' in h:
+        try: set_consignment_data(h, h['data'], strict=False)
+        except Exception: pass
+    if 'backup_data' in h: _legacy_backup_to_edits(h)
+    # Ensure defaults
+    if 'printed_boxes' not in h: h['printed_boxes'] = []
+    if 'task_type' not in h: h['task_type'] = h.get('task_type', 'execution')
+    if 'is_booked' not in h: h['is_booked'] = True if h.get('task_type') == 'execution' else False
+    return h
+
+def _serialize_consignment(h):
+    h_copy = h.copy()
+    # Convert DataFrames to JSON-friendly list of dicts
+    for key in ['data', 'data_extras', 'original_data', 'backup_data']:
+        if key in h_copy and isinstance(h_copy[key], pd.DataFrame):
+            h_copy[key] = h_copy[key].to_dict('records')
+    return h_copy
+
+def _canon(value):
+    return json.dumps(value, sort_keys=True, default=str)
+
+def load_history_snapshot():
+    """Returns (serialized records keyed by id, sha) of the stored history; records are round-tripped through
+    DataFrames so they compare equal to what save_history would write for an unchanged consignment."""
+    data_bytes, sha = StorageHandler.download_file_with_sha(HISTORY_FILE)
+    records = {}
     if data_bytes:
         try:
-            history = json.loads(data_bytes.decode('utf-8'))
-            for h in history:
-                # Reconstruct DataFrames from JSON records
-                if 'data' in h: 
-                    try: h['data'] = pd.DataFrame(h['data'])
-                    except: h['data'] = pd.DataFrame()
-                if 'original_data' in h:
-                    try: h['original_data'] = pd.DataFrame(h['original_data'])
-                    except: h['original_data'] = pd.DataFrame()
-                if 'backup_data' in h:
-                    try: h['backup_data'] = pd.DataFrame(h['backup_data'])
-                    except: h['backup_data'] = pd.DataFrame()
-                
-                # Ensure defaults
-                if 'printed_boxes' not in h: h['printed_boxes'] = []
-                if 'task_type' not in h: h['task_type'] = h.get('task_type', 'execution')
-                if 'is_booked' not in h: h['is_booked'] = True if h.get('task_type') == 'execution' else False
-            return history
-        except: return []
-    return []
+            for r in json.loads(data_bytes.decode('utf-8')):
+                records[r.get('id')] = _serialize_consignment(_hydrate_consignment(dict(r)))
+        except: records = {}
+    return records, sha
+
+def load_history():
+    """Current history from the process-wide store (shared, read-only records)."""
+    store = consignment_store(); store.refresh_if_stale()
+    return store.snapshot()[3]
+
+def init_history_session():
+    version, sha, base, records = consignment_store().snapshot()
+    st.session_state['history_version'] = version
+    st.session_state['history_sha'] = sha
+    st.session_state['history_base'] = base
+    st.session_state['history_dirty'] = set()
+    st.session_state['history_index_patch'] = {}
+    st.session_state['consignments'] = records
+
+def _merge_field(key, b, m, t, mine, theirs):
+    cb = _canon(b) if b is not _MISSING else None
+    cm = _canon(m) if m is not _MISSING else None
+    ct = _canon(t) if t is not _MISSING else None
+    if cm == ct or ct == cb: return m
+    if cm == cb: return t
+    if key == 'printed_boxes':
+        base_set = set(b) if isinstance(b, list) else set()
+        m_set = set(m) if isinstance(m, list) else set()
+        t_set = set(t) if isinstance(t, list) else set()
+        return sorted((base_set | m_set | t_set) - ((base_set - m_set) | (base_set - t_set)))
+    if key == 'is_booked': return m if str(mine.get('booked_updated_at', '')) >= str(theirs.get('booked_updated_at', '')) else t
+    return m if str(mine.get('updated_at', '')) >= str(theirs.get('updated_at', '')) else t
+
+def merge_consignment(base, mine, theirs):
+    """Field-level three-way merge of one consignment record."""
+    base = base or {}
+    out = {}
+    for key in list(theirs.keys()) + [k for k in mine.keys() if k not in theirs]:
+        val = _merge_field(key, base.get(key, _MISSING), mine.get(key, _MISSING), theirs.get(key, _MISSING), mine, theirs)
+        if val is not _MISSING: out[key] = val
+    return out
+
+def merge_histories(base, mine, theirs):
+    """Three-way merge of histories keyed by consignment id. A delete wins unless the other side edited the record."""
+    merged = {}
+    for cid in list(theirs.keys()) + [k for k in mine.keys() if k not in theirs]:
+        b, m, t = base.get(cid), mine.get(cid), theirs.get(cid)
+        if m is not None and t is not None: merged[cid] = merge_consignment(b, m, t)
+        elif m is not None:
+            if b is None or _canon(m) != _canon(b): merged[cid] = m
+        elif t is not None:
+            if b is None or _canon(t) != _canon(b): merged[cid] = t
+    return merged
+
+def _apply_merged_history(history_list, before, merged):
+    # Swap in fresh records rather than updating in place: unchanged ones may be shared with other sessions
+    current = {h.get('id'): h for h in history_list}
+    cur = st.session_state.get('curr_con')
+    result = []
+    for cid, rec in merged.items():
+        h = current.get(cid)
+        if h is None or cid not in before or _canon(before[cid]) != _canon(rec):
+            h = _hydrate_consignment(dict(rec))
+            if isinstance(cur, dict) and cur.get('id') == cid: st.session_state['curr_con'] = dict(h)
+        result.append(h)
+    history_list[:] = result
 
 def save_history(history_list):
-    serializable_list = []
+    """Writes the history against the sha it was loaded from; on conflict merges with the stored copy and retries."""
+    base = st.session_state.get('history_base', {})
+    base_sha = st.session_state.get('history_sha')
+    now = pd.Timestamp.now().isoformat()
+    mine = {}
     for h in history_list:
-        h_copy = h.copy()
-        # Convert DataFrames to JSON-friendly list of dicts
-        for key in ['data', 'original_data', 'backup_data']:
-            if key in h_copy and isinstance(h_copy[key], pd.DataFrame):
-                h_copy[key] = h_copy[key].to_dict('records')
-        serializable_list.append(h_copy)
-    
-    json_str = json.dumps(serializable_list)
-    return StorageHandler.upload_file(HISTORY_FILE, json_str, "Update History")
-
-def load_template_db(mode_type):
-    fname = TEMPLATE_SINGLE_FILE if mode_type == 'single' else TEMPLATE_MULTI_FILE
+        rec = _serialize_consignment(h)
+        b = base.get(rec.get('id'))
+        # Unchanged records keep the base's serialized object, so every version of the base shares them
+        if b is not None and _canon(rec) == _canon(b): rec = b
+        else: rec['updated_at'] = h['updated_at'] = now
+        mine[rec.get('id')] = rec
+    for _ in range(HISTORY_SAVE_RETRIES):
+        status, new_sha = StorageHandler.upload_file_if_match(HISTORY_FILE, json.dumps(list(mine.values())), base_sha, "Update History")
+        if status == 'ok':
+            st.session_state['history_sha'] = new_sha
+            st.session_state['history_base'] = mine
+            st.session_state['history_version'] = consignment_store().commit(mine, new_sha, history_list)
+            st.session_state['history_dirty'] = set()
+            st.session_state['history_index_patch'] = {}
+            return True
+        if status == 'error': return False
+        theirs, base_sha = load_history_snapshot()
+        merged = merge_histories(base, mine, theirs)
+        _apply_merged_history(history_list, mine, merged)
+        mine, base = merged, theirs
+    st.error("History is being changed by other stations. Please try saving again.")
+    return False
+
+# --- SHARED CONSIGNMENT STORE ---
+HISTORY_REFRESH_SECONDS = 30  # how often the process re-checks storage for other servers' writes
+HISTORY_WATCH_SECONDS = 10
+HISTORY_LIVE_PAGES = ('home', 'history', 'channel')  # pages that simply re-render when another station saves
+
+class ConsignmentStore:
+    """One versioned copy of the history per server process. Records are treated as immutable: a refresh or
+    commit swaps in new record objects (reusing unchanged ones) and bumps `version`, so every session can hold
+    the same objects and edits go to private copies (see edit_consignment/put_consignment)."""
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.version = 0
+        self.sha = None
+        self.base = {}
+        self.records = {}
+        self.rows = {}  # id -> history index row, recomputed only for records that changed
+        self._index = None
+        self.kpi = KpiRollup()  # updated from the rows of changed records only
+        self.loaded = False
+        self.checked_at = 0.0
+
+    def _install(self, serialized, sha, objects=None):
+        objects = objects or {}
+        records, rows = {}, {}
+        for cid, rec in serialized.items():
+            old = self.records.get(cid)
+            if old is not None and cid in self.base and _canon(self.base[cid]) == _canon(rec):
+                records[cid] = old
+                rows[cid] = self.rows[cid]
+                continue
+            records[cid] = dict(objects[cid]) if cid in objects else _hydrate_consignment(dict(rec))
+            rows[cid] = history_row(records[cid])
+            self.kpi.put(rows[cid])
+        for cid in self.rows.keys() - rows.keys(): self.kpi.drop(cid)
+        self.records, self.base, self.sha, self.rows = records, serialized, sha, rows
+        self._index = None
+        self.version += 1
+        self.loaded = True
+
+    def refresh_if_stale(self, force=False):
+        with self.lock:
+            if not force and self.loaded and time.time() - self.checked_at < HISTORY_REFRESH_SECONDS: return self.version
+            serialized, sha = load_history_snapshot()
+            self.checked_at = time.time()
+            if not self.loaded or sha != self.sha: self._install(serialized, sha)
+            return self.version
+
+    def snapshot(self):
+        """(version, sha, serialized base, list of records); the list is new, the records are shared."""
+        with self.lock:
+            if not self.loaded: self.refresh_if_stale(force=True)
+            return self.version, self.sha, self.base, list(self.records.values())
+
+    def index(self):
+        """(version, history index frame); the frame is built once per version and shared by every session."""
+        with self.lock:
+            if not self.loaded: self.refresh_if_stale(force=True)
+            if self._index is None: self._index = history_index_frame(self.rows.values())
+            return self.version, self._index
+
+    def record(self, cid):
+        with self.lock: return self.records.get(cid)
+
+    def kpi_frame(self, rows=()):
+        """(version, KPI frame); `rows` are unsaved index rows to apply to a copy of the shared rollup."""
+        with self.lock:
+            if not self.loaded: self.refresh_if_stale(force=True)
+            rows = list(rows)
+            return self.version, (self.kpi.patched(rows) if rows else self.kpi).frame()
+
+    def commit(self, serialized, sha, history_list):
+        # Called after a session's successful write; its private records become the shared ones (as copies),
+        # and the session's list is pointed at the shared records so it holds no copies of its own
+        with self.lock:
+            self._install(serialized, sha, {h.get('id'): h for h in history_list})
+            history_list[:] = list(self.records.values())
+            self.checked_at = time.time()
+            return self.version
+
+@st.cache_resource(show_spinner=False)
+def consignment_store():
+    return ConsignmentStore()
+
+def edit_consignment(c):
+    """Private (copy-on-write) copy of a shared record for a session to modify. DataFrames stay shared and
+    must be replaced, not mutated in place."""
+    c = dict(c)
+    if isinstance(c.get('printed_boxes'), list): c['printed_boxes'] = list(c['printed_boxes'])
+    return c
+
+def put_consignment(pkg):
+    """Puts a session's edited record into its history list (replacing the same id) ahead of save_history."""
+    tasks = st.session_state['consignments']
+    for i, h in enumerate(tasks):
+        if h.get('id') == pkg.get('id'): tasks[i] = pkg; break
+    else: tasks.append(pkg)
+    st.session_state.setdefault('history_dirty', set()).add(pkg.get('id'))
+    # The shared index only changes on save; until then this session patches in its own row
+    st.session_state.setdefault('history_index_patch', {})[pkg.get('id')] = (history_row(pkg), pkg)
+    st.session_state['history_patch_rev'] = st.session_state.get('history_patch_rev', 0) + 1
+
+@st.fragment(run_every=HISTORY_WATCH_SECONDS)
+def watch_history_version():
+    """Change notification: reruns list-style pages when the shared history moves to a new version."""
+    if consignment_store().refresh_if_stale() == st.session_state.get('history_version'): return
+    if st.session_state.get('page') in HISTORY_LIVE_PAGES: st.rerun()
+    else: st.caption("🔄 History changed on another station; it will refresh on your next action.")
+
+def _rebase_unsaved(old_base, new_base, mine):
+    """Three-way merges the session's unsaved records onto a newer stored version ({id: hydrated record}, or
+    None for a record the other side's delete wins), so a later save against the new sha keeps both edits."""
+    out = {}
+    for cid, h in mine.items():
+        rec, b, t = _serialize_consignment(h), old_base.get(cid), new_base.get(cid)
+        if t is None: out[cid] = h if b is None or _canon(rec) != _canon(b) else None
+        elif b is not None and _canon(t) == _canon(b): out[cid] = h
+        else: out[cid] = _hydrate_consignment(merge_consignment(b, rec, t))
+    return out
+
+def sync_history_session():
+    """Moves the session onto the store's latest version; records it changed but has not saved yet are merged
+    with what other stations committed since (the base becomes the new version, like after a save conflict)."""
+    store = consignment_store(); store.refresh_if_stale()
+    if st.session_state.get('history_version') == store.version: return False
+    version, sha, base, records = store.snapshot()
+    dirty = st.session_state.get('history_dirty', set())
+    rebased = set()
+    if dirty:
+        mine = {h.get('id'): h for h in st.session_state['consignments'] if h.get('id') in dirty}
+        merged = _rebase_unsaved(st.session_state.get('history_base', {}), base, mine)
+        rebased = {cid for cid, h in merged.items() if h is not mine[cid]}
+        mine = merged
+        records = [mine.pop(r.get('id'), r) for r in records] + list(mine.values())
+        records = [r for r in records if r is not None]
+        patch = st.session_state.setdefault('history_index_patch', {})
+        for h in records:
+            if h.get('id') in dirty: patch[h.get('id')] = (history_row(h), h)
+        for cid in dirty - {h.get('id') for h in records}: patch.pop(cid, None)
+        st.session_state['history_patch_rev'] = st.session_state.get('history_patch_rev', 0) + 1
+    st.session_state['consignments'] = records
+    st.session_state['history_version'] = version
+    st.session_state['history_sha'] = sha
+    st.session_state['history_base'] = base
+    cur = st.session_state.get('curr_con')
+    if isinstance(cur, dict) and (cur.get('id') not in dirty or cur.get('id') in rebased):
+        # an open unsaved record follows its merged copy, so the next put does not drop the other side's edits
+        fresh = next((r for r in records if r.get('id') == cur.get('id')), None)
+        if fresh is not None and fresh is not cur: st.session_state['curr_con'] = edit_consignment(fresh)
+    return True
+
+def load_template_db(mode_type, channel='Flipkart'):
+    fname = channel_template_file(channel, mode_type)
     data = StorageHandler.download_file(fname)
     if data: return pd.read_csv(io.BytesIO(data), dtype=str)
     return pd.DataFrame()
 
-def save_template_db(df, mode_type):
-    fname = TEMPLATE_SINGLE_FILE if mode_type == 'single' else TEMPLATE_MULTI_FILE
+def save_template_db(df, mode_type, channel='Flipkart'):
+    fname = channel_template_file(channel, mode_type)
     output = io.BytesIO()
     df.to_csv(output, index=False)
     StorageHandler.upload_file(fname, output.getvalue(), "Update Template")
@@ -160,10 +839,7 @@ def load_address_data(file_path, default_cols):
     return pd.DataFrame(columns=default_cols)
 
 def save_address_data(file_path, df):
-    output = io.BytesIO()
-    with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
-        df.to_excel(writer, index=False)
-    StorageHandler.upload_file(file_path, output.getvalue(), "Update Address")
+    StorageHandler.upload_file(file_path, export_xlsx([xlsx_sheet('Sheet1', df)]), "Update Address")
 
 def sync_data():
     try:
@@ -172,6 +848,7 @@ def sync_data():
         output = io.BytesIO()
         df.to_csv(output, index=False)
         StorageHandler.upload_file(CACHE_FILE, output.getvalue(), "Sync Master Data")
+        master_data_index.clear()
         return True, "✅ Master Data Synced!"
     except Exception as e: return False, f"❌ Sync Failed: {e}"
 
@@ -180,19 +857,29 @@ def load_master_data():
     if data: return pd.read_csv(io.BytesIO(data), dtype={'EAN': str})
     return pd.DataFrame()
 
+@st.cache_resource(ttl=900, show_spinner=False)
+def master_data_index():
+    """Master data keyed by SKU (first row wins), shared read-only by all sessions until the next sync."""
+    df = load_master_data()
+    if df.empty or 'SKU' not in df.columns: return pd.DataFrame()
+    df = df.drop_duplicates(subset='SKU').copy()
+    df['SKU'] = df['SKU'].astype(str)
+    if 'EAN' in df.columns: df['EAN'] = df['EAN'].astype(str).str.replace(r'\.0$', '', regex=True).where(df['EAN'].notna())
+    return df.set_index(pd.Index(df['SKU'].to_numpy(), name=None))
+
 # --- FILE HELPERS ---
 def save_uploaded_file(uploaded_file, c_id, file_type):
     filename = f"{c_id}_{file_type}.pdf"
-    StorageHandler.upload_file(filename, uploaded_file.getbuffer(), f"Upload {file_type}")
+    StorageHandler.upload_large_file(filename, uploaded_file.getbuffer(), f"Upload {file_type}")
     return filename
 
 def get_stored_file_bytes(c_id, file_type):
     filename = f"{c_id}_{file_type}.pdf"
     return StorageHandler.download_file(filename)
 
-def get_merged_labels_bytes(c_id):
-    filename = f"{c_id}_merged_labels.pdf"
-    return StorageHandler.download_file(filename)
+def open_stored_file(c_id, file_type):
+    """A stored PDF as an open spool (positioned at 0; memory-bounded, spills to disk), or None if missing."""
+    return StorageHandler.download_to_spool(f"{c_id}_{file_type}.pdf")
 
 def get_stored_file_exists(c_id, file_type):
     filename = f"{c_id}_{file_type}.pdf"
@@ -221,124 +908,438 @@ def qz_tray_print_component(pdf_bytes, printer_name):
     """
     components.html(js_code, height=0, width=0)
 
-def extract_label_pdf_bytes(merged_pdf_bytes, box_index):
+def open_label_reader(c_id):
+    """PdfReader over the consignment's merged labels, read lazily from a spool rather than one bytes object."""
+    spool = open_stored_file(c_id, 'merged_labels')
+    if spool is None: return None
+    try: return PdfReader(spool)
+    except Exception:
+        spool.close()
+        return None
+
+def extract_label_pdf_bytes(merged_pdf, box_index):
+    """One box's page as a PDF; `merged_pdf` is a PdfReader, a file or bytes."""
     try:
-        reader = PdfReader(io.BytesIO(merged_pdf_bytes))
+        if isinstance(merged_pdf, PdfReader): reader = merged_pdf
+        else: reader = PdfReader(merged_pdf if hasattr(merged_pdf, 'read') else io.BytesIO(merged_pdf))
         writer = PdfWriter()
         if box_index >= len(reader.pages): return None
         writer.add_page(reader.pages[box_index])
+        optimise_pdf_writer(writer)
         out = io.BytesIO()
         writer.write(out)
         return out.getvalue()
     except: return None
 
+# --- BOX MANIFEST ---
+BOX_UNIT_VALUE = 350
+MIX_GROUP_SIZE = 20
+BOX_DIMENSIONS = {'LENGTH (cm)': 75, 'BREADTH (cm)': 55, 'HEIGHT (cm)': 40, 'WEIGHT (kg)': 10}
+
+def _str_column(df, col):
+    if col not in df.columns: return np.full(len(df), '', dtype=object)
+    s = df[col]
+    return s.astype(str).str.replace(r'\.0$', '', regex=True).where(s.notna(), '').to_numpy(dtype=object)
+
+def build_box_manifest(df):
+    """Expands a consignment into boxes: one row per real box (SKU-sorted) followed by one "MIX SKU" box per
+    group of MIX_GROUP_SIZE zero-box rows. Returns {'boxes', 'dummy_members'}; both share the same box numbering."""
+    boxes_col = pd.to_numeric(df['Editable Boxes'], errors='coerce').fillna(0).to_numpy()
+    sku_all = df['SKU Id'].astype(str).to_numpy()
+    order = np.argsort(sku_all, kind='stable')
+    active = order[boxes_col[order] > 0]
+    zero = order[boxes_col[order] == 0]
+    ppcn = pd.to_numeric(df['PPCN'], errors='coerce').fillna(0).to_numpy() if 'PPCN' in df.columns else np.zeros(len(df))
+    ppcn = np.where(ppcn > 0, ppcn, 1).astype(np.int32)
+    fsn_all = _str_column(df, 'FSN')
+    ean_all = _str_column(df, 'EAN')
+
+    rows = active[np.repeat(np.arange(len(active)), boxes_col[active].astype(np.int64))]
+    n_real = len(rows)
+    n_groups = -(-len(zero) // MIX_GROUP_SIZE)
+    member_group = (np.arange(len(zero)) // MIX_GROUP_SIZE).astype(np.int32)
+    group_sizes = np.bincount(member_group, minlength=n_groups)
+    real = pd.DataFrame({
+        'Box No': np.arange(1, n_real + 1, dtype=np.int32),
+        'SKU': sku_all[rows], 'FSN': fsn_all[rows], 'EAN': ean_all[rows], 'Qty': ppcn[rows],
+        'Nominal Value': (BOX_UNIT_VALUE * ppcn[rows]).astype(np.int32),
+        'Dummy Group': np.full(n_real, -1, dtype=np.int32)
+    })
+    dummy = pd.DataFrame({
+        'Box No': np.arange(n_real + 1, n_real + n_groups + 1, dtype=np.int32),
+        'SKU': "MIX SKU", 'FSN': "MIX FSN", 'EAN': "", 'Qty': np.ones(n_groups, dtype=np.int32),
+        'Nominal Value': (BOX_UNIT_VALUE * group_sizes).astype(np.int32),
+        'Dummy Group': np.arange(n_groups, dtype=np.int32)
+    })
+    members = pd.DataFrame({
+        'Box No': (n_real + 1 + member_group).astype(np.int32),
+        'SKU': sku_all[zero], 'FSN': fsn_all[zero], 'Dummy Group': member_group
+    })
+    return {'boxes': pd.concat([real, dummy], ignore_index=True), 'dummy_members': members}
+
+def consignment_version(df):
+    """Content fingerprint of the columns that drive box numbering."""
+    cols = [c for c in ('SKU Id', 'Editable Boxes', 'PPCN', 'FSN', 'EAN') if c in df.columns]
+    return hashlib.sha1(pd.util.hash_pandas_object(df[cols], index=False).to_numpy().tobytes()).hexdigest()
+
+@st.cache_data(max_entries=64, show_spinner=False)
+def _cached_box_manifest(version, _df):
+    return build_box_manifest(_df)
+
+def box_manifest(df):
+    return _cached_box_manifest(consignment_version(df), df)
+
+# --- MULTI-STATION BOX CLAIMS ---
+CLAIMS_DB_FILE = os.path.join(STATE_DIR, "box_claims.sqlite3")
+CLAIM_LEASE_SECONDS = 45
+
+class BoxClaimService:
+    """SQLite-backed coordinator so several stations can scan one consignment without printing a box twice.
+    A claim holds a box for a short lease; it becomes permanent once the label is sent to the printer."""
+    def __init__(self, db_path=CLAIMS_DB_FILE, lease_seconds=CLAIM_LEASE_SECONDS):
+        self.db_path = db_path
+        self.lease_seconds = lease_seconds
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        con = self._conn()
+        try:
+            con.execute("CREATE TABLE IF NOT EXISTS box_claims (c_id TEXT NOT NULL, box_no INTEGER NOT NULL, status TEXT NOT NULL, "
+                        "station TEXT, lease_until REAL, PRIMARY KEY (c_id, box_no))")
+        finally: con.close()
+
+    def _conn(self):
+        return sqlite3.connect(self.db_path, timeout=10, isolation_level=None)
+
+    def claim_next(self, c_id, box_nos, station):
+        """Atomically claims the first box in `box_nos` that is neither printed nor leased by another station."""
+        now = time.time()
+        con = self._conn()
+        try:
+            con.execute("BEGIN IMMEDIATE")
+            blocked = {r[0] for r in con.execute("SELECT box_no FROM box_claims WHERE c_id = ? AND (status = 'printed' OR (lease_until > ? AND station != ?))",
+                                                 (c_id, now, station))}
+            box = next((int(b) for b in box_nos if int(b) not in blocked), None)
+            if box is not None: con.execute("INSERT OR REPLACE INTO box_claims VALUES (?, ?, 'claimed', ?, ?)", (c_id, box, station, now + self.lease_seconds))
+            con.execute("COMMIT")
+            return box
+        except Exception:
+            if con.in_transaction: con.execute("ROLLBACK")
+            raise
+        finally: con.close()
+
+    def mark_printed(self, c_id, box_no, station):
+        con = self._conn()
+        try: con.execute("INSERT OR REPLACE INTO box_claims VALUES (?, ?, 'printed', ?, NULL)", (c_id, int(box_no), station))
+        finally: con.close()
+
+    def release(self, c_id, box_no, station):
+        con = self._conn()
+        try: con.execute("DELETE FROM box_claims WHERE c_id = ? AND box_no = ? AND status = 'claimed' AND station = ?", (c_id, int(box_no), station))
+        finally: con.close()
+
+    def seed_printed(self, c_id, box_nos):
+        con = self._conn()
+        try: con.executemany("INSERT OR IGNORE INTO box_claims VALUES (?, ?, 'printed', 'history', NULL)", [(c_id, int(b)) for b in box_nos])
+        finally: con.close()
+
+    def progress(self, c_id):
+        """Returns (printed box set, {box_no: station} of live claims) shared by every session."""
+        now = time.time()
+        con = self._conn()
+        try: rows = con.execute("SELECT box_no, status, station, lease_until FROM box_claims WHERE c_id = ?", (c_id,)).fetchall()
+        finally: con.close()
+        printed = {r[0] for r in rows if r[1] == 'printed'}
+        claimed = {r[0]: r[2] for r in rows if r[1] == 'claimed' and (r[3] or 0) > now}
+        return printed, claimed
+
+@st.cache_resource(show_spinner=False)
+def box_claim_service():
+    return BoxClaimService()
+
+def station_id():
+    if 'station_id' not in st.session_state: st.session_state['station_id'] = uuid.uuid4().hex[:8]
+    return st.session_state['station_id']
+
 # --- PDF LOGIC ---
 def generate_confirm_consignment_csv(df):
-    output = io.BytesIO()
-    active_df = df[df['Editable Boxes'] > 0].sort_values(by='SKU Id')
-    zero_df = df[df['Editable Boxes'] == 0].sort_values(by='SKU Id')
-    rows = []
-    box_counter = 1
-    for _, row in active_df.iterrows():
-        try: num_boxes = int(row['Editable Boxes']); ppcn = int(float(row['PPCN'])) if float(row['PPCN']) > 0 else 1; fsn = row.get('FSN', '')
-        except: num_boxes=0; ppcn=1; fsn=''
-        nominal_val = 350 * ppcn
-        for _ in range(num_boxes):
-            rows.append({'BOX NUMBER': box_counter, 'BOX NAME': box_counter, 'LENGTH (cm)': 75, 'BREADTH (cm)': 55, 'HEIGHT (cm)': 40, 'WEIGHT (kg)': 10, 'NOMINAL VALUE (INR)': nominal_val, 'FSN': fsn, 'QUANTITY': ppcn})
-            box_counter += 1
-    if not zero_df.empty:
-        chunk_size = 20
-        zero_rows = zero_df.to_dict('records')
-        chunks = [zero_rows[i:i + chunk_size] for i in range(0, len(zero_rows), chunk_size)]
-        for chunk in chunks:
-            for row in chunk:
-                rows.append({'BOX NUMBER': box_counter, 'BOX NAME': box_counter, 'LENGTH (cm)': 75, 'BREADTH (cm)': 55, 'HEIGHT (cm)': 40, 'WEIGHT (kg)': 10, 'NOMINAL VALUE (INR)': 350, 'FSN': row.get('FSN', ''), 'QUANTITY': 1})
-            box_counter += 1
-    pd.DataFrame(rows).to_csv(output, index=False)
-    return output.getvalue()
-
-def generate_merged_box_labels(df, c_details, sender, receiver, flipkart_pdf_bytes, progress_bar=None):
-    if not flipkart_pdf_bytes: return None
-    box_data = []
-    active_df = df[df['Editable Boxes'] > 0].sort_values(by='SKU Id')
-    zero_df = df[df['Editable Boxes'] == 0].sort_values(by='SKU Id')
-    real_boxes_count = int(active_df['Editable Boxes'].sum())
-    dummy_boxes_count = math.ceil(len(zero_df) / 20) if not zero_df.empty else 0
-    total_boxes = real_boxes_count + dummy_boxes_count
-    current_box = 1
-    for _, row in active_df.iterrows():
-        boxes = int(row['Editable Boxes'])
-        for _ in range(boxes):
-            box_data.append({'num': current_box, 'total': total_boxes, 'sku': str(row['SKU Id']), 'qty': row['PPCN'], 'fsn': str(row.get('FSN', '')), 'type': 'real'})
-            current_box += 1
-    for _ in range(dummy_boxes_count):
-        box_data.append({'num': current_box, 'total': total_boxes, 'sku': "MIX SKU", 'qty': 1, 'fsn': "MIX FSN", 'type': 'dummy'})
-        current_box += 1
-    
-    writer = PdfWriter()
-    w_a4, h_a4 = A4; half_h = h_a4 / 2; SHIFT_UP = 25 * mm
-    total_items = len(box_data)
-    
-    temp_reader = PdfReader(io.BytesIO(flipkart_pdf_bytes))
-    
-    for i, box in enumerate(box_data):
-        if progress_bar: progress_bar.progress(int((i + 1) / total_items * 100), text=f"Processing Box {i+1}...")
-        packet = io.BytesIO()
-        c = canvas.Canvas(packet, pagesize=A4)
-        def draw_grid_table(y_top):
-            row_h = 10*mm; y_header = y_top; y_data = y_top - row_h
-            x_start = 10*mm; x_c1 = 30*mm; x_c2 = 85*mm; x_c3 = 175*mm; x_end = w_a4 - 10*mm
-            c.setLineWidth(1); c.line(x_start, y_header + row_h, x_end, y_header + row_h); c.line(x_start, y_header, x_end, y_header); c.line(x_start, y_data, x_end, y_data)
-            c.line(x_start, y_data, x_start, y_header + row_h); c.line(x_c1, y_data, x_c1, y_header + row_h); c.line(x_c2, y_data, x_c2, y_header + row_h); c.line(x_c3, y_data, x_c3, y_header + row_h); c.line(x_end, y_data, x_end, y_header + row_h)
-            c.setFont("Helvetica-Bold", 12); c.drawString(x_start + 2*mm, y_header + 3*mm, "SR NO."); c.drawString(x_c1 + 2*mm, y_header + 3*mm, "FSN"); c.drawString(x_c2 + 2*mm, y_header + 3*mm, "SKU ID"); c.drawString(x_c3 + 2*mm, y_header + 3*mm, "QTY")
-            c.setFont("Helvetica", 12)
-            c.drawString(x_start + 2*mm, y_data + 3*mm, "1."); c.drawString(x_c1 + 2*mm, y_data + 3*mm, box['fsn']); c.setFont("Helvetica", 12); c.drawString(x_c2 + 2*mm, y_data + 3*mm, box['sku'][:35]); c.setFont("Helvetica-Bold", 14); c.drawString(x_c3 + 2*mm, y_data + 3*mm, str(int(float(box['qty']))))
-            return y_data
-        def draw_slip(y_base):
-            c.setFont("Helvetica-Bold", 30); c.drawCentredString(w_a4/2, y_base + 45*mm, "PACKING SLIP")
-            data_bottom_y = draw_grid_table(y_base + 32*mm)
-            c.setFont("Helvetica-Bold", 30); c.drawCentredString(w_a4/2, data_bottom_y - 15*mm, f"BOX NO.- {box['num']}            BOX NAME- {box['num']}")
-        
-        draw_slip(240*mm); c.setLineWidth(2); c.line(0, 210*mm, w_a4, 210*mm); draw_slip(155*mm); c.setLineWidth(1); c.line(0, half_h, w_a4, half_h)
+    m = box_manifest(df)
+    real = m['boxes'][m['boxes']['Dummy Group'] < 0]
+    members = m['dummy_members']
+    box_no = np.concatenate([real['Box No'].to_numpy(), members['Box No'].to_numpy()])
+    out_df = pd.DataFrame({'BOX NUMBER': box_no, 'BOX NAME': box_no})
+    for col, val in BOX_DIMENSIONS.items(): out_df[col] = val
+    out_df['NOMINAL VALUE (INR)'] = np.concatenate([real['Nominal Value'].to_numpy(), np.full(len(members), BOX_UNIT_VALUE)])
+    out_df['FSN'] = np.concatenate([real['FSN'].to_numpy(), members['FSN'].to_numpy()])
+    out_df['QUANTITY'] = np.concatenate([real['Qty'].to_numpy(), np.ones(len(members), dtype=np.int32)])
+    return export_csv(out_df)
+
+def draw_packing_slip_page(c, box):
+    w_a4, h_a4 = A4; half_h = h_a4 / 2
+    def draw_grid_table(y_top):
+        row_h = 10*mm; y_header = y_top; y_data = y_top - row_h
+        x_start = 10*mm; x_c1 = 30*mm; x_c2 = 85*mm; x_c3 = 175*mm; x_end = w_a4 - 10*mm
+        c.setLineWidth(1); c.line(x_start, y_header + row_h, x_end, y_header + row_h); c.line(x_start, y_header, x_end, y_header); c.line(x_start, y_data, x_end, y_data)
+        c.line(x_start, y_data, x_start, y_header + row_h); c.line(x_c1, y_data, x_c1, y_header + row_h); c.line(x_c2, y_data, x_c2, y_header + row_h); c.line(x_c3, y_data, x_c3, y_header + row_h); c.line(x_end, y_data, x_end, y_header + row_h)
+        c.setFont("Helvetica-Bold", 12); c.drawString(x_start + 2*mm, y_header + 3*mm, "SR NO."); c.drawString(x_c1 + 2*mm, y_header + 3*mm, "FSN"); c.drawString(x_c2 + 2*mm, y_header + 3*mm, "SKU ID"); c.drawString(x_c3 + 2*mm, y_header + 3*mm, "QTY")
+        c.setFont("Helvetica", 12)
+        c.drawString(x_start + 2*mm, y_data + 3*mm, "1."); c.drawString(x_c1 + 2*mm, y_data + 3*mm, box['fsn']); c.setFont("Helvetica", 12); c.drawString(x_c2 + 2*mm, y_data + 3*mm, box['sku'][:35]); c.setFont("Helvetica-Bold", 14); c.drawString(x_c3 + 2*mm, y_data + 3*mm, str(int(float(box['qty']))))
+        return y_data
+    def draw_slip(y_base):
+        c.setFont("Helvetica-Bold", 30); c.drawCentredString(w_a4/2, y_base + 45*mm, "PACKING SLIP")
+        data_bottom_y = draw_grid_table(y_base + 32*mm)
+        c.setFont("Helvetica-Bold", 30); c.drawCentredString(w_a4/2, data_bottom_y - 15*mm, f"BOX NO.- {box['num']}            BOX NAME- {box['num']}")
+    draw_slip(240*mm); c.setLineWidth(2); c.line(0, 210*mm, w_a4, 210*mm); draw_slip(155*mm); c.setLineWidth(1); c.line(0, half_h, w_a4, half_h)
+    c.showPage()
+
+def page_as_form_xobject(writer, page):
+    """Wraps a source page (content + resources) as one compressed Form XObject in `writer`, so each box
+    page references it instead of carrying its own copy of the content stream."""
+    content = page.get_contents()
+    form = DecodedStreamObject(); form.set_data(content.get_data() if content is not None else b"")
+    form = form.flate_encode()
+    box = page.mediabox
+    form[NameObject("/Type")] = NameObject("/XObject"); form[NameObject("/Subtype")] = NameObject("/Form")
+    form[NameObject("/BBox")] = ArrayObject([FloatObject(box.left), FloatObject(box.bottom), FloatObject(box.right), FloatObject(box.top)])
+    if "/Resources" in page: form[NameObject("/Resources")] = page["/Resources"].clone(writer)
+    return writer._add_object(form)
+
+def _stream_ref(writer, data):
+    s = DecodedStreamObject(); s.set_data(data)
+    return writer._add_object(s)
+
+def stamp_form_on_page(writer, page, name, form_ref, ty, clip_h, open_ref):
+    # Slip content is wrapped in q/Q, then the Flipkart form is drawn shifted and clipped on top of it
+    res = DictionaryObject(page["/Resources"].get_object()) if "/Resources" in page else DictionaryObject()
+    xobjs = DictionaryObject(res["/XObject"].get_object()) if "/XObject" in res else DictionaryObject()
+    xobjs[NameObject(name)] = form_ref; res[NameObject("/XObject")] = xobjs
+    page[NameObject("/Resources")] = res
+    w = float(page.mediabox.width)
+    stamp = f"Q q 0 0 {w:.2f} {clip_h:.2f} re W n 1 0 0 1 0 {ty:.2f} cm {name} Do Q".encode()
+    existing = page["/Contents"].get_object() if "/Contents" in page else ArrayObject()
+    parts = list(existing) if isinstance(existing, ArrayObject) else [page["/Contents"]]
+    page[NameObject("/Contents")] = ArrayObject([open_ref] + parts + [_stream_ref(writer, stamp)])
+
+def optimise_pdf_writer(writer):
+    """Compresses content streams and drops duplicate/orphaned objects (fonts, images, forms) before writing."""
+    for page in writer.pages:
+        try: page.compress_content_streams()
+        except Exception as e: warnings.warn(f"PDF content stream left uncompressed: {e!r}", RuntimeWarning)
+    # The output is still valid without deduplication, just larger, so a failure here is reported, not raised
+    try: writer.compress_identical_objects(remove_duplicates=True, remove_unreferenced=True)
+    except Exception as e: warnings.warn(f"PDF object deduplication skipped: {e!r}", RuntimeWarning)
+
+MERGE_BATCH_BOXES = 200
+PROGRESS_INTERVAL_S = 0.5
+
+class MergeCancelled(Exception):
+    pass
+
+class ThrottledProgress:
+    """Updates a Streamlit progress bar at most every `interval` seconds, with an ETA, instead of once per item."""
+    def __init__(self, progress_bar, total, label="Processing Box", interval=PROGRESS_INTERVAL_S):
+        self.bar = progress_bar; self.total = max(1, total); self.label = label; self.interval = interval
+        self.start = self.last = time.time()
+
+    def update(self, done):
+        if self.bar is None: return
+        now = time.time()
+        if done < self.total and now - self.last < self.interval: return
+        self.last = now
+        eta = (now - self.start) / done * (self.total - done) if done else 0
+        self.bar.progress(min(100, int(done / self.total * 100)), text=f"{self.label} {done}/{self.total} · ETA {int(eta)}s")
+
+class StreamingPdfConcatenator:
+    """Appends the pages of many small PDFs to one output file, renumbering objects on the fly, so only the
+    part currently being copied is held in memory. Object 1 is the catalog and 2 the page tree (written on close)."""
+    def __init__(self, out):
+        self.out = out; self.offsets = [None, None, None]; self.kids = []
+        out.write(b"%PDF-1.7\n%\xe2\xe3\xcf\xd3\n")
+
+    def _new_id(self):
+        self.offsets.append(None)
+        return len(self.offsets) - 1
+
+    def _write_obj(self, num, obj):
+        self.offsets[num] = self.out.tell()
+        self.out.write(f"{num} 0 obj\n".encode()); obj.write_to_stream(self.out); self.out.write(b"\nendobj\n")
+
+    def add_pdf(self, pdf_bytes):
+        reader = PdfReader(io.BytesIO(pdf_bytes))
+        mapping = {}; queue = []
+        def remap(o, parent_key=None):
+            if isinstance(o, IndirectObject):
+                if o.idnum not in mapping: mapping[o.idnum] = self._new_id(); queue.append(o)
+                return IndirectObject(mapping[o.idnum], 0, None)
+            if isinstance(o, DictionaryObject):
+                n = copy.copy(o); dict.clear(n)
+                for k, v in dict.items(o): dict.__setitem__(n, k, IndirectObject(2, 0, None) if k == "/Parent" and o.get("/Type") == "/Page" else remap(v))
+                return n
+            if isinstance(o, ArrayObject): return ArrayObject(remap(v) for v in o)
+            return o
+        for page in reader.pages: self.kids.append(remap(page.indirect_reference))
+        while queue:
+            ref = queue.pop()
+            self._write_obj(mapping[ref.idnum], remap(ref.get_object()))
+
+    def close(self):
+        pages = DictionaryObject({NameObject("/Type"): NameObject("/Pages"), NameObject("/Kids"): ArrayObject(self.kids), NameObject("/Count"): NumberObject(len(self.kids))})
+        self._write_obj(2, pages)
+        self._write_obj(1, DictionaryObject({NameObject("/Type"): NameObject("/Catalog"), NameObject("/Pages"): IndirectObject(2, 0, None)}))
+        xref_at = self.out.tell()
+        self.out.write(f"xref\n0 {len(self.offsets)}\n0000000000 65535 f \n".encode())
+        self.out.write("".join(f"{off:010d} 00000 n \n" for off in self.offsets[1:]).encode())
+        self.out.write(f"trailer\n<< /Size {len(self.offsets)} /Root 1 0 R >>\nstartxref\n{xref_at}\n%%EOF\n".encode())
+
+def iter_merged_label_batches(box_data, fk_reader, on_box=None, batch_size=MERGE_BATCH_BOXES):
+    """Yields one small, optimised PDF (bytes) per batch of merged box pages; only one batch lives in memory."""
+    SHIFT_UP = float(25 * mm)
+    batch_size += batch_size % 2  # keep both boxes of a Flipkart page in the same batch
+    for start in range(0, len(box_data), batch_size):
+        chunk = box_data[start:start + batch_size]
+        # All slips of the batch in one canvas, so the Helvetica font objects are shared
+        packet = io.BytesIO(); c = canvas.Canvas(packet, pagesize=A4)
+        for box in chunk: draw_packing_slip_page(c, box)
         c.save(); packet.seek(0)
-        custom_page = PdfReader(packet).pages[0]
-        
-        fk_page_idx = i // 2; is_top_label = (i % 2 == 0)
-        
-        if fk_page_idx < len(temp_reader.pages):
-            result_page = PageObject.create_blank_page(width=w_a4, height=h_a4)
-            result_page.merge_page(custom_page)
-            fk_page = temp_reader.pages[fk_page_idx]
-            fk_h = fk_page.mediabox.height; fk_w = fk_page.mediabox.width
-            shift_amount = -(0.70 * float(fk_h)) + float(SHIFT_UP) if is_top_label else -(0.2 * float(fk_h)) + float(SHIFT_UP)
-            op = Transformation().translate(tx=0, ty=shift_amount)
-            fk_page.add_transformation(op)
-            if not is_top_label: fk_page.mediabox.lower_left = (0, 0); fk_page.mediabox.upper_right = (fk_w, (0.4 * float(fk_h)) + float(SHIFT_UP))
-            result_page.merge_page(fk_page)
-            writer.add_page(result_page)
-        else:
-            result_page = PageObject.create_blank_page(width=w_a4, height=h_a4)
-            result_page.merge_page(custom_page)
-            writer.add_page(result_page)
-            
-    out = io.BytesIO()
-    writer.write(out)
-    return out.getvalue()
+        slips = PdfReader(packet)
+        writer = PdfWriter(); forms = {}; open_ref = _stream_ref(writer, b"q")
+        for j, box in enumerate(chunk):
+            i = start + j
+            page = writer.add_page(slips.pages[j])
+            fk_page_idx = i // 2; is_top_label = (i % 2 == 0)
+            if fk_page_idx < len(fk_reader.pages):
+                fk_page = fk_reader.pages[fk_page_idx]
+                if fk_page_idx not in forms: forms[fk_page_idx] = page_as_form_xobject(writer, fk_page)
+                fk_h = float(fk_page.mediabox.height)
+                if is_top_label: shift_amount = -(0.70 * fk_h) + SHIFT_UP; clip_h = fk_h
+                else: shift_amount = -(0.2 * fk_h) + SHIFT_UP; clip_h = (0.4 * fk_h) + SHIFT_UP
+                stamp_form_on_page(writer, page, f"/FkP{fk_page_idx}", forms[fk_page_idx], shift_amount, clip_h, open_ref)
+            if on_box: on_box(i + 1)
+        optimise_pdf_writer(writer)
+        buf = io.BytesIO(); writer.write(buf)
+        yield buf.getvalue()
+
+def merge_box_labels_to_file(df, flipkart_pdf, out, progress_bar=None, should_cancel=None):
+    """Streams the merged label PDF into `out` batch by batch. `flipkart_pdf` is bytes or a seekable file.
+    Progress is throttled; `should_cancel()` is polled per box."""
+    boxes = box_manifest(df)['boxes']
+    total_boxes = len(boxes)
+    columns = zip(boxes['Box No'].tolist(), boxes['SKU'].tolist(), boxes['Qty'].tolist(), boxes['FSN'].tolist())
+    box_data = [{'num': n, 'total': total_boxes, 'sku': s, 'qty': q, 'fsn': f} for n, s, q, f in columns]
+    progress = ThrottledProgress(progress_bar, total_boxes)
+    def on_box(done):
+        if should_cancel and should_cancel(): raise MergeCancelled()
+        progress.update(done)
+    fk_reader = PdfReader(flipkart_pdf if hasattr(flipkart_pdf, 'read') else io.BytesIO(flipkart_pdf))
+    concat = StreamingPdfConcatenator(out)
+    for part in iter_merged_label_batches(box_data, fk_reader, on_box): concat.add_pdf(part)
+    concat.close()
+    return out
+
+def generate_merged_box_labels(df, c_details, sender, receiver, flipkart_pdf, progress_bar=None, should_cancel=None):
+    """Merged label PDF as an open temporary file positioned at 0 (the caller closes it), or None without source
+    labels. The file can go straight to StorageHandler.upload_large_file, so the merge is never held in memory."""
+    if not flipkart_pdf: return None
+    spool = tempfile.TemporaryFile()
+    try: merge_box_labels_to_file(df, flipkart_pdf, spool, progress_bar, should_cancel)
+    except BaseException:
+        spool.close()
+        raise
+    spool.seek(0)
+    return spool
+
+class ProgressRelay:
+    """st.progress stand-in for work on a helper thread: keeps the latest value for the script thread to draw."""
+    def __init__(self):
+        self.value, self.text = 0, ""
+
+    def progress(self, value, text=""):
+        self.value, self.text = value, text
+
+def merge_labels_in_session(pkg, flipkart_pdf, progress_bar, cancel):
+    """generate_merged_box_labels for the page's merge button. The merge runs on a helper thread and polls the
+    session's `cancel` flag (threading.Event) per box; the script thread draws progress and sets the flag when its
+    run is interrupted (Cancel click, navigation), so an abandoned merge stops instead of running on unseen."""
+    relay = ProgressRelay()
+    ctx = get_script_run_ctx()
+    args = (pkg['data'], pkg, pkg.get('sender', {}), pkg.get('receiver', {}), flipkart_pdf, relay, cancel.is_set)
+    with ThreadPoolExecutor(max_workers=1, initializer=lambda: add_script_run_ctx(threading.current_thread(), ctx)) as pool:
+        fut = pool.submit(generate_merged_box_labels, *args)
+        try:
+            while not fut.done():
+                progress_bar.progress(min(100, int(relay.value)), text=relay.text or "Merging Labels...")
+                time.sleep(PROGRESS_INTERVAL_S)
+        except BaseException:
+            cancel.set()
+            fut.add_done_callback(lambda f: f.exception() is None and f.result() is not None and f.result().close())
+            raise
+    return fut.result()
+
+PDF_ROW_H = 7 * mm
+PDF_BOTTOM = 15 * mm
+
+def _paged_table_capacities(n_rows, first_top, next_top, row_h=PDF_ROW_H, bottom=PDF_BOTTOM):
+    # Header + totals row are reserved on every page
+    first_cap = max(1, int((first_top - bottom) // row_h) - 2)
+    next_cap = max(1, int((next_top - bottom) // row_h) - 2)
+    caps = [first_cap]
+    remaining = n_rows - first_cap
+    while remaining > 0: caps.append(next_cap); remaining -= next_cap
+    return caps
+
+def draw_paged_table(c, header, col_widths, columns, totals=None, first_top=None, next_top=None, on_new_page=None, align=None, x=10*mm):
+    """Streams column arrays onto canvas pages: repeated header, running totals and page numbers."""
+    w, h = A4; row_h = PDF_ROW_H
+    first_top = h - 20*mm if first_top is None else first_top
+    next_top = h - 20*mm if next_top is None else next_top
+    totals = totals or {}
+    align = align or ['C'] * len(header)
+    n = len(columns[0]) if columns else 0
+    caps = _paged_table_capacities(n, first_top, next_top)
+    n_pages = len(caps)
+    xs = [x]
+    for cw in col_widths: xs.append(xs[-1] + cw)
+    cum = {ci: np.cumsum(np.asarray(arr, dtype=np.int64)) for ci, arr in totals.items()}
+    start = 0
+    for p, cap in enumerate(caps):
+        if p > 0:
+            c.showPage()
+            if on_new_page: on_new_page(c, p)
+        top = first_top if p == 0 else next_top
+        stop = min(start + cap, n); last = (p == n_pages - 1)
+
+        def put(ci, y, text):
+            if align[ci] == 'L': c.drawString(xs[ci] + 2*mm, y, text)
+            else: c.drawCentredString((xs[ci] + xs[ci+1]) / 2, y, text)
+
+        c.setFillColor(colors.lightgrey); c.rect(xs[0], top - row_h, xs[-1] - xs[0], row_h, fill=1, stroke=0); c.setFillColor(colors.black)
+        c.setFont("Helvetica-Bold", 10)
+        for ci, lbl in enumerate(header): put(ci, top - row_h + 2.3*mm, lbl)
+        c.setFont("Helvetica", 9)
+        for ci, col in enumerate(columns):
+            y = top - 2*row_h + 2.3*mm
+            for v in col[start:stop]: put(ci, y, v); y -= row_h
+        y_tot = top - (stop - start + 2) * row_h
+        c.setFont("Helvetica-Bold", 10)
+        put(0, y_tot + 2.3*mm, "TOTAL" if last else "C/F")
+        for ci, cs in cum.items(): put(ci, y_tot + 2.3*mm, str(int(cs[stop-1])) if stop > 0 else "0")
+        c.setLineWidth(1); c.grid(xs, [top - k * row_h for k in range(stop - start + 3)])
+        c.setFont("Helvetica", 8); c.drawRightString(w - 10*mm, 8*mm, f"Page {p+1} of {n_pages}")
+        start = stop
+
+def _int_column(df, col):
+    if col not in df.columns: return np.zeros(len(df), dtype=np.int64)
+    return pd.to_numeric(df[col], errors='coerce').fillna(0).astype(np.int64).to_numpy()
 
 def generate_consignment_data_pdf(df, c_details):
-    active_df = df[df['Editable Boxes'] > 0].copy()
-    buffer = io.BytesIO(); doc = SimpleDocTemplate(buffer, pagesize=A4, rightMargin=10*mm, leftMargin=10*mm, topMargin=10*mm, bottomMargin=10*mm); elements = []
-    elements.append(Paragraph(f"<b>Consignment ID:</b> {c_details['id']}", getSampleStyleSheet()['Heading2']))
-    elements.append(Paragraph(f"<b>Pickup Date:</b> {c_details['date']}", getSampleStyleSheet()['Normal']))
-    elements.append(Spacer(1, 10))
-    data = [['SKU', 'QTY', 'No. of Box']]; t_qty, t_box = 0, 0
-    for _, row in active_df.sort_values(by='SKU Id').iterrows():
-        qty = int(row['Editable Qty']); box = int(row['Editable Boxes']); t_qty += qty; t_box += box
-        data.append([str(row['SKU Id']), str(qty), str(box)])
-    data.append(['TOTAL', str(t_qty), str(t_box)])
-    table = Table(data, colWidths=[110*mm, 30*mm, 30*mm])
-    table.setStyle(TableStyle([('GRID', (0,0), (-1,-1), 1, colors.black), ('BACKGROUND', (0,0), (-1,0), colors.lightgrey), ('FONTNAME', (0,0), (-1,0), 'Helvetica-Bold')]))
-    elements.append(table); doc.build(elements)
+    active_df = df[df['Editable Boxes'] > 0].sort_values(by='SKU Id')
+    buffer = io.BytesIO(); c = canvas.Canvas(buffer, pagesize=A4); w, h = A4
+    c.setFont("Helvetica-Bold", 14); c.drawString(10*mm, h-15*mm, f"Consignment ID: {c_details['id']}")
+    c.setFont("Helvetica", 10); c.drawString(10*mm, h-22*mm, f"Pickup Date: {c_details['date']}")
+    def contd(cv, p):
+        cv.setFont("Helvetica-Bold", 10); cv.drawString(10*mm, h-12*mm, f"Consignment ID: {c_details['id']} (contd.)")
+    qty = _int_column(active_df, 'Editable Qty'); box = _int_column(active_df, 'Editable Boxes')
+    columns = [active_df['SKU Id'].astype(str).to_numpy(), qty.astype(str), box.astype(str)]
+    draw_paged_table(c, ['SKU', 'QTY', 'No. of Box'], [110*mm, 30*mm, 30*mm], columns, totals={1: qty, 2: box}, first_top=h-30*mm, on_new_page=contd, align=['L', 'C', 'C'])
+    c.save()
     return buffer.getvalue()
 
 def generate_challan(df, c_details, sender, receiver):
@@ -352,12 +1353,13 @@ def generate_challan(df, c_details, sender, receiver):
         c.setFont("Helvetica", 10); c.drawString(x, y-10*mm, str(data.get('Address1',''))); c.drawString(x, y-15*mm, f"{data.get('City','')}, {data.get('State','')}"); c.drawString(x, y-20*mm, f"GST: {data.get('GST','')}")
     draw_addr(15*mm, h-40*mm, sender, "FROM:"); draw_addr(110*mm, h-40*mm, receiver, "TO:")
     c.drawString(15*mm, h-95*mm, f"Date: {c_details['date']}")
-    active_df = df[df['Editable Boxes'] > 0].copy()
-    data = [['S.No', 'SKU', 'Product', 'Qty', 'Boxes']]; 
-    for i, row in active_df.iterrows(): data.append([str(i+1), str(row['SKU Id']), str(row.get('Product Name',''))[:25], str(int(row['Editable Qty'])), str(int(row['Editable Boxes']))])
-    table = Table(data, colWidths=[15*mm, 60*mm, 70*mm, 20*mm, 20*mm])
-    table.setStyle(TableStyle([('GRID', (0,0), (-1,-1), 1, colors.black), ('FONTNAME', (0,0), (-1,0), 'Helvetica-Bold'), ('ALIGN', (0,0), (-1,-1), 'CENTER')]))
-    table.wrapOn(c, w, h); table.drawOn(c, 10*mm, h-110*mm - (len(data)*7*mm))
+    def contd(cv, p):
+        cv.setFont("Helvetica-Bold", 10); cv.drawString(10*mm, h-12*mm, f"DELIVERY CHALLAN - Consignment ID: {c_details['id']} (contd.)")
+    active_df = df[df['Editable Boxes'] > 0]
+    qty = _int_column(active_df, 'Editable Qty'); box = _int_column(active_df, 'Editable Boxes')
+    names = active_df['Product Name'].astype(str).str[:25].to_numpy() if 'Product Name' in active_df.columns else np.full(len(active_df), '')
+    columns = [np.arange(1, len(active_df) + 1).astype(str), active_df['SKU Id'].astype(str).to_numpy(), names, qty.astype(str), box.astype(str)]
+    draw_paged_table(c, ['S.No', 'SKU', 'Product', 'Qty', 'Boxes'], [15*mm, 60*mm, 70*mm, 20*mm, 20*mm], columns, totals={3: qty, 4: box}, first_top=h-100*mm, on_new_page=contd)
     c.save()
     return buffer.getvalue()
 
@@ -375,29 +1377,294 @@ def generate_appointment_letter(c_details, sender, receiver):
     return buffer.getvalue()
 
 def generate_excel_simple(df, cols, filename):
-    output = io.BytesIO(); valid_cols = [c for c in cols if c in df.columns]
-    temp_df = df.copy()
-    if 'Qty' in cols and 'Qty' not in temp_df.columns: temp_df['Qty'] = temp_df['Editable Qty']
-    if 'Boxes' in cols and 'Boxes' not in temp_df.columns: temp_df['Boxes'] = temp_df['Editable Boxes']
-    with pd.ExcelWriter(output, engine='xlsxwriter') as writer: temp_df[valid_cols].to_excel(writer, index=False)
-    return output.getvalue()
-
-def generate_bartender_full(df):
-    active_df = df[df['Editable Boxes'] > 0].copy()
-    output = io.BytesIO(); master_df = load_master_data()
-    temp_df = active_df[['SKU Id', 'Editable Qty']].copy()
-    if 'FSN' in active_df.columns: temp_df['FSN_Temp'] = active_df['FSN']
-    elif 'Product Name' in active_df.columns: temp_df['FSN_Temp'] = active_df['Product Name']
-    else: temp_df['FSN_Temp'] = ''
-    export_df = pd.merge(temp_df, master_df, left_on='SKU Id', right_on='SKU', how='left')
-    if 'EAN' in export_df.columns: export_df['EAN'] = export_df['EAN'].astype(str).str.replace(r'\.0$', '', regex=True)
-    export_df['EAN'] = export_df.apply(lambda x: x['FSN_Temp'] if pd.isna(x.get('EAN')) else x['EAN'], axis=1)
+    aliases = {'Qty': 'Editable Qty', 'Boxes': 'Editable Boxes'}
+    columns = []
+    for c in cols:
+        if c in df.columns: columns.append(c)
+        elif aliases.get(c) in df.columns: columns.append((c, aliases[c]))
+    return export_xlsx([xlsx_sheet('Sheet1', df, columns)])
+
+def bartender_frame(df):
+    active_df = df[df['Editable Boxes'] > 0]
+    sku = active_df['SKU Id'].astype(str).to_numpy()
+    if 'FSN' in active_df.columns: fsn = active_df['FSN'].to_numpy()
+    elif 'Product Name' in active_df.columns: fsn = active_df['Product Name'].to_numpy()
+    else: fsn = np.full(len(sku), '', dtype=object)
+    export_df = pd.DataFrame({'SKU Id': sku, 'Editable Qty': active_df['Editable Qty'].to_numpy(), 'FSN_Temp': fsn})
+    master = master_data_index()
+    if not master.empty: export_df = pd.concat([export_df, master.reindex(sku).reset_index(drop=True)], axis=1)
+    if 'EAN' in export_df.columns: export_df['EAN'] = export_df['EAN'].where(export_df['EAN'].notna(), export_df['FSN_Temp'])
+    else: export_df['EAN'] = export_df['FSN_Temp']
     export_df['QTY'] = export_df['Editable Qty']
     if 'SKU' in export_df.columns: export_df['SKU'] = export_df['SKU'].fillna(export_df['SKU Id'])
     else: export_df['SKU'] = export_df['SKU Id']
-    with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
-        export_df.to_excel(writer, index=False)
-    return output.getvalue()
+    return export_df
+
+def bartender_unit_rows(qty, per_sheet=1):
+    """Positional row index and label QTY for one row per unit (per_sheet=1) or per label sheet of `per_sheet` units."""
+    qty = np.maximum(np.nan_to_num(np.asarray(qty, dtype=float)), 0).astype(np.int64)
+    per_sheet = max(1, int(per_sheet))
+    counts = -(-qty // per_sheet)
+    rows = np.repeat(np.arange(len(qty)), counts)
+    starts = np.cumsum(counts) - counts
+    k = np.arange(len(rows)) - np.repeat(starts, counts)
+    return rows, np.minimum(per_sheet, qty[rows] - k * per_sheet)
+
+def generate_bartender_full(df, per_unit=False, per_sheet=1, fmt='xlsx', out=None):
+    export_df = bartender_frame(df)
+    rows, overrides = None, {}
+    if per_unit:
+        rows, label_qty = bartender_unit_rows(export_df['Editable Qty'].to_numpy(), per_sheet)
+        overrides = {'QTY': label_qty}
+    if fmt == 'csv': return export_csv(export_df, rows, overrides, out)
+    if rows is None: return export_xlsx([xlsx_sheet('Sheet1', export_df, formats={'EAN': 'text'})], out)
+    # The label QTY is per output row, not per SKU, so every column is expanded here rather than through `rows`
+    columns = [(c, overrides[c] if c in overrides else export_df[c].to_numpy()[rows]) for c in export_df.columns]
+    return export_xlsx([xlsx_sheet('Sheet1', export_df, columns, formats={'EAN': 'text'})], out)
+
+# --- UNIT LABELS ---
+LABEL_LAYOUTS = {
+    'Zebra Roll 50x25mm': {'page': (50*mm, 25*mm), 'label': (50*mm, 25*mm), 'cols': 1, 'rows': 1, 'origin': (0, 0)},
+    'Zebra Roll 2-up 100x25mm': {'page': (100*mm, 25*mm), 'label': (50*mm, 25*mm), 'cols': 2, 'rows': 1, 'origin': (0, 0)},
+    'A4 Sheet 40 (52.5x29.7mm)': {'page': A4, 'label': (52.5*mm, 29.7*mm), 'cols': 4, 'rows': 10, 'origin': (0, 0)},
+    'A4 Sheet 65 (38.1x21.2mm)': {'page': A4, 'label': (38.1*mm, 21.2*mm), 'cols': 5, 'rows': 13, 'origin': (4.7*mm, 10.7*mm)},
+}
+
+def is_valid_ean13(val):
+    if len(val) != 13 or not val.isdigit(): return False
+    digits = [int(ch) for ch in val]
+    return (10 - sum(d * (3 if i % 2 else 1) for i, d in enumerate(digits[:12])) % 10) % 10 == digits[12]
+
+def _label_text(v):
+    return '' if v is None or (isinstance(v, float) and math.isnan(v)) else str(v).removesuffix('.0')
+
+EAN_L_CODES = ['0001101', '0011001', '0010011', '0111101', '0100011', '0110001', '0101111', '0111011', '0110111', '0001011']
+EAN_PARITY = ['LLLLLL', 'LLGLGG', 'LLGGLG', 'LLGGGL', 'LGLLGG', 'LGGLLG', 'LGGGLL', 'LGLGLL', 'LGLGGL', 'LGGLGL']
+
+def ean13_modules(val):
+    """95-module bar pattern ('1' = bar) for a valid 13-digit EAN."""
+    r_codes = [''.join('1' if b == '0' else '0' for b in code) for code in EAN_L_CODES]
+    left = ''.join(EAN_L_CODES[int(d)] if p == 'L' else r_codes[int(d)][::-1] for d, p in zip(val[1:7], EAN_PARITY[int(val[0])]))
+    right = ''.join(r_codes[int(d)] for d in val[7:])
+    return '101' + left + '01010' + right + '101'
+
+def _draw_ean13(c, val, x, y, width, height):
+    # Bars are drawn as merged runs straight onto the canvas; digits sit in the guard-bar gaps
+    mod = width / 102.0; x0 = x + 7 * mod; font = min(7, 9 * mod)
+    text_h = font + 1; bar_y = y + text_h
+    modules = ean13_modules(val)
+    p = c.beginPath(); i = 0
+    while i < 95:
+        if modules[i] == '1':
+            j = i
+            while j < 95 and modules[j] == '1': j += 1
+            guard = i < 3 or 45 <= i < 50 or i >= 92
+            p.rect(x0 + i * mod, bar_y - (text_h * 0.6 if guard else 0), (j - i) * mod, height - text_h + (text_h * 0.6 if guard else 0))
+            i = j
+        else: i += 1
+    c.drawPath(p, stroke=0, fill=1)
+    c.setFont("Helvetica", font)
+    c.drawString(x, y + 1, val[0])
+    c.drawCentredString(x0 + 24 * mod, y + 1, val[1:7]); c.drawCentredString(x0 + 71 * mod, y + 1, val[7:])
+
+def _draw_code128(c, val, x, y, width, height):
+    probe = Code128(val, barWidth=1, barHeight=height - 9, humanReadable=True, quiet=0)
+    Code128(val, barWidth=width / probe.width, barHeight=height - 9, humanReadable=True, quiet=0).drawOn(c, x, y + 9)
+
+def _define_unit_label_form(c, name, label_w, label_h, ean, sku, size, colour, mrp, symbology):
+    # Drawn once per EAN as a form XObject, then stamped with doForm for every copy
+    pad = 1.5*mm
+    c.beginForm(name, lowerx=0, lowery=0, upperx=label_w, uppery=label_h)
+    c.setFont("Helvetica-Bold", 7); c.drawString(pad, label_h - pad - 6, sku[:34])
+    c.setFont("Helvetica", 6)
+    c.drawString(pad, label_h - pad - 13, f"Size: {size}  {colour}"[:36])
+    if mrp: c.drawRightString(label_w - pad, label_h - pad - 13, f"MRP Rs.{mrp}")
+    if ean:
+        use_ean = is_valid_ean13(ean) and symbology in ('auto', 'EAN13')
+        (_draw_ean13 if use_ean else _draw_code128)(c, ean, pad, pad, label_w - 2*pad, label_h - 2*pad - 16)
+    c.endForm()
+
+def iter_label_pages(keys, layout):
+    """Yields one list of (key, x, y) placements per page, so pages stream out as the canvas writes them."""
+    lw, lh = layout['label']; pw, ph = layout['page']; ox, oy = layout['origin']
+    slots = [(ox + col * lw, ph - oy - (row + 1) * lh) for row in range(layout['rows']) for col in range(layout['cols'])]
+    per_page = len(slots)
+    for start in range(0, len(keys), per_page):
+        yield [(k, x, y) for k, (x, y) in zip(keys[start:start + per_page], slots)]
+
+def generate_unit_labels_pdf(df, layout_name='A4 Sheet 40 (52.5x29.7mm)', symbology='auto', out=None):
+    """One barcode label per physical unit, driven by the consignment data and the master data index."""
+    layout = LABEL_LAYOUTS[layout_name]
+    export_df = bartender_frame(df)
+    rows, _ = bartender_unit_rows(export_df['Editable Qty'].to_numpy())
+    ean = export_df['EAN'].map(_label_text)
+    codes, _ = pd.factorize(ean)
+    size_col = 'UK Size' if 'UK Size' in export_df.columns else ('EU Size' if 'EU Size' in export_df.columns else None)
+    text_cols = {k: export_df[c].to_numpy() if c in export_df.columns else np.full(len(export_df), None) for k, c in [('sku', 'SKU'), ('colour', 'color'), ('mrp', 'MRP')]}
+    text_cols['size'] = export_df[size_col].to_numpy() if size_col else np.full(len(export_df), None)
+    first_row = {}
+    for i, code in enumerate(codes): first_row.setdefault(code, i)
+    target = out if out is not None else io.BytesIO()
+    c = canvas.Canvas(target, pagesize=layout['page'], pageCompression=1)
+    lw, lh = layout['label']; defined = set()
+    for placements in iter_label_pages(codes[rows], layout):
+        for code, x, y in placements:
+            name = f"UL{code}"
+            if code not in defined:
+                i = first_row[code]
+                _define_unit_label_form(c, name, lw, lh, ean.iat[i], _label_text(text_cols['sku'][i]), _label_text(text_cols['size'][i]), _label_text(text_cols['colour'][i]), _label_text(text_cols['mrp'][i]), symbology)
+                defined.add(code)
+            c.saveState(); c.translate(x, y); c.doForm(name); c.restoreState()
+        c.showPage()
+    c.save()
+    if out is not None: return out
+    return target.getvalue()
+
+# --- DOCUMENT BUNDLE ---
+BUNDLE_WORKERS = 8
+ARTIFACT_CACHE_MAX_BYTES = 256 * 1024 * 1024
+ZIP_STORED_SUFFIXES = ('.pdf', '.xlsx')  # already compressed
+
+class ArtifactCache:
+    """Process-wide LRU of generated dispatch documents keyed by (consignment id, artifact, content fingerprint)."""
+    def __init__(self, max_bytes=ARTIFACT_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes; self.items = {}; self.size = 0; self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            data = self.items.pop(key, None)
+            if data is not None: self.items[key] = data
+            return data
+
+    def put(self, key, data):
+        with self.lock:
+            old = self.items.pop(key, None)
+            if old is not None: self.size -= len(old)
+            self.items[key] = data; self.size += len(data)
+            while self.size > self.max_bytes and len(self.items) > 1:
+                self.size -= len(self.items.pop(next(iter(self.items))))
+
+@st.cache_resource(show_spinner=False)
+def artifact_cache():
+    return ArtifactCache()
+
+def artifact_fingerprint(pkg):
+    """Changes whenever anything a generated document is built from changes."""
+    digest = hashlib.sha1(_canon({k: pkg.get(k) for k in ('id', 'date', 'channel', 'sender', 'receiver')}).encode())
+    for key in ('data', 'original_data'):
+        if isinstance(pkg.get(key), pd.DataFrame) and not pkg[key].empty: digest.update(pd.util.hash_pandas_object(pkg[key], index=False).to_numpy().tobytes())
+    return digest.hexdigest()
+
+def cached_artifact(key, fn):
+    """(data, source) of a generated document: an artifact_cache() hit, or fn() stored there as bytes."""
+    data = artifact_cache().get(key)
+    if data is not None: return data, 'cache'
+    data = fn()
+    if isinstance(data, str): data = data.encode('utf-8')
+    if data: artifact_cache().put(key, data)
+    return data, 'generated'
+
+def consignment_artifacts(pkg, fingerprint=None):
+    """{kind: (file name, builder)} for the dispatch documents of a consignment. Builders return (data or None, source):
+    generated documents go through artifact_cache() as bytes; uploaded PDFs (labels, challan, appointment) are read
+    from storage first as open spools, the challan and appointment falling back to generated ones."""
+    c_id, df = pkg['id'], pkg['data']
+    snd, rcv = pkg.get('sender', {}), pkg.get('receiver', {})
+    fingerprint = fingerprint or artifact_fingerprint(pkg)
+    def raw_csv():
+        orig = pkg.get('original_data')
+        return orig.to_csv(index=False) if isinstance(orig, pd.DataFrame) and not orig.empty else b''
+    def generated(kind, fn):
+        return lambda: cached_artifact((c_id, kind, fingerprint), fn)
+    def stored(filename, fallback=None):
+        def build():
+            spool = StorageHandler.download_to_spool(filename)
+            if spool is not None: return spool, 'stored'
+            return fallback() if fallback else (None, 'missing')
+        return build
+    return {
+        'raw_csv': (f"{c_id}.csv", generated('raw_csv', raw_csv)),
+        'data_pdf': (f"Data_{c_id}.pdf", generated('data_pdf', lambda: generate_consignment_data_pdf(df, pkg))),
+        'confirm_csv': (f"Confirm_{c_id}.csv", generated('confirm_csv', lambda: generate_confirm_consignment_csv(df))),
+        'bartender': (f"Bartender_All_{c_id}.xlsx", generated('bartender', lambda: generate_bartender_full(df))),
+        'eway': (f"Eway_{c_id}.xlsx", generated('eway', lambda: generate_excel_simple(df, ['SKU Id', 'Editable Qty', 'Cost Price'], f"Eway_{c_id}.xlsx"))),
+        'labels': (f"Labels_{c_id}.pdf", stored(f"{c_id}_merged_labels.pdf")),
+        'challan': (f"Challan_{c_id}.pdf", stored(f"{c_id}_challan.pdf", generated('challan', lambda: generate_challan(df, pkg, snd, rcv)))),
+        'appointment': (f"Appt_{c_id}.pdf", stored(f"{c_id}_appointment.pdf", generated('appointment', lambda: generate_appointment_letter(pkg, snd, rcv)))),
+    }
+
+def artifact_bytes(pkg, kind, fingerprint=None):
+    """One document for the individual download buttons, sharing the bundle's cache. Pages pass the
+    fingerprint they computed once for the run."""
+    data = consignment_artifacts(pkg, fingerprint)[kind][1]()[0]
+    if hasattr(data, 'read'):
+        with data: return data.read()
+    return data
+
+def _timed(build):
+    t0 = time.time(); data, source = build()
+    return data, source, time.time() - t0
+
+def _write_zip_entry(zf, name, data):
+    """Copies bytes or an open file (closed afterwards) into the archive block by block; returns (size, sha256)."""
+    info = zipfile.ZipInfo(name, date_time=time.localtime()[:6])
+    info.compress_type = zipfile.ZIP_STORED if name.endswith(ZIP_STORED_SUFFIXES) else zipfile.ZIP_DEFLATED
+    src = io.BytesIO(data) if isinstance(data, (bytes, bytearray)) else data
+    digest, size = hashlib.sha256(), 0
+    with src, zf.open(info, 'w', force_zip64=True) as dst:
+        for block in iter(lambda: src.read(SPOOL_MEMORY_LIMIT), b''):
+            digest.update(block)
+            dst.write(block)
+            size += len(block)
+    return size, digest.hexdigest()
+
+def build_consignment_bundle(pkg, kinds=None, workers=BUNDLE_WORKERS, fingerprint=None):
+    """Builds the consignment's documents concurrently and streams each into a ZIP as it completes.
+    Returns (zip spool, manifest): the archive is a SpooledTemporaryFile positioned at 0 that spills to disk
+    past SPOOL_MEMORY_LIMIT; the caller closes it. The manifest is also stored in the archive as manifest.json."""
+    fingerprint = fingerprint or artifact_fingerprint(pkg)
+    artifacts = consignment_artifacts(pkg, fingerprint)
+    kinds = [k for k in (kinds or artifacts) if k in artifacts]
+    ctx = get_script_run_ctx(suppress_warning=True)  # None on a job worker
+    t0 = time.time()
+    entries = []
+    out = tempfile.SpooledTemporaryFile(max_size=SPOOL_MEMORY_LIMIT)
+    pool = ThreadPoolExecutor(max_workers=max(1, min(workers, len(kinds))),
+                              initializer=lambda: add_script_run_ctx(threading.current_thread(), ctx))
+    try:
+        with zipfile.ZipFile(out, 'w', zipfile.ZIP_DEFLATED) as zf, pool:
+            futures = {pool.submit(_timed, artifacts[k][1]): k for k in kinds}
+            for fut in as_completed(futures):
+                kind = futures[fut]
+                name = artifacts[kind][0]
+                try: data, source, secs = fut.result()
+                except Exception as e:
+                    entries.append({'kind': kind, 'file': name, 'source': 'error', 'error': str(e)})
+                    continue
+                if not data:
+                    entries.append({'kind': kind, 'file': name, 'source': 'missing'})
+                    continue
+                size, sha256 = _write_zip_entry(zf, name, data)
+                entries.append({'kind': kind, 'file': name, 'source': source, 'bytes': size, 'sha256': sha256,
+                                'seconds': round(secs, 3)})
+            entries.sort(key=lambda e: kinds.index(e['kind']))
+            manifest = {
+                'consignment': pkg['id'], 'channel': pkg.get('channel'), 'date': pkg.get('date'),
+                'edit_version': edit_head(pkg), 'fingerprint': fingerprint,
+                'created_at': pd.Timestamp.now().isoformat(timespec='seconds'),
+                'build_seconds': round(time.time() - t0, 3), 'files': entries,
+            }
+            zf.writestr('manifest.json', json.dumps(manifest, indent=2, default=str))
+    except BaseException:
+        out.close()
+        raise
+    out.seek(0)
+    return out, manifest
+
+def spool_bytes(spool):
+    """Contents of a spool kept open across reruns (e.g. for a deferred download button)."""
+    spool.seek(0)
+    return spool.read()
 
 # --- HELPER LOGIC ---
 def clean_sku(val):
@@ -406,41 +1673,97 @@ def clean_sku(val):
     if val.upper().startswith("SKU:"): val = val[4:]
     return val.strip()
 
-def compute_booked_details_from_history():
+# Column kernels below work on the distinct values of a column (pd.factorize) and broadcast back through the
+# codes, so a month of sales rows costs as much as its few thousand distinct SKUs/states.
+def clean_sku_series(s):
+    """clean_sku for a whole column; returns a categorical Series aligned with `s`."""
+    codes, uniques = pd.factorize(s, use_na_sentinel=False)
+    u = pd.Series(np.asarray(uniques, dtype=object), dtype=object)
+    is_str = np.array([isinstance(v, str) for v in u], dtype=bool)
+    txt = u[is_str].str.replace('"', '', regex=False).str.replace("'", '', regex=False)
+    txt = txt.where(~txt.str.upper().str.startswith('SKU:'), txt.str[4:]).str.strip()
+    out = np.empty(len(u), dtype=object); out[is_str] = txt.to_numpy(dtype=object)
+    # factorize folds None into NaN and 1.0/True into 1, which str() tells apart, so non-strings go by their text per cell
+    other = np.flatnonzero(~is_str[codes])
+    if len(other):
+        extra_codes, extra = pd.factorize(s.to_numpy(dtype=object)[other].astype(str))
+        codes = codes.copy(); codes[other] = len(u) + extra_codes
+        out[~is_str] = extra[0]; out = np.concatenate([out, np.asarray(extra, dtype=object)])
+    cats, inverse = np.unique(out.astype(str), return_inverse=True)
+    return pd.Series(pd.Categorical.from_codes(inverse.reshape(-1)[codes], categories=cats), index=s.index)
+
+def listing_pattern_mask(s, pattern):
+    """Case-insensitive regex search per distinct value (NaN never matches); boolean array aligned with `s`."""
+    codes, uniques = pd.factorize(s)
+    hits = pd.Series(np.asarray(uniques, dtype=object), dtype=object).str.contains(pattern, case=False, na=False, regex=True).to_numpy(dtype=bool)
+    return np.append(hits, False)[np.where(codes >= 0, codes, len(hits))]
+
+def state_zone_columns(s):
+    """(zone, warehouse) categoricals for a delivery-state column via STATE_ZONE_LOOKUP; NaN when unmapped."""
+    codes, uniques = pd.factorize(s)
+    found = [STATE_ZONE_LOOKUP.get(' '.join(u.split()).casefold()) if isinstance(u, str) else None for u in uniques]
+    out = []
+    for part in (0, 1):
+        cats = sorted({f[part] for f in found if f})
+        pos = {c: i for i, c in enumerate(cats)}
+        code_u = np.array([pos[f[part]] if f else -1 for f in found] + [-1], dtype=np.int64)
+        out.append(pd.Series(pd.Categorical.from_codes(code_u[np.where(codes >= 0, codes, len(found))], categories=cats), index=s.index))
+    return out[0], out[1]
+
+def compute_booked_details_from_history(channel=None):
     history = load_history()
     today = pd.Timestamp.now().date()
-    details = {}; dates_set = set()
+    frames = []; dates_set = set()
     for h in history:
         if h.get('task_type') != 'execution': continue
         if h.get('is_booked') is False: continue
+        if channel and h.get('channel', 'Flipkart') != channel: continue
         try: d_obj = pd.to_datetime(h.get('date')).date()
         except: continue
         if d_obj >= today:
             dates_set.add(str(d_obj))
             df = h.get('data')
             if isinstance(df, pd.DataFrame) and not df.empty:
-                for _, r in df.iterrows():
-                    sku_col = None
-                    for col in df.columns:
-                        if re.search(r'^sku', col, re.IGNORECASE): sku_col = col; break
-                    if not sku_col: continue
-                    sku = clean_sku(r[sku_col])
-                    qty_col = None
-                    for col in df.columns:
-                        if re.search(r'editable qty|quantity|qty', col, re.IGNORECASE): qty_col = col; break
-                    box_col = None
-                    for col in df.columns:
-                        if re.search(r'editable boxes|boxes|box', col, re.IGNORECASE): box_col = col; break
-                    try: q = int(float(r.get(qty_col, 0))) if qty_col else 0
-                    except: q = 0
-                    try: b = int(float(r.get(box_col, 0))) if box_col else 0
-                    except: b = 0
-                    if sku not in details: details[sku] = {'total_qty': 0, 'total_boxes': 0, 'dates': {}}
-                    details[sku]['total_qty'] += q; details[sku]['total_boxes'] += b
-                    ds = details[sku]['dates']; ds.setdefault(str(d_obj), {'qty': 0, 'boxes': 0})
-                    ds[str(d_obj)]['qty'] += q; ds[str(d_obj)]['boxes'] += b
+                frames.append(pd.DataFrame({'SKU': df['SKU Id'].astype(str), 'Date': str(d_obj), 'qty': df['Editable Qty'], 'boxes': df['Editable Boxes']}))
+    details = {}
+    if frames:
+        booked = pd.concat(frames, ignore_index=True)
+        skus = pd.Categorical(booked['SKU'])
+        booked['SKU'] = np.array([clean_sku(v) for v in skus.categories], dtype=object)[skus.codes]
+        per_date = booked.groupby(['SKU', 'Date'], sort=True)[['qty', 'boxes']].sum()
+        for (sku, d), q, b in zip(per_date.index, per_date['qty'].tolist(), per_date['boxes'].tolist()):
+            v = details.setdefault(sku, {'total_qty': 0, 'total_boxes': 0, 'dates': {}})
+            v['total_qty'] += q; v['total_boxes'] += b; v['dates'][d] = {'qty': q, 'boxes': b}
     return details, sorted(list(dates_set))
 
+def compute_booked_by_warehouse(skus, channel=None):
+    """Qty of upcoming booked consignments per (SKU, zone warehouse) as an array over `skus` x ZONES_ORDER, plus
+    a vector of booked qty whose receiver state maps to no zone."""
+    today = pd.Timestamp.now().date()
+    frames = []
+    for h in load_history():
+        if h.get('task_type') != 'execution' or h.get('is_booked') is False: continue
+        if channel and h.get('channel', 'Flipkart') != channel: continue
+        try: d_obj = pd.to_datetime(h.get('date')).date()
+        except: continue
+        df = h.get('data')
+        if d_obj < today or not isinstance(df, pd.DataFrame) or df.empty: continue
+        state = (h.get('receiver') or {}).get('State')
+        zone = None
+        if isinstance(state, str): zone = STATE_ZONE_LOOKUP.get(' '.join(state.split()).casefold(), ('',))[0].title()
+        frames.append(pd.DataFrame({
+            'SKU': df['SKU Id'].astype(str),
+            'wh': ZONES_ORDER.index(zone) if zone in ZONES_ORDER else len(ZONES_ORDER),
+            'qty': pd.to_numeric(df['Editable Qty'], errors='coerce').fillna(0),
+        }))
+    out = np.zeros((len(skus), len(ZONES_ORDER) + 1))
+    if frames:
+        booked = pd.concat(frames, ignore_index=True)
+        row = pd.Index(skus).get_indexer(clean_sku_series(booked['SKU']).astype(str))
+        ok = row >= 0
+        np.add.at(out, (row[ok], booked['wh'].to_numpy()[ok]), booked['qty'].to_numpy()[ok])
+    return out[:, :-1], out[:, -1]
+
 def compute_booked_map_from_details(details):
     m = {}
     for sku, v in details.items(): m[sku] = v.get('total_qty', 0)
@@ -470,198 +1793,1161 @@ def generate_booked_summary_pdf_bytes(booked_details, selected_dates=None):
     doc.build(elements); buffer.seek(0)
     return buffer.getvalue()
 
-def split_df_by_quantity_limit(df, qty_col, limit):
-    chunks = []; current_rows = []; current_sum = 0
-    for _, row in df.iterrows():
-        q = int(row[qty_col]) if pd.notna(row[qty_col]) else 0
-        if q > limit:
-            if current_rows:
-                chunks.append(pd.DataFrame(current_rows)); current_rows = []; current_sum = 0
-            chunks.append(pd.DataFrame([row])); continue
-        if current_sum + q > limit:
-            if current_rows: chunks.append(pd.DataFrame(current_rows))
-            current_rows = [row]; current_sum = q
-        else: current_rows.append(row); current_sum += q
-    if current_rows: chunks.append(pd.DataFrame(current_rows))
-    final = []
-    for c in chunks:
-        if isinstance(c, pd.DataFrame): final.append(c.reset_index(drop=True))
-        else: final.append(pd.DataFrame(c).reset_index(drop=True))
-    return final
-
-def calculate_single_warehouse_plan(sales_df, inv_df, settings, include_duplicates, mode_type):
-    tpl_df = load_template_db(mode_type)
-    booked_details, _ = compute_booked_details_from_history()
-    booked_map = compute_booked_map_from_details(booked_details)
-    
-    sales_df.columns = [str(c).strip() for c in sales_df.columns]
-    if 'SKU' in sales_df.columns: col_sku = 'SKU'
-    elif len(sales_df.columns) > 5: col_sku = sales_df.columns[5]
-    else: return pd.DataFrame(), "SKU Column not found", pd.DataFrame(), pd.DataFrame(), pd.DataFrame()
-    if 'Quantity' in sales_df.columns: col_qty = 'Quantity'
-    elif len(sales_df.columns) > 13: col_qty = sales_df.columns[13]
-    else: return pd.DataFrame(), "Quantity Column not found", pd.DataFrame(), pd.DataFrame(), pd.DataFrame()
-    possible_state = [c for c in sales_df.columns if 'Delivery State' in str(c)]
-    if possible_state: col_state = possible_state[0]
-    elif len(sales_df.columns) > 50: col_state = sales_df.columns[50]
-    else: return pd.DataFrame(), "State Column not found", pd.DataFrame(), pd.DataFrame(), pd.DataFrame()
-
-    sales_df['Clean_SKU'] = sales_df[col_sku].apply(clean_sku)
-    pattern = r"KBRV-\d+$" if not include_duplicates else r"^KBRV(?:[A-Z]*?)-\d+$"
-    filtered_sales = sales_df[sales_df['Clean_SKU'].str.contains(pattern, case=False, na=False, regex=True)].copy()
-
-    def map_state(s):
-        if not isinstance(s, str): return (None, None)
-        res = STATE_TO_ZONE.get(s)
-        if not res: res = STATE_TO_ZONE.get(s.title())
-        if not res: res = STATE_TO_ZONE.get(s.strip().title())
-        return res if res else (None, None)
-
-    if not filtered_sales.empty:
-        filtered_sales[['Zone', 'WH_Col']] = filtered_sales[col_state].apply(lambda x: pd.Series(map_state(x)))
-        filtered_sales[col_qty] = pd.to_numeric(filtered_sales[col_qty], errors='coerce').fillna(0)
-        global_sales = filtered_sales.groupby('Clean_SKU')[col_qty].sum().to_dict()
-        zone_sales = filtered_sales.groupby(['Clean_SKU', 'Zone'])[col_qty].sum().reset_index()
-    else: global_sales = {}; zone_sales = pd.DataFrame(columns=['Clean_SKU','Zone',col_qty])
+def listing_template_error(tpl_db, channel):
+    """Why a channel's active-listing template cannot be filled, or None."""
+    sku_col, qty_col, cost_col = PLAN_CHANNELS[channel]['template_cols']
+    pos = [c for c in (qty_col, cost_col) if isinstance(c, int)]
+    if pos and tpl_db.shape[1] <= max(pos): return f"Template must have at least {max(pos) + 1} columns (so Column {' and '.join(chr(65 + c) for c in pos)} exist)."
+    if sku_col not in tpl_db.columns: return f"Template needs a '{sku_col}' column."
+    return None
+
+LISTING_QTY_LIMIT = 4999  # units per active-listing upload file
+
+def quantity_chunk_bounds(q, limit=LISTING_QTY_LIMIT):
+    """Row offsets cutting `q` into consecutive chunks of at most `limit` units, filled greedily in order; a row
+    above the limit gets a chunk of its own. One cumulative sum, then a binary search per chunk."""
+    cum = np.concatenate([[0], np.cumsum(np.asarray(q, dtype=np.int64))])
+    bounds = [0]; n = len(cum) - 1
+    while bounds[-1] < n:
+        i = bounds[-1]
+        bounds.append(max(int(np.searchsorted(cum, cum[i] + limit, side='right')) - 1, i + 1))
+    return bounds
+
+def plan_listing_files(tpl_db, groups, channel, cost, limit=LISTING_QTY_LIMIT):
+    """Active-listing files of a plan from one template join. `groups` is [(name, {SKU: qty})]; each group's
+    template rows with qty > 0 (sorted by SKU) get the channel's quantity/cost columns and are cut into files of
+    at most `limit` units. Returns (rows in template columns, [(group, file no, start, stop)]); nothing is
+    rendered until listing_csv_bytes is called."""
+    sku_col, qty_col, cost_col = PLAN_CHANNELS[channel]['template_cols']
+    parts = [pd.DataFrame({'__G__': gi, sku_col: list(m.keys()), '__Q__': np.fromiter(m.values(), dtype=np.int64, count=len(m))}) for gi, (_, m) in enumerate(groups)]
+    qty = pd.concat(parts, ignore_index=True) if parts else pd.DataFrame({'__G__': [], sku_col: [], '__Q__': []})
+    qty = qty[qty['__Q__'] > 0]
+    tpl = tpl_db.reset_index(drop=True); tpl['__R__'] = np.arange(len(tpl))
+    joined = qty.merge(tpl, on=sku_col, how='inner')
+    joined = joined.iloc[np.lexsort((joined['__R__'].to_numpy(), joined[sku_col].astype(str).str.upper().to_numpy(), joined['__G__'].to_numpy()))].reset_index(drop=True)
+    for col, val in ((qty_col, joined['__Q__']), (cost_col, cost)):
+        if col is not None: joined[tpl_db.columns[col] if isinstance(col, int) else col] = val
+    cols = list(tpl_db.columns) + [c for c in (qty_col, cost_col) if isinstance(c, str) and c not in tpl_db.columns]
+    g = joined['__G__'].to_numpy(); q = joined['__Q__'].to_numpy(); files = []
+    for gi, (name, _) in enumerate(groups):
+        lo, hi = np.searchsorted(g, [gi, gi + 1])
+        b = quantity_chunk_bounds(q[lo:hi], limit)
+        files += [(name, k, lo + a, lo + z) for k, (a, z) in enumerate(zip(b[:-1], b[1:]), start=1)]
+    return joined[cols], files
+
+def listing_csv_bytes(rows, start, stop):
+    return rows.iloc[start:stop].to_csv(index=False).encode()
+
+def listing_file_name(group, idx, task_id):
+    return f"Download_{str(group).replace(' ', '_')}_{idx}_{task_id}.csv"
+
+def listing_zip_bytes(rows, files, task_id):
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, 'w', zipfile.ZIP_DEFLATED) as zf:
+        for group, idx, start, stop in files: zf.writestr(listing_file_name(group, idx, task_id), listing_csv_bytes(rows, start, stop))
+    return buf.getvalue()
+
+PLAN_SKU_PATTERNS = {False: r"KBRV-\d+$", True: r"^KBRV(?:[A-Z]*?)-\d+$"}  # keyed by include_duplicates
+
+# --- PLANNING CHANNELS ---
+# Per-channel adapters for the shared planner: report column aliases (canonical name first; Flipkart also falls
+# back to column positions), listing SKU filter (None plans every SKU), zone -> FC for multi-warehouse plans and
+# the active-listing template (files per mode, SKU column, quantity/cost columns by position or name).
+# Amazon and Myntra FC codes are not known here: they come from PLAN_CHANNELS_FILE, and multi-warehouse plans
+# for a channel are refused until all four zones have one. Their template files are this app's own storage
+# names (written by the template uploader) and can be renamed there too.
+PLAN_CHANNELS = {
+    'Flipkart': {
+        'sales': {'sheet': 'Sales Report', 'SKU': ['SKU'], 'Quantity': ['Quantity'], 'Delivery State': ['Delivery State'],
+                  'positions': (5, 13, 50)},
+        'inventory': ['Live on Website'],
+        'sku_patterns': PLAN_SKU_PATTERNS, 'fcs': ZONE_WAREHOUSE,
+        'templates': {'single': TEMPLATE_SINGLE_FILE, 'multi': TEMPLATE_MULTI_FILE}, 'template_cols': ('SKU', 14, 15),
+    },
+    'Amazon': {
+        'sales': {'sheet': None, 'SKU': ['SKU', 'sku', 'Merchant SKU', 'seller-sku'],
+                  'Quantity': ['Quantity', 'quantity', 'quantity-shipped', 'Units Ordered'],
+                  'Delivery State': ['Delivery State', 'ship-state', 'Ship To State', 'Ship State']},
+        'inventory': ['Live on Website', 'afn-fulfillable-quantity', 'Fulfillable Quantity', 'Available'],
+        'sku_patterns': None, 'fcs': None,
+        'templates': {'single': "active_listing_amazon.csv", 'multi': "active_listing_amazon_multi.csv"},
+        'template_cols': ('SKU', 'Quantity', None),
+    },
+    'Myntra': {
+        'sales': {'sheet': None, 'SKU': ['SKU', 'seller sku code', 'Seller SKU Code', 'sku code', 'SKU Code'],
+                  'Quantity': ['Quantity', 'quantity', 'Qty'],
+                  'Delivery State': ['Delivery State', 'state', 'State', 'Customer Delivery State']},
+        'inventory': ['Live on Website', 'Sellable Inventory Count', 'inventory count', 'Inventory Count'],
+        'sku_patterns': None, 'fcs': None,
+        'templates': {'single': "active_listing_myntra.csv", 'multi': "active_listing_myntra_multi.csv"},
+        'template_cols': ('SKU', 'Quantity', None),
+    },
+}
 
+@st.cache_resource(ttl=900, show_spinner=False)
+def channel_config():
+    """PLAN_CHANNELS_FILE as {channel: {'fcs': {zone: FC code}, 'templates': {mode: file}}}; {} if absent or invalid."""
+    data = StorageHandler.download_file(PLAN_CHANNELS_FILE)
+    try: cfg = json.loads(data) if data else {}
+    except ValueError: return {}
+    return cfg if isinstance(cfg, dict) else {}
+
+def save_channel_fcs(channel, fcs):
+    cfg = copy.deepcopy(channel_config())
+    cfg.setdefault(channel, {})['fcs'] = {z: str(fcs[z]).strip() for z in ZONES_ORDER}
+    StorageHandler.upload_file(PLAN_CHANNELS_FILE, json.dumps(cfg, indent=2).encode(), f"Update {channel} FC codes")
+    channel_config.clear()
+
+def channel_fcs(channel):
+    """Zone -> FC code of a channel, or None while any zone has no configured code."""
+    fcs = (channel_config().get(channel) or {}).get('fcs') or PLAN_CHANNELS[channel]['fcs'] or {}
+    if not all(isinstance(fcs.get(z), str) and fcs[z].strip() for z in ZONES_ORDER): return None
+    return {z: fcs[z].strip() for z in ZONES_ORDER}
+
+def channel_warehouses(channel):
+    """FC codes of a channel in ZONES_ORDER; [] when they are not configured."""
+    fcs = channel_fcs(channel)
+    return [fcs[z] for z in ZONES_ORDER] if fcs else []
+
+def channel_template_file(channel, mode_type):
+    files = (channel_config().get(channel) or {}).get('templates') or {}
+    return files.get(mode_type) or PLAN_CHANNELS[channel]['templates'][mode_type]
+
+def channel_fcs_missing(channel):
+    return f"No FC codes configured for {channel}. Set one per zone in Settings before planning multiple warehouses."
+
+def channel_listing_mask(sku, channel, include_duplicates=None):
+    """Listing filter of a channel over a SKU column; None = either strict or duplicate listings pass."""
+    patterns = PLAN_CHANNELS[channel]['sku_patterns']
+    if patterns is None: return np.asarray(sku.notna(), dtype=bool)
+    if include_duplicates is None: return listing_pattern_mask(sku, patterns[False]) | listing_pattern_mask(sku, patterns[True])
+    return listing_pattern_mask(sku, patterns[include_duplicates])
+
+def _plan_fail(msg):
+    return pd.DataFrame(), msg, pd.DataFrame(), pd.DataFrame(), pd.DataFrame()
+
+def plan_ppcn(skus, mode_type, channel='Flipkart'):
+    """PPCN per SKU: 16 by default, then the listing template, then master data (first matching row wins)."""
+    ppcn = np.full(len(skus), 16, dtype=np.int64)
+    tpl_df = load_template_db(mode_type, channel)
+    sources = [tpl_df if not tpl_df.empty and 'SKU' in tpl_df.columns and 'PPCN' in tpl_df.columns else None, master_data_index()]
+    for src in sources:
+        if src is None or src.empty or 'PPCN' not in src.columns: continue
+        vals = pd.to_numeric(src.drop_duplicates(subset='SKU').set_index('SKU')['PPCN'].reindex(skus), errors='coerce').to_numpy(dtype=float)
+        ok = np.isfinite(vals)
+        ppcn[ok] = np.trunc(vals[ok]).astype(np.int64)
+    return ppcn
+
+def _plan_stock(inv_df):
     inv_df.columns = [str(c).strip() for c in inv_df.columns]
     inv_grouped = {}
     if 'SKU' in inv_df.columns and 'Live on Website' in inv_df.columns:
-        inv_df['Clean_SKU'] = inv_df['SKU'].apply(clean_sku)
+        inv_df['Clean_SKU'] = clean_sku_series(inv_df['SKU'])
         inv_df['Live on Website'] = pd.to_numeric(inv_df['Live on Website'], errors='coerce').fillna(0)
-        inv_grouped = inv_df.groupby('Clean_SKU')['Live on Website'].sum().to_dict()
+        inv_grouped = inv_df.groupby('Clean_SKU', observed=True)['Live on Website'].sum().to_dict()
     else:
         qty_cols = [c for c in inv_df.columns if re.search(r'Live on Website|live on website|Live on website|qty|quantity|Live|Live Qty|LiveQty', c, re.IGNORECASE)]
         if 'SKU' in inv_df.columns and qty_cols:
-            inv_df['Clean_SKU'] = inv_df['SKU'].apply(clean_sku)
+            inv_df['Clean_SKU'] = clean_sku_series(inv_df['SKU'])
             inv_df[qty_cols[0]] = pd.to_numeric(inv_df[qty_cols[0]], errors='coerce').fillna(0)
-            inv_grouped = inv_df.groupby('Clean_SKU')[qty_cols[0]].sum().to_dict()
+            inv_grouped = inv_df.groupby('Clean_SKU', observed=True)[qty_cols[0]].sum().to_dict()
         else:
             if 'SKU' in inv_df.columns:
-                inv_df['Clean_SKU'] = inv_df['SKU'].apply(clean_sku)
+                inv_df['Clean_SKU'] = clean_sku_series(inv_df['SKU'])
                 numeric_cols = inv_df.select_dtypes(include='number').columns.tolist()
-                if numeric_cols: inv_grouped = inv_df.groupby('Clean_SKU')[numeric_cols].sum().sum(axis=1).to_dict()
+                if numeric_cols: inv_grouped = inv_df.groupby('Clean_SKU', observed=True)[numeric_cols].sum().sum(axis=1).to_dict()
             elif inv_df.shape[1] >= 2:
-                inv_df['Clean_SKU'] = inv_df.iloc[:,1].apply(clean_sku)
+                inv_df['Clean_SKU'] = clean_sku_series(inv_df.iloc[:,1])
                 numeric_cols = inv_df.select_dtypes(include='number').columns.tolist()
-                if numeric_cols: inv_grouped = inv_df.groupby('Clean_SKU')[numeric_cols].sum().sum(axis=1).to_dict()
-
-    final_rows = []; summary_rows = []; zone_summary_rows = []
-    sales_skus = set(filtered_sales['Clean_SKU'].unique()) if not filtered_sales.empty else set()
-    booked_skus = set(booked_map.keys())
-    unique_skus = list(sales_skus.union(booked_skus))
-
-    for sku in unique_skus:
-        tot_sales = float(global_sales.get(sku, 0))
-        tot_stock_orig = float(inv_grouped.get(sku, 0))
-        booked_qty = int(booked_map.get(sku, 0))
-        ppcn = 16 
-        if not tpl_df.empty and 'SKU' in tpl_df.columns and 'PPCN' in tpl_df.columns:
-            m_row = tpl_df[tpl_df['SKU'] == sku]
-            if not m_row.empty: 
-                try: ppcn = int(float(m_row.iloc[0]['PPCN']))
-                except: pass
-        master_df = load_master_data()
-        if not master_df.empty and 'SKU' in master_df.columns and 'PPCN' in master_df.columns:
-             m_row = master_df[master_df['SKU'] == sku]
-             if not m_row.empty:
-                 try: ppcn = int(float(m_row.iloc[0]['PPCN']))
-                 except: pass
-
-        try: req_net = float(tot_sales) - float(tot_stock_orig) - float(booked_qty)
-        except: req_net = 0.0
-        total_boxes_needed = int(math.floor(req_net / ppcn)) if ppcn > 0 else 0
-        boxes_for_summary = total_boxes_needed
-        final_qty_for_summary = total_boxes_needed * ppcn
-        summary_rows.append({'SKU': sku, 'Sales_30': tot_sales, 'FBF_Qty': int(tot_stock_orig), 'Qty_Booked': int(booked_qty), 'Needed_Qty': req_net, 'Boxes': int(boxes_for_summary), 'Final_Qty': int(final_qty_for_summary), 'PPCN': int(ppcn)})
-
-        sku_z_data = zone_sales[zone_sales['Clean_SKU'] == sku].copy()
-        if not sku_z_data.empty: sku_z_data = sku_z_data.rename(columns={col_qty: 'ZoneSales'}) if col_qty in sku_z_data.columns else sku_z_data
-        else: sku_z_data = pd.DataFrame(columns=['Clean_SKU','Zone','ZoneSales'])
-
-        allocated_map = {}
-        if sku_z_data.empty or total_boxes_needed <= 0: allocated_map = {}
-        else:
-            sku_z_data['Zone'] = sku_z_data['Zone'].astype(str).str.title()
-            sku_z_data['ZoneSales'] = pd.to_numeric(sku_z_data['ZoneSales'], errors='coerce').fillna(0)
-            zone_sales_nonzero = sku_z_data[sku_z_data['ZoneSales'] > 0].copy()
-            zcount = len(zone_sales_nonzero)
-            if zcount == 0:
-                top_zone = sku_z_data.sort_values(by='ZoneSales', ascending=False).iloc[0]['Zone']
-                allocated_map[top_zone] = int(total_boxes_needed)
-            else:
-                if total_boxes_needed >= zcount:
-                    for z in zone_sales_nonzero['Zone'].tolist(): allocated_map[z] = 1
-                    remaining = int(total_boxes_needed - zcount)
-                    if remaining > 0:
-                        zone_sales_nonzero['Share'] = zone_sales_nonzero['ZoneSales'] / tot_sales if tot_sales > 0 else 0
-                        zone_sales_nonzero['Ideal'] = zone_sales_nonzero['Share'] * total_boxes_needed
-                        zone_sales_nonzero['ToAdd'] = zone_sales_nonzero['Ideal'].apply(lambda x: int(math.floor(x - 1)) if (x - 1) > 0 else 0)
-                        zone_sales_nonzero['Allocated'] = zone_sales_nonzero['ToAdd'] + 1
-                        used = int(zone_sales_nonzero['Allocated'].sum())
-                        remaining = int(total_boxes_needed - used)
-                        if remaining > 0:
-                            zone_sales_nonzero['Frac'] = (zone_sales_nonzero['Ideal'] - zone_sales_nonzero['Ideal'].apply(math.floor))
-                            zone_sales_nonzero = zone_sales_nonzero.sort_values(by=['Frac','ZoneSales'], ascending=[False,False])
-                            for idx, row in zone_sales_nonzero.iterrows():
-                                if remaining <= 0: break
-                                zone_sales_nonzero.at[idx, 'Allocated'] += 1
-                                remaining -= 1
-                        for _, r in zone_sales_nonzero.iterrows(): allocated_map[r['Zone']] = int(r['Allocated'])
-                else:
-                    zone_sales_nonzero = zone_sales_nonzero.sort_values(by='ZoneSales', ascending=False)
-                    for z in zone_sales_nonzero['Zone'].tolist(): allocated_map[z] = 0
-                    top_zones = zone_sales_nonzero.head(int(total_boxes_needed))
-                    for _, r in top_zones.iterrows(): allocated_map[r['Zone']] = allocated_map.get(r['Zone'], 0) + 1
-
-        for zone_name, boxes in allocated_map.items():
-            if boxes > 0:
-                final_rows.append({'SKU Id': sku, 'Zone': zone_name.title() if zone_name else "Unknown", 'Required Qty': req_net, 'Editable Boxes': int(boxes), 'Editable Qty': int(boxes * ppcn), 'PPCN': ppcn, 'Stock': int(tot_stock_orig), 'Qty_Booked': int(booked_qty)})
-
-        for zone in ZONES_ORDER:
-            ztitle = zone
-            boxes_zone = allocated_map.get(ztitle, 0)
-            boxes_zone = max(0, int(boxes_zone))
-            zone_summary_rows.append({'SKU': sku, 'Zone': ztitle, 'Sales_30': tot_sales, 'FBF_Qty': int(tot_stock_orig), 'Qty_Booked': int(booked_qty), 'Needed_Qty': req_net, 'Boxes': int(boxes_zone), 'Final_Qty': int(boxes_zone * ppcn), 'PPCN': int(ppcn)})
-
-    summary_df = pd.DataFrame(summary_rows)
-    zone_summary_df = pd.DataFrame(zone_summary_rows)
-    if not zone_summary_df.empty:
-        zone_pivot = zone_summary_df.pivot_table(index='SKU', columns='Zone', values='Boxes', aggfunc='sum').fillna(0)
-        for z in ZONES_ORDER:
-            if z not in zone_pivot.columns: zone_pivot[z] = 0
-        zone_pivot = zone_pivot[ZONES_ORDER].reset_index()
-        combined = pd.merge(summary_df, zone_pivot, left_on='SKU', right_on='SKU', how='left').fillna(0)
-    else:
-        combined = summary_df.copy()
-        for z in ZONES_ORDER: combined[z] = 0
-        if 'Qty_Booked' not in combined.columns: combined['Qty_Booked'] = 0
-
-    ordered_cols = ['SKU', 'Sales_30', 'FBF_Qty', 'Qty_Booked', 'Needed_Qty', 'Boxes', 'Final_Qty', 'PPCN'] + ZONES_ORDER
-    combined = combined[[c for c in ordered_cols if c in combined.columns]]
-    combined = combined.fillna(0)
-    for c in ['Sales_30','FBF_Qty','Qty_Booked','Needed_Qty','Boxes','Final_Qty','PPCN'] + ZONES_ORDER:
-        if c in combined.columns:
-            if c in ZONES_ORDER or c in ['Boxes','Final_Qty','PPCN','Qty_Booked']: combined[c] = combined[c].astype(int)
-            else: combined[c] = pd.to_numeric(combined[c], errors='coerce').fillna(0)
-
-    if 'SKU' in combined.columns: combined = combined.sort_values(by='SKU', key=lambda s: s.str.upper()).reset_index(drop=True)
-    if 'SKU' in summary_df.columns: summary_df = summary_df.sort_values(by='SKU', key=lambda s: s.str.upper()).reset_index(drop=True)
-
-    if not final_rows: return pd.DataFrame(final_rows), "Calculated rows are empty.", summary_df, zone_summary_df, combined
-
-    final_rows_df = pd.DataFrame(final_rows)
-    if 'SKU Id' in final_rows_df.columns:
-        final_rows_df['SKU_sort'] = final_rows_df['SKU Id'].astype(str).str.upper()
-        zone_order_map = {z: i for i, z in enumerate(ZONES_ORDER)}
-        final_rows_df['Zone_order'] = final_rows_df['Zone'].map(lambda x: zone_order_map.get(x.title(), 999))
-        final_rows_df = final_rows_df.sort_values(by=['SKU_sort','Zone_order']).drop(columns=['SKU_sort','Zone_order']).reset_index(drop=True)
+                if numeric_cols: inv_grouped = inv_df.groupby('Clean_SKU', observed=True)[numeric_cols].sum().sum(axis=1).to_dict()
+    return inv_grouped
+
+def plan_sales_columns(sales_df, channel='Flipkart'):
+    """(SKU, quantity, delivery state) column names of a channel's sales report, by alias (the state also by
+    substring) or, for Flipkart, by position."""
+    spec = PLAN_CHANNELS[channel]['sales']; positions = spec.get('positions', (None, None, None)); found = []
+    for canon, label, pos in zip(['SKU', 'Quantity', 'Delivery State'], ['SKU', 'Quantity', 'State'], positions):
+        col = next((c for c in spec[canon] if c in sales_df.columns), None)
+        if col is None and canon == 'Delivery State': col = next((c for c in sales_df.columns if any(a in str(c) for a in spec[canon])), None)
+        if col is None and pos is not None and len(sales_df.columns) > pos: col = sales_df.columns[pos]
+        if col is None: return None, f"{label} Column not found"
+        found.append(col)
+    return tuple(found), "Success"
+
+SALES_EVENT_COLUMNS = {'Order Item ID': ['Order Item ID', 'Order Item Id', 'order_item_id'], 'Order Date': ['Order Date', 'Order Approval Date', 'Buyer Invoice Date', 'Event Date'],
+                       'Event Type': ['Event Type'], 'Event Sub Type': ['Event Sub Type']}
+
+def plan_sales_event_columns(sales_df):
+    """{canonical name: column} for the per-order columns of a sales report that are present (item id, date, event)."""
+    found = {}
+    for canon, names in SALES_EVENT_COLUMNS.items():
+        col = next((c for c in names if c in sales_df.columns), None)
+        if col is not None: found[canon] = col
+    return found
+
+def plan_inventory_columns(inv_df, channel='Flipkart'):
+    """(SKU, live quantity) columns of a channel's inventory export, or None if it has no SKU column."""
+    col_sku = next((c for c in PLAN_CHANNELS[channel]['sales']['SKU'] if c in inv_df.columns), None)
+    if col_sku is None: return None
+    col_qty = next((c for c in PLAN_CHANNELS[channel]['inventory'] if c in inv_df.columns), None)
+    if col_qty is not None: return col_sku, col_qty
+    qty_cols = [c for c in inv_df.columns if re.search(r'Live on Website|live on website|Live on website|qty|quantity|Live|Live Qty|LiveQty', c, re.IGNORECASE)]
+    return (col_sku, qty_cols[0]) if qty_cols else None
+
+def _warehouse_key(v):
+    return re.sub(r'[^a-z0-9]', '', str(v).casefold())
+
+def plan_inventory_warehouse_columns(inv_df, warehouses=WAREHOUSES):
+    """Per-warehouse layout of an inventory export: ('wide', {warehouse index: column}) when it has one quantity
+    column per warehouse id, ('long', column) when a warehouse/location column names the warehouse of each row,
+    or None."""
+    keys = {_warehouse_key(w): j for j, w in enumerate(warehouses)}
+    wide = {keys[_warehouse_key(c)]: c for c in inv_df.columns if _warehouse_key(c) in keys}
+    if wide: return 'wide', wide
+    loc = next((c for c in inv_df.columns if re.search(r'warehouse|location|\bfc\b', str(c), re.IGNORECASE)), None)
+    return ('long', loc) if loc is not None else None
+
+def plan_warehouse_stock(inv_df, skus, warehouses=WAREHOUSES):
+    """Live stock per `skus` x `warehouses`, or None if the export has no per-warehouse breakdown."""
+    layout = plan_inventory_warehouse_columns(inv_df, warehouses)
+    if layout is None or 'SKU' not in inv_df.columns: return None
+    row = pd.Index(skus).get_indexer(clean_sku_series(inv_df['SKU']).astype(str))
+    out = np.zeros((len(skus), len(warehouses)))
+    if layout[0] == 'wide':
+        ok = row >= 0
+        for j, c in layout[1].items():
+            qty = pd.to_numeric(inv_df[c], errors='coerce').fillna(0).to_numpy()
+            np.add.at(out[:, j], row[ok], qty[ok])
+        return out
+    cols = plan_inventory_columns(inv_df)
+    if cols is None: return None
+    keys = {_warehouse_key(w): j for j, w in enumerate(warehouses)}
+    codes, uniques = pd.factorize(inv_df[layout[1]])
+    # one lookup per distinct location; the trailing -1 catches missing values (code -1)
+    unique_wh = np.array([keys.get(_warehouse_key(u), -1) for u in uniques] + [-1], dtype=np.int64)
+    wh = unique_wh[np.where(codes >= 0, codes, len(uniques))]
+    ok = (row >= 0) & (wh >= 0)
+    qty = pd.to_numeric(inv_df[cols[1]], errors='coerce').fillna(0).to_numpy()
+    np.add.at(out, (row[ok], wh[ok]), qty[ok])
+    return out
+
+def build_plan_inputs(sales_df, inv_df, mode_type, channel='Flipkart'):
+    """Reduces the uploads to per-SKU aggregates (sales, sales per zone, stock, booked qty, PPCN) plus which
+    listing filter each SKU passes. Returns (inputs, error message); allocate_plan works from `inputs` alone."""
+    sales_df.columns = [str(c).strip() for c in sales_df.columns]
+    cols, msg = plan_sales_columns(sales_df, channel)
+    if cols is None: return None, msg
+    col_sku, col_qty, col_state = cols
+
+    sales_df['Clean_SKU'] = clean_sku_series(sales_df[col_sku])
+    listed = channel_listing_mask(sales_df['Clean_SKU'], channel)
+    filtered_sales = sales_df[listed]
+    zone, _ = state_zone_columns(filtered_sales[col_state])
+    demand = pd.DataFrame({'Clean_SKU': filtered_sales['Clean_SKU'].cat.remove_unused_categories(), 'Zone': zone, 'Quantity': pd.to_numeric(filtered_sales[col_qty], errors='coerce').fillna(0)})
+    demand = demand.groupby(['Clean_SKU', 'Zone'], observed=True, dropna=False).agg(Quantity=('Quantity', 'sum'), Rows=('Quantity', 'size')).reset_index()
+    return plan_inputs_from_demand(demand, inv_df, mode_type, channel)
+
+def plan_inputs_from_demand(demand, inv_df, mode_type, channel='Flipkart'):
+    """build_plan_inputs from listing demand already summed per (Clean_SKU, Zone) with its row count `Rows`;
+    Zone is NaN for states outside STATE_TO_ZONE (counted in total sales, not in any zone). Shared by uploaded
+    exports and DemandStore windows. Booked qty counts the channel's own upcoming consignments."""
+    warehouses = channel_warehouses(channel)
+    if mode_type == 'multi' and not warehouses: return None, channel_fcs_missing(channel)
+    inv_df = reduce_inventory_frame(inv_df, channel)
+    booked_details, _ = compute_booked_details_from_history(channel)
+    booked_map = compute_booked_map_from_details(booked_details)
 
+    demand = demand[demand['Rows'] > 0]
+    sku = demand['Clean_SKU'].astype(str); zone = demand['Zone'].astype(object)
+    global_sales = demand['Quantity'].groupby(sku).sum()
+    mapped = zone.notna()
+    zone_sales = demand['Quantity'][mapped].groupby([sku[mapped], zone[mapped]]).sum()
+
+    inv_grouped = _plan_stock(inv_df)
+    sales_skus = pd.Index(global_sales.index.astype(str))
+    skus = sales_skus.union(pd.Index([k for k in booked_map if k not in sales_skus], dtype=object), sort=False) if booked_map else sales_skus
+    zone_table = zone_sales.unstack() if len(zone_sales) else pd.DataFrame(index=sales_skus)
+    zone_table = zone_table.reindex(index=skus, columns=sorted(zone_table.columns, key=str))
+    sku_arr = pd.Series(skus.to_numpy(dtype=object))
+    in_sales = skus.isin(sales_skus)  # hashed; np.isin on objects is quadratic
+    inputs = {
+        'skus': skus.to_numpy(dtype=object),
+        'sales': global_sales.reindex(skus).fillna(0).to_numpy(dtype=float),
+        'zones': [str(z).title() for z in zone_table.columns],
+        'zone_sales': zone_table.fillna(0).to_numpy(dtype=float),
+        'zone_present': zone_table.notna().to_numpy(),
+        'stock': pd.Series(inv_grouped, dtype=float).reindex(skus).fillna(0).to_numpy(dtype=float) if inv_grouped else np.zeros(len(skus)),
+        'booked': pd.Series(booked_map, dtype=float).reindex(skus).fillna(0).to_numpy().astype(np.int64) if booked_map else np.zeros(len(skus), dtype=np.int64),
+        'pass_strict': channel_listing_mask(sku_arr, channel, False) & in_sales,
+        'pass_dupe': channel_listing_mask(sku_arr, channel, True) & in_sales,
+        'is_booked_sku': skus.isin(list(booked_map)),
+        'ppcn': plan_ppcn(skus, mode_type, channel),
+        'mode_type': mode_type, 'channel': channel, 'warehouses': warehouses,
+    }
+    # Warehouse matrices for the multi-warehouse engine (zone columns map 1:1 onto the channel's FCs)
+    wh_zone = [ZONES_ORDER.index(z) if z in ZONES_ORDER else -1 for z in inputs['zones']]
+    wh_sales = np.zeros((len(skus), len(ZONES_ORDER)))
+    for i, j in enumerate(wh_zone):
+        if j >= 0: wh_sales[:, j] += inputs['zone_sales'][:, i]
+    wh_stock = plan_warehouse_stock(inv_df, skus, warehouses) if warehouses else None
+    inputs['wh_stock_split'] = wh_stock is None
+    if wh_stock is None: wh_stock = _split_by_share(inputs['stock'], wh_sales)
+    wh_booked, unplaced = compute_booked_by_warehouse(skus, channel)
+    inputs.update(wh_sales=wh_sales, wh_stock=wh_stock, wh_booked=wh_booked + _split_by_share(unplaced, wh_sales))
+    return inputs, "Success"
+
+def _split_by_share(total, weights):
+    """Spreads a per-SKU total over warehouses by each row's weights (evenly when a row has none)."""
+    w = np.where(weights.sum(axis=1, keepdims=True) > 0, weights, 1.0)
+    return total[:, None] * w / w.sum(axis=1, keepdims=True)
+
+def _allocate_zone_boxes(boxes, zs, present, sales):
+    """Splits each SKU's boxes over its zones (rows = SKUs, columns = zones): every selling zone gets one box,
+    the rest follow sales share with largest-remainder top-up; with fewer boxes than selling zones the best
+    sellers get one each, and SKUs without selling zones send everything to their top zone."""
+    n, z = zs.shape
+    alloc = np.zeros((n, z), dtype=np.int64)
+    active = (boxes > 0) & present.any(axis=1)
+    nz = present & (zs > 0); zc = nz.sum(axis=1)
+    cols = np.arange(z)
+    # no selling zone: everything to the first zone with the highest (non-positive) sales
+    rows = np.flatnonzero(active & (zc == 0))
+    if len(rows):
+        top = np.argmax(np.where(present[rows], zs[rows], -np.inf), axis=1)
+        alloc[rows, top] = boxes[rows]
+    # fewer boxes than selling zones: one each to the best sellers (ties keep zone order)
+    rows = np.flatnonzero(active & (zc > 0) & (boxes < zc))
+    if len(rows):
+        order = np.lexsort((cols[None, :].repeat(len(rows), 0), -zs[rows], ~nz[rows]), axis=1)
+        rank = np.empty_like(order); np.put_along_axis(rank, order, cols[None, :].repeat(len(rows), 0), axis=1)
+        alloc[rows] = (nz[rows] & (rank < boxes[rows, None])).astype(np.int64)
+    # enough boxes: one per selling zone, then floor(share - 1), then +1 by largest fraction
+    rows = np.flatnonzero(active & (zc > 0) & (boxes >= zc))
+    if len(rows):
+        b = boxes[rows]; m = nz[rows]; zr = zs[rows]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            share = np.where(sales[rows, None] > 0, zr / sales[rows, None], 0.0)
+        ideal = np.where(m, share * b[:, None], 0.0)
+        extra = (b > zc[rows])[:, None]
+        add = np.where(extra & (ideal - 1 > 0), np.floor(ideal - 1), 0).astype(np.int64)
+        a = np.where(m, add + 1, 0)
+        remaining = np.where(b > zc[rows], b - a.sum(axis=1), 0)
+        frac = ideal - np.floor(ideal)
+        order = np.lexsort((cols[None, :].repeat(len(rows), 0), -zr, -frac, ~m), axis=1)
+        rank = np.empty_like(order); np.put_along_axis(rank, order, cols[None, :].repeat(len(rows), 0), axis=1)
+        a += (m & (rank < remaining[:, None])).astype(np.int64)
+        alloc[rows] = a
+    return alloc
+
+def _plan_selection(inputs, include_duplicates, ppcn_overrides):
+    """(listing mask, kept rows, their SKUs, their PPCN with overrides) shared by both plan engines."""
+    in_sales = inputs['pass_dupe'] if include_duplicates else inputs['pass_strict']
+    keep = np.flatnonzero(in_sales | inputs['is_booked_sku'])
+    skus = inputs['skus'][keep]
+    ppcn = inputs['ppcn'][keep].copy()
+    if ppcn_overrides:
+        ov = pd.Series(ppcn_overrides, dtype=float).reindex(skus).to_numpy()
+        ok = np.isfinite(ov); ppcn[ok] = ov[ok].astype(np.int64)
+    return in_sales, keep, skus, ppcn
+
+def allocate_plan(inputs, multiplier=1.0, include_duplicates=False, ppcn_overrides=None, excluded_zones=(), excluded_skus=()):
+    """Turns build_plan_inputs aggregates into (final rows, msg, summary, zone summary, combined working).
+    Pure array work, so what-if changes (multiplier, PPCN overrides, zone/SKU exclusions) re-run in milliseconds."""
+    if inputs['mode_type'] == 'multi':
+        return allocate_warehouse_plan(inputs, multiplier, include_duplicates, ppcn_overrides, excluded_zones, excluded_skus)
+    in_sales, keep, skus, ppcn = _plan_selection(inputs, include_duplicates, ppcn_overrides)
+    sales = np.where(in_sales[keep], inputs['sales'][keep], 0.0)
+    stock = inputs['stock'][keep]; booked = inputs['booked'][keep]
+    zones = inputs['zones']
+    zs = inputs['zone_sales'][keep]
+    present = inputs['zone_present'][keep] & in_sales[keep][:, None] & ~np.isin(zones, list(excluded_zones))[None, :]
+
+    req = sales * multiplier - stock - booked
+    with np.errstate(divide='ignore', invalid='ignore'):
+        boxes = np.where(ppcn > 0, np.floor(req / np.where(ppcn > 0, ppcn, 1)), 0).astype(np.int64)
+    if excluded_skus: boxes[np.isin(skus, list(excluded_skus))] = 0
+    alloc = _allocate_zone_boxes(boxes, zs, present, sales)
+
+    order = np.argsort(pd.Series(skus, dtype=object).astype(str).str.upper().to_numpy(), kind='stable')
+    stock_i = stock.astype(np.int64)
+    summary_df = pd.DataFrame({'SKU': skus, 'Sales_30': sales, 'FBF_Qty': stock_i, 'Qty_Booked': booked, 'Needed_Qty': req, 'Boxes': boxes, 'Final_Qty': boxes * ppcn, 'PPCN': ppcn}).iloc[order].reset_index(drop=True)
+    zone_boxes = np.zeros((len(skus), len(ZONES_ORDER)), dtype=np.int64)
+    for j, zone in enumerate(ZONES_ORDER):
+        if zone in zones: zone_boxes[:, j] = np.maximum(alloc[:, zones.index(zone)], 0)
+    zone_summary_df = pd.DataFrame({
+        'SKU': np.repeat(skus[order], len(ZONES_ORDER)), 'Zone': np.tile(ZONES_ORDER, len(skus)),
+        'Sales_30': np.repeat(sales[order], len(ZONES_ORDER)), 'FBF_Qty': np.repeat(stock_i[order], len(ZONES_ORDER)),
+        'Qty_Booked': np.repeat(booked[order], len(ZONES_ORDER)), 'Needed_Qty': np.repeat(req[order], len(ZONES_ORDER)),
+        'Boxes': zone_boxes[order].ravel(), 'Final_Qty': (zone_boxes * ppcn[:, None])[order].ravel(), 'PPCN': np.repeat(ppcn[order], len(ZONES_ORDER))})
+    combined = summary_df.copy()
+    for j, zone in enumerate(ZONES_ORDER): combined[zone] = zone_boxes[order, j]
+
+    zone_rank = np.array([ZONES_ORDER.index(zn) if zn in ZONES_ORDER else 999 for zn in zones] or [0])
+    r, c = np.nonzero(alloc[order] > 0)
+    r_sorted = np.lexsort((zone_rank[c], r)); r, c = r[r_sorted], c[r_sorted]
+    src = order[r]
+    final_rows_df = pd.DataFrame({'SKU Id': skus[src], 'Zone': np.array([zn if zn else "Unknown" for zn in zones] or [''], dtype=object)[c], 'Required Qty': req[src], 'Editable Boxes': alloc[src, c], 'Editable Qty': alloc[src, c] * ppcn[src], 'PPCN': ppcn[src], 'Stock': stock_i[src], 'Qty_Booked': booked[src]})
+    if final_rows_df.empty: return pd.DataFrame(), "Calculated rows are empty.", summary_df, zone_summary_df, combined
     return final_rows_df, "Success", summary_df, zone_summary_df, combined
 
+def allocate_warehouse_plan(inputs, multiplier=1.0, include_duplicates=False, ppcn_overrides=None,
+                            excluded_zones=(), excluded_skus=()):
+    """Multi-warehouse plan in the allocate_plan shape: every SKU x warehouse needs its own demand less that
+    warehouse's stock and booked qty, in whole boxes, all in one array pass (no zone split step). Final rows
+    carry the Warehouse next to its Zone."""
+    if not inputs['warehouses']: return _plan_fail(channel_fcs_missing(inputs['channel']))
+    in_sales, keep, skus, ppcn = _plan_selection(inputs, include_duplicates, ppcn_overrides)
+    listed = in_sales[keep]
+    sales = np.where(listed, inputs['sales'][keep], 0.0)
+    demand = inputs['wh_sales'][keep] * listed[:, None]
+    stock = inputs['wh_stock'][keep]
+    booked = inputs['wh_booked'][keep]
+    req = demand * multiplier - stock - booked
+    per_box = np.where(ppcn > 0, ppcn, 1)[:, None]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        boxes = np.where(ppcn[:, None] > 0, np.floor(req / per_box), 0).clip(min=0).astype(np.int64)
+    boxes[:, np.isin(ZONES_ORDER, list(excluded_zones))] = 0
+    if excluded_skus: boxes[np.isin(skus, list(excluded_skus))] = 0
+
+    order = np.argsort(pd.Series(skus, dtype=object).astype(str).str.upper().to_numpy(), kind='stable')
+    skus, sales, demand, req, boxes, ppcn = (a[order] for a in (skus, sales, demand, req, boxes, ppcn))
+    stock_i = np.rint(stock[order]).astype(np.int64)
+    booked_i = np.rint(booked[order]).astype(np.int64)
+    total_boxes = boxes.sum(axis=1)
+    summary_df = pd.DataFrame({
+        'SKU': skus, 'Sales_30': sales, 'FBF_Qty': stock_i.sum(axis=1), 'Qty_Booked': booked_i.sum(axis=1),
+        'Needed_Qty': req.clip(min=0).sum(axis=1), 'Boxes': total_boxes, 'Final_Qty': total_boxes * ppcn, 'PPCN': ppcn})
+    whs = inputs['warehouses']
+    w = len(whs)
+    zone_summary_df = pd.DataFrame({
+        'SKU': np.repeat(skus, w), 'Zone': np.tile(ZONES_ORDER, len(skus)), 'Warehouse': np.tile(whs, len(skus)),
+        'Sales_30': demand.ravel(), 'FBF_Qty': stock_i.ravel(), 'Qty_Booked': booked_i.ravel(), 'Needed_Qty': req.ravel(),
+        'Boxes': boxes.ravel(), 'Final_Qty': (boxes * ppcn[:, None]).ravel(), 'PPCN': np.repeat(ppcn, w)})
+    combined = summary_df.copy()
+    for j, zone in enumerate(ZONES_ORDER): combined[zone] = boxes[:, j]
+
+    r, c = np.nonzero(boxes)
+    final_rows_df = pd.DataFrame({
+        'SKU Id': skus[r], 'Zone': np.array(ZONES_ORDER, dtype=object)[c], 'Warehouse': np.array(whs, dtype=object)[c],
+        'Required Qty': req[r, c], 'Editable Boxes': boxes[r, c], 'Editable Qty': boxes[r, c] * ppcn[r], 'PPCN': ppcn[r],
+        'Stock': stock_i[r, c], 'Qty_Booked': booked_i[r, c]})
+    if final_rows_df.empty: return pd.DataFrame(), "Calculated rows are empty.", summary_df, zone_summary_df, combined
+    return final_rows_df, "Success", summary_df, zone_summary_df, combined
+
+def plan_zone_diff(before, after):
+    """Boxes per zone before/after a re-plan."""
+    per_zone = lambda df: df.groupby('Zone')['Editable Boxes'].sum() if isinstance(df, pd.DataFrame) and not df.empty else pd.Series(dtype=np.int64)
+    diff = pd.concat([per_zone(before).rename('Before'), per_zone(after).rename('After')], axis=1).fillna(0).astype(np.int64)
+    diff = diff.reindex([z for z in ZONES_ORDER if z in diff.index] + [z for z in diff.index if z not in ZONES_ORDER])
+    diff.loc['Total'] = diff.sum()
+    diff['Change'] = diff['After'] - diff['Before']
+    return diff.rename_axis('Zone').reset_index()
+
+PLAN_STATE_KEYS = ['plan_results', None, 'plan_summary', None, 'plan_combined_zone_working']  # per allocate_plan output
+
+def store_plan_results(plan):
+    """Puts an allocate_plan result on the planning page and resets its editor. The long SKU x zone summary is
+    not kept: the page only reads the combined working, which has the same numbers one row per SKU."""
+    for key, df in zip(PLAN_STATE_KEYS, plan):
+        if key: st.session_state[key] = df if isinstance(df, pd.DataFrame) else pd.DataFrame()
+    st.session_state.pop('plan_editor_df', None)
+    st.session_state['plan_rev'] = st.session_state.get('plan_rev', 0) + 1
+
+def load_plan_job(result):
+    """Puts a finished background plan on the planning page, as if generated here."""
+    saved = pd.read_pickle(result['path']); p = saved['params']
+    store_plan_results(saved['plan'])
+    st.session_state['plan_inputs'] = saved['inputs']
+    st.session_state['plan_whatif_params'] = (p['mult'], p['dupe'], p['mode'], (), (), ())
+    st.session_state.pop('plan_whatif_diff', None)
+    st.session_state['plan_mode_key'] = p['mode']
+    st.session_state['plan_task_id'] = f"TASK_{int(time.time())}"
+    st.session_state['plan_channel'] = p.get('channel', 'Flipkart')
+    st.session_state['page'] = 'plan_flipkart' if st.session_state['plan_channel'] == 'Flipkart' else 'plan_generic'
+
+def calculate_single_warehouse_plan(sales_df, inv_df, settings, include_duplicates, mode_type):
+    # sales_df=None plans from the demand store window in settings['demand_window'] (days or {days: weight})
+    if sales_df is None: inputs, msg = plan_inputs_from_demand(demand_store().demand_window(settings.get('demand_window', PLAN_HORIZON_DAYS)), inv_df, mode_type)
+    else: inputs, msg = build_plan_inputs(sales_df, inv_df, mode_type)
+    if inputs is None: return _plan_fail(msg)
+    return allocate_plan(inputs, settings.get('multiplier', 1.0), include_duplicates, settings.get('ppcn_overrides'), settings.get('excluded_zones', ()), settings.get('excluded_skus', ()))
+
+def plan_channels_combined(uploads, mode_type, multiplier=1.0, include_duplicates=False, shared_stock=None):
+    """One planning run over several channels ({channel: (sales_df, inv_df)}). Each channel nets its own FC stock
+    and booked qty through the shared kernels; with `shared_stock` (SKU -> units in our warehouse) the units booked
+    on any channel are set aside first and the boxes per SKU are capped to what is left, every channel scaled
+    down pro rata in whole boxes (largest remainder). Returns (rows with a Channel column, {channel: plan or error message})."""
+    plans, frames = {}, []
+    for ch, (sales_df, inv_df) in uploads.items():
+        inputs, msg = build_plan_inputs(sales_df, inv_df, mode_type, ch)
+        plans[ch] = allocate_plan(inputs, multiplier, include_duplicates) if inputs is not None else msg
+        if inputs is not None and not plans[ch][0].empty: frames.append(plans[ch][0].assign(Channel=ch))
+    rows = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+    if shared_stock is not None and not rows.empty:
+        booked = pd.Series(compute_booked_map_from_details(compute_booked_details_from_history()[0]), dtype=float)
+        avail = pd.Series(shared_stock, dtype=float).sub(booked, fill_value=0).clip(lower=0)
+        sku = rows['SKU Id'].astype(str)
+        need = rows['Editable Qty'].groupby(sku).transform('sum').to_numpy(dtype=float)
+        have = avail.reindex(sku).fillna(0).to_numpy()
+        factor = np.where(need > 0, np.minimum(1.0, have / np.where(need > 0, need, 1)), 0.0)
+        ideal = rows['Editable Boxes'].to_numpy() * factor; boxes = np.floor(ideal).astype(np.int64)
+        # top up by largest fraction while the whole box still fits in what is left of the SKU's stock
+        ppcn = rows['PPCN'].to_numpy(); codes = pd.factorize(sku)[0]
+        left = have - pd.Series(boxes * ppcn).groupby(codes).transform('sum').to_numpy()
+        frac = ideal - boxes; order = np.lexsort((-ideal, -frac, codes))
+        cum = pd.Series(np.where(frac > 0, ppcn, 0)[order]).groupby(codes[order]).cumsum().to_numpy()
+        boxes[order] += ((frac[order] > 0) & (cum <= left[order])).astype(np.int64)
+        rows = rows.assign(**{'Editable Boxes': boxes, 'Editable Qty': boxes * rows['PPCN'].to_numpy(), 'Shared_Stock': have})[boxes > 0].reset_index(drop=True)
+    return rows, plans
+
+# --- UPLOAD CACHE ---
+UPLOAD_CACHE_DIR = os.path.join(tempfile.gettempdir(), "hike_upload_cache")
+UPLOAD_CACHE_MAX_BYTES = 512 * 1024 * 1024
+UPLOAD_CACHE_FORMAT = 4  # bump when the reduced snapshot layout changes
+
+def _compact_numeric(s):
+    q = pd.to_numeric(s, errors='coerce')
+    if q.notna().all() and (q % 1 == 0).all() and (q.abs() < 2**31).all(): return q.astype(np.int32)
+    return q.astype(np.float64)
+
+def reduce_sales_frame(df, channel='Flipkart'):
+    """Keeps only the columns the planner reads, as categoricals/compact numbers under their canonical names."""
+    df.columns = [str(c).strip() for c in df.columns]
+    cols, _ = plan_sales_columns(df, channel)
+    if cols is None: return df
+    col_sku, col_qty, col_state = cols
+    out = pd.DataFrame({'SKU': df[col_sku].astype('category'), 'Quantity': _compact_numeric(df[col_qty]), 'Delivery State': df[col_state].astype('category')})
+    for canon, col in plan_sales_event_columns(df).items():
+        out[canon] = pd.to_datetime(df[col], errors='coerce').dt.normalize() if canon == 'Order Date' else df[col].astype(str).where(df[col].notna()).astype('category')
+    return out
+
+def reduce_inventory_frame(df, channel='Flipkart'):
+    """SKU and live quantity under the Flipkart names (plus any per-warehouse columns); idempotent."""
+    df.columns = [str(c).strip() for c in df.columns]
+    cols = plan_inventory_columns(df, channel)
+    if cols is None: return df
+    out = pd.DataFrame({'SKU': df[cols[0]].astype('category'), 'Live on Website': _compact_numeric(df[cols[1]])})
+    layout = plan_inventory_warehouse_columns(df, channel_warehouses(channel))
+    if layout and layout[0] == 'long': out[layout[1]] = df[layout[1]].astype('category')
+    elif layout:
+        for c in layout[1].values(): out[c] = _compact_numeric(df[c])
+    return out
+
+def read_report_upload(buf, sheet=None):
+    """Excel (by zip signature) or CSV/TSV report; sheet=None reads the first sheet."""
+    head = buf.read(4096); buf.seek(0)
+    if head[:2] == b'PK':
+        try: return pd.read_excel(buf, sheet_name=sheet or 0, engine='openpyxl')
+        except Exception: buf.seek(0); return pd.read_excel(buf, sheet_name=sheet or 0)
+    first = head.split(b'\n', 1)[0]
+    return pd.read_csv(buf, sep='\t' if first.count(b'\t') > first.count(b',') else ',', dtype=str)
+
+def parse_sales_upload(buf, channel='Flipkart'):
+    return reduce_sales_frame(read_report_upload(buf, PLAN_CHANNELS[channel]['sales']['sheet']), channel)
+
+def parse_inventory_upload(buf, is_csv, channel='Flipkart'):
+    return reduce_inventory_frame(pd.read_csv(buf, dtype=str) if is_csv else pd.read_excel(buf, dtype=str), channel)
+
+def channel_upload_kind(kind, channel):
+    """Upload cache namespace: parses differ per channel."""
+    return kind if channel == 'Flipkart' else f"{kind}-{channel.lower()}"
+
+def _evict_upload_cache():
+    try: entries = [e for e in os.scandir(UPLOAD_CACHE_DIR) if e.name.endswith(('.pkl', '.bin'))]
+    except FileNotFoundError: return
+    entries.sort(key=lambda e: e.stat().st_mtime)
+    total = sum(e.stat().st_size for e in entries)
+    for e in entries:
+        if total <= UPLOAD_CACHE_MAX_BYTES: break
+        try: os.remove(e.path); total -= e.stat().st_size
+        except OSError: pass
+
+def cached_upload_frame(uploaded_file, kind, parse):
+    """Content-addressed cache of parsed uploads: the sha256 of the file bytes names a reduced snapshot on
+    disk, so the same file skips parsing in any session (and after restarts). LRU by access time, capped at
+    UPLOAD_CACHE_MAX_BYTES. Returns (frame, was_cached)."""
+    data = uploaded_file.getvalue()
+    path = os.path.join(UPLOAD_CACHE_DIR, f"{kind}-v{UPLOAD_CACHE_FORMAT}-{hashlib.sha256(data).hexdigest()}.pkl")
+    try:
+        df = pd.read_pickle(path); os.utime(path)
+        return df, True
+    except Exception: pass
+    df = parse(io.BytesIO(data))
+    try:
+        os.makedirs(UPLOAD_CACHE_DIR, exist_ok=True)
+        tmp = f"{path}.{uuid.uuid4().hex}.tmp"
+        df.to_pickle(tmp); os.replace(tmp, path)
+        _evict_upload_cache()
+    except OSError: pass
+    return df, False
+
+# --- DEMAND STORE ---
+DEMAND_DB_FILE = os.path.join(STATE_DIR, "demand_store.sqlite3")
+DEMAND_RETENTION_DAYS = 180
+PLAN_HORIZON_DAYS = 30  # plans cover 30 days of demand (the original "Last 30 Days Sales" input)
+DEMAND_WINDOWS = {'Last 7 days': 7, 'Last 30 days': 30, 'Last 60 days': 60, 'Last 90 days': 90,
+                  'Weighted 7/30/60 (50/30/20%)': {7: 0.5, 30: 0.3, 60: 0.2}}
+_EPOCH = pd.Timestamp('1970-01-01')
+
+def demand_rows(sales_df):
+    """Listing rows of a sales export as (item_key, sku, zone, day, qty) for DemandStore.ingest. The key is the
+    order item ID plus event type/sub type when present, since returns reuse the item ID. Raises ValueError if
+    the export has no item IDs or dates. Returns (rows, number of rows skipped for a missing ID/date)."""
+    sales_df.columns = [str(c).strip() for c in sales_df.columns]
+    cols, msg = plan_sales_columns(sales_df)
+    if cols is None: raise ValueError(msg)
+    ev = plan_sales_event_columns(sales_df)
+    if 'Order Item ID' not in ev or 'Order Date' not in ev:
+        raise ValueError("Sales export needs 'Order Item ID' and 'Order Date' columns for the demand store")
+    col_sku, col_qty, col_state = cols
+    sku = clean_sku_series(sales_df[col_sku])
+    listed = listing_pattern_mask(sku, PLAN_SKU_PATTERNS[False]) | listing_pattern_mask(sku, PLAN_SKU_PATTERNS[True])
+    df = sales_df[listed]
+    day = (pd.to_datetime(df[ev['Order Date']], errors='coerce').dt.normalize() - _EPOCH).dt.days
+    key = df[ev['Order Item ID']].astype(str).where(df[ev['Order Item ID']].notna())
+    for extra in ('Event Type', 'Event Sub Type'):
+        if extra in ev: key = key + '|' + df[ev[extra]].astype(str).fillna('')
+    ok = key.notna() & day.notna()
+    rows = pd.DataFrame({
+        'item_key': key[ok].astype(str),
+        'sku': sku[listed][ok].astype(str),
+        'zone': state_zone_columns(df[col_state])[0][ok].astype(object).fillna(''),
+        'day': day[ok].astype(np.int64),
+        'qty': pd.to_numeric(df[col_qty][ok], errors='coerce').fillna(0).astype(float),
+    })
+    return rows.drop_duplicates('item_key', keep='last'), int((~ok).sum())
+
+class DemandStore:
+    """SQLite-backed daily listing demand per (SKU, zone, day), fed incrementally from overlapping sales exports.
+    Order items are deduplicated on their key, so re-uploading a period never double counts. Windows are read
+    from an in-memory prefix-sum cube (rebuilt after ingest), so a 7- or 90-day window costs the same."""
+    def __init__(self, db_path=DEMAND_DB_FILE, retention_days=DEMAND_RETENTION_DAYS):
+        self.db_path = db_path
+        self.retention_days = retention_days
+        self.lock = threading.Lock()
+        self._cube = None
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        con = self._conn()
+        try:
+            con.execute("CREATE TABLE IF NOT EXISTS demand_items (item_key TEXT PRIMARY KEY, sku TEXT NOT NULL, "
+                        "zone TEXT NOT NULL, day INTEGER NOT NULL, qty REAL NOT NULL)")
+            con.execute("CREATE TABLE IF NOT EXISTS demand_daily (sku TEXT NOT NULL, zone TEXT NOT NULL, day INTEGER NOT NULL, "
+                        "qty REAL NOT NULL, n INTEGER NOT NULL, PRIMARY KEY (sku, zone, day))")
+        finally: con.close()
+
+    def _conn(self):
+        return sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+
+    def ingest(self, sales_df):
+        """Adds the order items of a (reduced) sales export not seen before; returns counts of new / duplicate /
+        skipped rows."""
+        rows, skipped = demand_rows(sales_df)
+        con = self._conn()
+        try:
+            con.execute("BEGIN IMMEDIATE")
+            con.execute("CREATE TEMP TABLE IF NOT EXISTS demand_incoming "
+                        "(item_key TEXT PRIMARY KEY, sku TEXT, zone TEXT, day INTEGER, qty REAL)")
+            con.execute("DELETE FROM demand_incoming")
+            con.executemany("INSERT INTO demand_incoming VALUES (?, ?, ?, ?, ?)", rows.itertuples(index=False, name=None))
+            con.execute("DELETE FROM demand_incoming WHERE item_key IN (SELECT item_key FROM demand_items)")
+            new = con.execute("SELECT COUNT(*) FROM demand_incoming").fetchone()[0]
+            con.execute("INSERT INTO demand_items SELECT * FROM demand_incoming")
+            con.execute("INSERT INTO demand_daily SELECT sku, zone, day, SUM(qty), COUNT(*) FROM demand_incoming "
+                        "WHERE 1 GROUP BY sku, zone, day "
+                        "ON CONFLICT (sku, zone, day) DO UPDATE SET qty = qty + excluded.qty, n = n + excluded.n")
+            last = con.execute("SELECT MAX(day) FROM demand_daily").fetchone()[0]
+            if last is not None:
+                for table in ('demand_items', 'demand_daily'):
+                    con.execute(f"DELETE FROM {table} WHERE day <= ?", (last - self.retention_days,))
+            con.execute("COMMIT")
+        except Exception:
+            if con.in_transaction: con.execute("ROLLBACK")
+            raise
+        finally: con.close()
+        if new:
+            with self.lock: self._cube = None
+        return {'rows': len(rows), 'new': int(new), 'duplicate': len(rows) - int(new), 'skipped': skipped}
+
+    def coverage(self):
+        """(first day, last day, order items) held, or None when empty."""
+        con = self._conn()
+        try: first, last, n = con.execute("SELECT MIN(day), MAX(day), COUNT(*) FROM demand_items").fetchone()
+        finally: con.close()
+        return (_EPOCH + pd.Timedelta(days=first), _EPOCH + pd.Timedelta(days=last), n) if n else None
+
+    def _load_cube(self):
+        with self.lock:
+            if self._cube is None:
+                con = self._conn()
+                try: df = pd.read_sql_query("SELECT sku, zone, day, qty, n FROM demand_daily", con)
+                finally: con.close()
+                if df.empty: self._cube = {}
+                else:
+                    codes, keys = pd.factorize(pd.MultiIndex.from_frame(df[['sku', 'zone']]))
+                    first, last = int(df['day'].min()), int(df['day'].max())
+                    # Column d of the cumulative arrays = sum over the first d days, so column 0 is all zeros
+                    qty = np.zeros((len(keys), last - first + 2))
+                    cnt = np.zeros((len(keys), last - first + 2), dtype=np.int32)
+                    col = df['day'].to_numpy() - first + 1
+                    qty[codes, col] = df['qty'].to_numpy()
+                    cnt[codes, col] = df['n'].to_numpy()
+                    self._cube = {'sku': keys.get_level_values(0).to_numpy(dtype=object),
+                                  'zone': keys.get_level_values(1).to_numpy(dtype=object),
+                                  'first': first, 'last': last,
+                                  'qty': np.cumsum(qty, axis=1), 'n': np.cumsum(cnt, axis=1)}
+            return self._cube
+
+    def _window(self, cube, days, end):
+        hi = max(0, min(end, cube['last']) - cube['first'] + 1)
+        lo = max(0, hi - int(days))
+        return cube['qty'][:, hi] - cube['qty'][:, lo], cube['n'][:, hi] - cube['n'][:, lo]
+
+    def demand_window(self, window=PLAN_HORIZON_DAYS, end=None, horizon=PLAN_HORIZON_DAYS):
+        """Demand per (Clean_SKU, Zone) for plan_inputs_from_demand, scaled to `horizon` days. `window` is a day
+        count or {days: weight} for a blend of daily rates; `end` is a date (default: the latest day held)."""
+        cube = self._load_cube()
+        if not cube:
+            return pd.DataFrame({'Clean_SKU': pd.Series(dtype=object), 'Zone': pd.Series(dtype=object),
+                                 'Quantity': pd.Series(dtype=float), 'Rows': pd.Series(dtype=np.int64)})
+        end_day = cube['last'] if end is None else (pd.Timestamp(end).normalize() - _EPOCH).days
+        blend = window if isinstance(window, dict) else {int(window): 1.0}
+        total_w = sum(blend.values())
+        qty = rows = 0
+        for days, w in blend.items():
+            q, n = self._window(cube, days, end_day)
+            qty = qty + q * (w / total_w) * horizon / days
+            rows = np.maximum(rows, n)
+        keep = rows > 0
+        zone = pd.Series(cube['zone'][keep], dtype=object).replace('', np.nan).to_numpy()
+        return pd.DataFrame({'Clean_SKU': cube['sku'][keep], 'Zone': zone, 'Quantity': qty[keep], 'Rows': rows[keep]})
+
+@st.cache_resource(show_spinner=False)
+def demand_store():
+    return DemandStore()
+
+# --- BACKGROUND JOBS ---
+JOBS_DB_FILE = os.path.join(STATE_DIR, "jobs.sqlite3")
+JOB_WORKERS = 2
+JOB_RETENTION_DAYS = 7
+JOB_PURGE_SECONDS = 3600  # how often idle workers drop expired jobs and their result files
+JOB_CANCEL_POLL_SECONDS = 1.0  # handlers may poll cancelled() per item; the job table is read at most this often
+JOB_PRIORITY = {'merge_labels': 20, 'plan_generate': 20, 'sync_master': 10, 'prefetch': 0}
+JOB_LABELS = {'merge_labels': "Merge labels", 'plan_generate': "Generate plan", 'sync_master': "Sync master data",
+              'prefetch': "Prefetch documents"}
+PREFETCH_DAYS_AHEAD = 1
+
+class JobCancelled(Exception): pass
+
+class JobContext:
+    """Handed to a job handler: progress reporting (same interface as st.progress, so ThrottledProgress works)
+    and cancellation polling. A cancel from this process sets `cancel_event` at once; one from another process is
+    seen through the job table, read at most every JOB_CANCEL_POLL_SECONDS, so polling per box stays cheap."""
+    def __init__(self, scheduler, job_id, cancel_event=None):
+        self.scheduler = scheduler
+        self.job_id = job_id
+        self.cancel_event = cancel_event or threading.Event()
+        self.polled_at = 0.0
+
+    def progress(self, value, text=""):
+        self.scheduler._update(self.job_id, progress=float(value), message=str(text))
+
+    def cancelled(self):
+        if self.cancel_event.is_set(): return True
+        if time.monotonic() - self.polled_at >= JOB_CANCEL_POLL_SECONDS:
+            self.polled_at = time.monotonic()
+            if self.scheduler.status(self.job_id) == 'cancelling': self.cancel_event.set()
+        return self.cancel_event.is_set()
+
+class JobScheduler:
+    """Local worker pool over a persistent SQLite job table. Jobs run outside any script thread, so they keep going
+    when the submitting page reruns or the browser refreshes; any session can poll them. Identical active jobs
+    (same kind and params) are deduplicated, higher priority runs first, and jobs interrupted by a restart are
+    re-queued. Workers have no ScriptRunContext (a job outlives the session that submitted it): handlers only
+    use the process-wide caches, never page elements, and storage errors reach the job via StorageHandler.report."""
+    def __init__(self, db_path=JOBS_DB_FILE, workers=JOB_WORKERS):
+        self.db_path = db_path
+        self.wake = threading.Event()
+        self.running = {}  # job id -> cancel event of the jobs this process is running
+        self.purged_at = 0.0
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        con = self._conn()
+        try:
+            con.execute("CREATE TABLE IF NOT EXISTS jobs (id TEXT PRIMARY KEY, kind TEXT NOT NULL, dedup_key TEXT NOT NULL, "
+                        "params TEXT NOT NULL, priority INTEGER NOT NULL, status TEXT NOT NULL, progress REAL DEFAULT 0, "
+                        "message TEXT DEFAULT '', result TEXT, error TEXT, station TEXT, "
+                        "created_at REAL, started_at REAL, finished_at REAL)")
+            con.execute("CREATE UNIQUE INDEX IF NOT EXISTS jobs_active ON jobs (dedup_key) "
+                        "WHERE status IN ('queued', 'running', 'cancelling')")
+            con.execute("UPDATE jobs SET status = 'queued', progress = 0, message = 'Re-queued after restart' "
+                        "WHERE status = 'running'")
+            con.execute("UPDATE jobs SET status = 'cancelled', finished_at = ? WHERE status = 'cancelling'", (time.time(),))
+        finally: con.close()
+        self.purge()
+        self.threads = [threading.Thread(target=self._worker, name=f"job-worker-{i}", daemon=True) for i in range(workers)]
+        for t in self.threads: t.start()
+
+    def _conn(self):
+        return sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+
+    def submit(self, kind, params, priority=None, station=None):
+        """Queues a job, or returns the id of the identical job already queued/running (raising its priority)."""
+        priority = JOB_PRIORITY.get(kind, 0) if priority is None else priority
+        key = f"{kind}:{_canon(params)}"; con = self._conn()
+        try:
+            con.execute("BEGIN IMMEDIATE")
+            row = con.execute("SELECT id, priority FROM jobs WHERE dedup_key = ? AND status IN ('queued', 'running', 'cancelling')", (key,)).fetchone()
+            if row:
+                if priority > row[1]: con.execute("UPDATE jobs SET priority = ? WHERE id = ?", (priority, row[0]))
+                job_id = row[0]
+            else:
+                job_id = uuid.uuid4().hex[:12]
+                con.execute("INSERT INTO jobs (id, kind, dedup_key, params, priority, status, station, created_at) VALUES (?, ?, ?, ?, ?, 'queued', ?, ?)",
+                            (job_id, kind, key, json.dumps(params, default=str), priority, station, time.time()))
+            con.execute("COMMIT")
+        except Exception:
+            if con.in_transaction: con.execute("ROLLBACK")
+            raise
+        finally: con.close()
+        self.wake.set()
+        return job_id
+
+    def cancel(self, job_id):
+        con = self._conn()
+        try:
+            con.execute("UPDATE jobs SET status = 'cancelled', finished_at = ? WHERE id = ? AND status = 'queued'",
+                        (time.time(), job_id))
+            con.execute("UPDATE jobs SET status = 'cancelling' WHERE id = ? AND status = 'running'", (job_id,))
+        finally: con.close()
+        event = self.running.get(job_id)
+        if event is not None: event.set()
+
+    def purge(self, max_age_days=JOB_RETENTION_DAYS):
+        """Deletes finished jobs older than `max_age_days` together with the result files they point at (plan
+        pickles); returns the number of jobs removed."""
+        self.purged_at = time.time()
+        con = self._conn()
+        try:
+            con.execute("BEGIN IMMEDIATE")
+            cutoff = time.time() - max_age_days * 86400
+            rows = con.execute("SELECT id, result FROM jobs WHERE finished_at < ?", (cutoff,)).fetchall()
+            con.execute("DELETE FROM jobs WHERE finished_at < ?", (cutoff,))
+            con.execute("COMMIT")
+        except Exception:
+            if con.in_transaction: con.execute("ROLLBACK")
+            raise
+        finally: con.close()
+        for _, result in rows:
+            path = _job_result_file(result)
+            if path is None: continue
+            try: os.remove(path)
+            except OSError: pass
+        return len(rows)
+
+    def status(self, job_id):
+        con = self._conn()
+        try: row = con.execute("SELECT status FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        finally: con.close()
+        return row[0] if row else None
+
+    def jobs(self, kinds=None, station=None, limit=20):
+        """Recent jobs as a DataFrame, active ones first."""
+        sql = ("SELECT id, kind, params, priority, status, progress, message, result, error, station, created_at, "
+               "finished_at FROM jobs")
+        where, args = [], []
+        if kinds:
+            where.append(f"kind IN ({','.join('?' * len(kinds))})")
+            args += list(kinds)
+        if station:
+            where.append("station = ?")
+            args.append(station)
+        if where: sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY status NOT IN ('queued', 'running', 'cancelling'), created_at DESC LIMIT ?"
+        con = self._conn()
+        try: return pd.read_sql_query(sql, con, params=args + [limit])
+        finally: con.close()
+
+    def _update(self, job_id, **fields):
+        con = self._conn()
+        try: con.execute(f"UPDATE jobs SET {', '.join(f'{k} = ?' for k in fields)} WHERE id = ?", (*fields.values(), job_id))
+        finally: con.close()
+
+    def _claim(self):
+        con = self._conn()
+        try:
+            con.execute("BEGIN IMMEDIATE")
+            row = con.execute("SELECT id, kind, params FROM jobs WHERE status = 'queued' "
+                              "ORDER BY priority DESC, created_at LIMIT 1").fetchone()
+            if row:
+                con.execute("UPDATE jobs SET status = 'running', started_at = ?, message = 'Started' WHERE id = ?",
+                            (time.time(), row[0]))
+            con.execute("COMMIT")
+            return row
+        except Exception:
+            if con.in_transaction: con.execute("ROLLBACK")
+            return None
+        finally: con.close()
+
+    def _worker(self):
+        while True:
+            job = self._claim()
+            if job is None:
+                if time.time() - self.purged_at > JOB_PURGE_SECONDS:
+                    try: self.purge()
+                    except sqlite3.Error: pass
+                self.wake.wait(2)
+                self.wake.clear()
+                continue
+            job_id, kind, params = job
+            ctx = JobContext(self, job_id)
+            self.running[job_id] = ctx.cancel_event
+            StorageHandler._worker.last_error = None
+            try:
+                result = JOB_HANDLERS[kind](json.loads(params), ctx)
+                self._update(job_id, status='done', progress=100.0, message='Done',
+                             result=json.dumps(result, default=str), finished_at=time.time())
+            except (JobCancelled, MergeCancelled):
+                self._update(job_id, status='cancelled', message='Cancelled', finished_at=time.time())
+            except Exception as e:
+                error = f"{type(e).__name__}: {e}"
+                if StorageHandler._worker.last_error: error += f" ({StorageHandler._worker.last_error})"
+                self._update(job_id, status='failed', message='Failed', error=error, finished_at=time.time())
+            finally: self.running.pop(job_id, None)
+
+def _job_result_file(result):
+    """The file a finished job's result points at, if it is one of ours in the upload cache."""
+    try: path = json.loads(result).get('path') if result else None
+    except (ValueError, AttributeError): return None
+    if not path or os.path.dirname(os.path.abspath(path)) != os.path.abspath(UPLOAD_CACHE_DIR): return None
+    return path
+
+@st.cache_resource(show_spinner=False)
+def job_scheduler():
+    return JobScheduler()
+
+def stored_consignment(c_id):
+    """Latest shared record of a consignment (jobs run outside any session)."""
+    store = consignment_store(); store.refresh_if_stale()
+    return next((h for h in store.snapshot()[3] if h.get('id') == c_id), None)
+
+def stage_job_input(uploaded_file):
+    """Copies an upload next to the upload cache (content-addressed) so a job can read it after the page reruns."""
+    data = uploaded_file.getvalue()
+    path = os.path.join(UPLOAD_CACHE_DIR, f"input-{hashlib.sha256(data).hexdigest()}.bin")
+    if not os.path.exists(path):
+        os.makedirs(UPLOAD_CACHE_DIR, exist_ok=True)
+        tmp = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp, 'wb') as f: f.write(data)
+        os.replace(tmp, path)
+    return {'path': path, 'name': uploaded_file.name}
+
+def _staged_file(staged):
+    with open(staged['path'], 'rb') as f: buf = io.BytesIO(f.read())
+    buf.name = staged['name']
+    return buf
+
+def job_merge_labels(params, job):
+    """Merges the stored source labels of a consignment and stores the merged PDF."""
+    c_id = params['c_id']; pkg = stored_consignment(c_id)
+    if pkg is None: raise ValueError(f"Consignment {c_id} not found")
+    raw = open_stored_file(c_id, 'box_labels')
+    if raw is None: raise ValueError(f"No source labels stored for {c_id}")
+    with raw, generate_merged_box_labels(pkg['data'], pkg, pkg.get('sender', {}), pkg.get('receiver', {}), raw, job, job.cancelled) as merged:
+        job.progress(100, "Saving merged labels...")
+        size = merged.seek(0, io.SEEK_END)
+        merged.seek(0)
+        if not StorageHandler.upload_large_file(f"{c_id}_merged_labels.pdf", merged, "Merged Labels"): raise RuntimeError("Could not save merged labels")
+    return {'c_id': c_id, 'file': f"{c_id}_merged_labels.pdf", 'bytes': size}
+
+def job_plan_generate(params, job):
+    """The Generate Plan handler off the script thread; the plan is pickled next to the upload cache for loading."""
+    job.progress(5, "Reading inventory file...")
+    is_csv = params['inventory']['name'].endswith('.csv'); channel = params.get('channel', 'Flipkart')
+    inv_df, _ = cached_upload_frame(_staged_file(params['inventory']), channel_upload_kind('inventory-csv' if is_csv else 'inventory-xlsx', channel), lambda buf: parse_inventory_upload(buf, is_csv, channel))
+    if job.cancelled(): raise JobCancelled()
+    if params.get('sales'):
+        job.progress(30, "Reading sales file...")
+        sales_df, hit = cached_upload_frame(_staged_file(params['sales']), channel_upload_kind('sales', channel), lambda buf: parse_sales_upload(buf, channel))
+        if not hit and channel == 'Flipkart':
+            try: demand_store().ingest(sales_df.copy())
+            except ValueError: pass
+        job.progress(60, "Calculating plan...")
+        inputs, msg = build_plan_inputs(sales_df, inv_df, params['mode'], channel)
+    else:
+        job.progress(60, "Calculating plan...")
+        inputs, msg = plan_inputs_from_demand(demand_store().demand_window(DEMAND_WINDOWS[params['window']]), inv_df, params['mode'])
+    if inputs is None: raise ValueError(msg)
+    plan = allocate_plan(inputs, params['mult'], params['dupe'])
+    path = os.path.join(UPLOAD_CACHE_DIR, f"plan-{job.job_id}.pkl")
+    pd.to_pickle({'plan': plan, 'inputs': inputs, 'params': params}, path)
+    return {'path': path, 'rows': len(plan[0]), 'message': plan[1]}
+
+def job_sync_master(params, job):
+    ok, msg = sync_data()
+    if not ok: raise RuntimeError(msg)
+    return {'message': msg}
+
+def job_prefetch(params, job):
+    """Warms a consignment's documents in the artifact cache and merges its labels if only the source is stored."""
+    c_id = params['c_id']; pkg = stored_consignment(c_id)
+    if pkg is None: raise ValueError(f"Consignment {c_id} not found")
+    merged = False
+    if not StorageHandler.file_exists(f"{c_id}_merged_labels.pdf") and StorageHandler.file_exists(f"{c_id}_box_labels.pdf"):
+        job.progress(10, "Merging labels..."); job_merge_labels(params, job); merged = True
+    job.progress(80, "Building documents...")
+    spool, manifest = build_consignment_bundle(pkg, workers=2)
+    spool.close()  # only the artifact cache is being warmed
+    return {'c_id': c_id, 'merged_labels': merged, 'files': len(manifest['files'])}
+
+JOB_HANDLERS = {'merge_labels': job_merge_labels, 'plan_generate': job_plan_generate, 'sync_master': job_sync_master, 'prefetch': job_prefetch}
+
+def schedule_prefetch(tasks, days_ahead=PREFETCH_DAYS_AHEAD):
+    """Low-priority prefetch jobs for booked execution consignments picked up between today and `days_ahead`."""
+    today = pd.Timestamp.now().normalize(); ids = []
+    for t in tasks:
+        if t.get('task_type') != 'execution' or not t.get('is_booked', True): continue
+        d = pd.to_datetime(t.get('date'), errors='coerce')
+        if pd.notna(d) and today <= d <= today + pd.Timedelta(days=days_ahead): ids.append(job_scheduler().submit('prefetch', {'c_id': t['id']}, station=station_id()))
+    return ids
+
+@st.fragment(run_every=3)
+def render_jobs_panel(kinds=None, c_id=None, on_load=None):
+    """Live status of background jobs (optionally for one consignment); `on_load(result)` adds a load button to
+    finished jobs."""
+    jobs = job_scheduler().jobs(kinds)
+    if c_id is not None: jobs = jobs[jobs['params'].map(lambda p: json.loads(p).get('c_id') == c_id)]
+    if jobs.empty: st.caption("No background jobs."); return
+    for j in jobs.head(6).itertuples():
+        label = f"{JOB_LABELS.get(j.kind, j.kind)}" + (f" · {json.loads(j.params).get('c_id')}" if 'c_id' in j.params else "")
+        c1, c2 = st.columns([4, 1])
+        if j.status in ('queued', 'running', 'cancelling'):
+            c1.progress(min(100, int(j.progress or 0)), text=f"{label} · {j.status} · {j.message or ''}")
+            if j.status != 'cancelling' and c2.button("✖", key=f"job_cancel_{j.id}", help="Cancel job"): job_scheduler().cancel(j.id); st.rerun(scope="fragment")
+        elif j.status == 'done':
+            c1.caption(f"✅ {label} · done {pd.Timestamp(j.finished_at, unit='s', tz='UTC').tz_convert(None):%H:%M}")
+            if on_load and c2.button("📥 Load", key=f"job_load_{j.id}"):
+                try: on_load(json.loads(j.result)); st.rerun()
+                except (OSError, KeyError, ValueError) as e: st.error(f"Result no longer available: {e}")
+        else: c1.caption(f"{'⚠️' if j.status == 'failed' else '🚫'} {label} · {j.status}" + (f": {j.error}" if j.error else ""))
+
+# --- HISTORY INDEX ---
+HISTORY_PAGE_SIZE = 10
+HISTORY_SORTS = {'Newest first': (['Date', 'ID'], [False, False]), 'Oldest first': (['Date', 'ID'], [True, True]), 'Task ID': (['ID'], [True]), 'Most boxes': (['Boxes', 'Date'], [False, False])}
+
+def _frame_stats(df):
+    if not isinstance(df, pd.DataFrame) or df.empty: return 0, 0, 0
+    num = lambda c: int(pd.to_numeric(df[c], errors='coerce').fillna(0).sum()) if c in df.columns else 0
+    sku_col = next((c for c in ['SKU', 'SKU Id'] if c in df.columns), None)
+    return num('Editable Boxes'), num('Editable Qty'), int(df[sku_col].nunique()) if sku_col else len(df)
+
+HISTORY_INDEX_COLUMNS = ['ID', 'Type', 'Channel', 'Date', 'Booked', 'Boxes', 'Qty', 'SKUs']
+
+def history_row(h):
+    """One task's history index row (see HISTORY_INDEX_COLUMNS)."""
+    head = (str(h.get('id', '')), h.get('task_type', 'execution'), h.get('channel') or '-', h.get('date'), bool(h.get('is_booked', True)))
+    return head + _frame_stats(h.get('data'))
+
+def history_index_frame(rows):
+    idx = pd.DataFrame(list(rows), columns=HISTORY_INDEX_COLUMNS)
+    idx['Date'] = pd.to_datetime(idx['Date'], errors='coerce')
+    return idx
+
+def session_history_index():
+    """The store's shared index with rows of this session's unsaved records patched in. Returns (cache key, frame);
+    the patched frame is rebuilt only when the store version or the session's edits change."""
+    version, idx = consignment_store().index()
+    patch = st.session_state.get('history_index_patch') or {}
+    key = (version, st.session_state.get('history_patch_rev', 0) if patch else 0)
+    if not patch: return key, idx
+    cached = st.session_state.get('history_index_cache')
+    if cached is None or cached[0] != key:
+        mine = history_index_frame(row for row, _ in patch.values())
+        merged = pd.concat([idx[~idx['ID'].isin(mine['ID'])], mine], ignore_index=True)
+        cached = st.session_state['history_index_cache'] = (key, merged)
+    return cached
+
+def session_record(cid):
+    """A task by id: this session's unsaved copy if it has one, otherwise the shared record."""
+    hit = (st.session_state.get('history_index_patch') or {}).get(cid)
+    return hit[1] if hit is not None else consignment_store().record(cid)
+
+def filter_history_index(idx, query='', channels=None, date_range=None, booked='All', sort='Newest first'):
+    mask = np.ones(len(idx), dtype=bool)
+    if query: mask &= idx['ID'].str.contains(query.strip(), case=False, regex=False).to_numpy()
+    if channels: mask &= idx['Channel'].isin(channels).to_numpy()
+    if date_range: mask &= idx['Date'].between(date_range[0], date_range[1]).to_numpy()
+    if booked != 'All': mask &= (idx['Booked'] == (booked == 'Booked')).to_numpy()
+    by, asc = HISTORY_SORTS[sort]
+    return idx[mask].sort_values(by=by, ascending=asc, na_position='last', kind='stable')
+
+# --- KPI ROLLUPS ---
+KPI_COLUMNS = ['Tasks', 'Booked', 'Unbooked', 'Boxes', 'Qty', 'SKU Lines']
+
+class KpiRollup:
+    """Daily x channel x task-type aggregates of the history, fed from history index rows (see history_row).
+    put()/drop() apply one task's difference, so keeping it current costs O(changed tasks) and reads O(days)."""
+    def __init__(self):
+        self.cells = {}    # (date, channel, task_type) -> np.array(KPI_COLUMNS)
+        self.parts = {}    # task id -> (index row, cell key, contribution)
+        self._frame = None
+
+    def _add(self, key, vec, sign):
+        cell = self.cells.get(key)
+        if cell is None: cell = self.cells[key] = np.zeros(len(KPI_COLUMNS), dtype=np.int64)
+        cell += sign * vec
+        if not cell[0]: del self.cells[key]
+        self._frame = None
+
+    def put(self, row):
+        cid, task_type, channel, date, booked, boxes, qty, skus = row
+        old = self.parts.get(cid)
+        if old is not None and old[0] == row: return
+        if old is not None: self._add(old[1], old[2], -1)
+        d = pd.to_datetime(date, errors='coerce')
+        key = (None if pd.isna(d) else d.normalize(), channel, task_type)
+        vec = np.array([1, int(booked), int(not booked), boxes, qty, skus], dtype=np.int64)
+        self._add(key, vec, 1)
+        self.parts[cid] = (row, key, vec)
+
+    def drop(self, cid):
+        old = self.parts.pop(cid, None)
+        if old is not None: self._add(old[1], old[2], -1)
+
+    def patched(self, rows):
+        """A copy with some tasks' rows replaced; cells are copied, contributions are shared."""
+        out = KpiRollup()
+        out.cells = {k: v.copy() for k, v in self.cells.items()}
+        out.parts = dict(self.parts)
+        for row in rows: out.put(row)
+        return out
+
+    def frame(self):
+        """One row per (Date, Channel, Type) with KPI_COLUMNS; rebuilt only after a change."""
+        if self._frame is None:
+            keys = list(self.cells)
+            df = pd.DataFrame(keys, columns=['Date', 'Channel', 'Type'])
+            vals = np.array([self.cells[k] for k in keys], dtype=np.int64).reshape(len(keys), len(KPI_COLUMNS))
+            for i, c in enumerate(KPI_COLUMNS): df[c] = vals[:, i]
+            df['Date'] = pd.to_datetime(df['Date'])
+            df = df.sort_values(['Date', 'Channel', 'Type'], na_position='first', kind='stable')
+            self._frame = df.reset_index(drop=True)
+        return self._frame
+
+def kpi_frame():
+    """The store's KPI frame, with this session's unsaved records applied (cached until store or edits change)."""
+    patch = st.session_state.get('history_index_patch') or {}
+    if not patch: return consignment_store().kpi_frame()[1]
+    rev = st.session_state.get('history_patch_rev', 0)
+    cached = st.session_state.get('kpi_cache')
+    version = consignment_store().version
+    if cached is None or cached[0] != (version, rev):
+        version, frame = consignment_store().kpi_frame(row for row, _ in patch.values())
+        cached = st.session_state['kpi_cache'] = ((version, rev), frame)
+    return cached[1]
+
 # --- APP NAVIGATION & STARTUP ---
 if 'page' not in st.session_state: st.session_state['page'] = 'home'
-if 'consignments' not in st.session_state: st.session_state['consignments'] = load_history()
+if 'consignments' not in st.session_state: init_history_session()
+else: sync_history_session()
 
 addr_cols = ['Code', 'Address1', 'Address2', 'City', 'State', 'Pincode', 'GST', 'Channel']
 
@@ -680,6 +2966,7 @@ with st.sidebar:
     st.title("🚀 Hike Manager")
     if st.button("🏠 Home", use_container_width=True): nav('home')
     if st.button("🕘 History", use_container_width=True): nav('history')
+    watch_history_version()
 
     st.divider()
     st.header("Plan Consignment")
@@ -702,53 +2989,113 @@ with st.sidebar:
     st.divider()
     st.header("Settings")
     if st.button("🔄 Sync Master Data"):
-        s, m = sync_data()
-        if s: st.success(m)
-        else: st.error(m)
+        job_scheduler().submit('sync_master', {}, station=station_id()); st.toast("Master data sync queued")
+    with st.expander("⏳ Background Jobs"):
+        if st.button("Prefetch Upcoming Pickups", use_container_width=True, help=f"Pre-builds documents and merged labels for booked consignments due within {PREFETCH_DAYS_AHEAD} day(s)"):
+            ids = schedule_prefetch(consignment_store().snapshot()[3]); st.toast(f"{len(ids)} prefetch job(s) queued" if ids else "No booked pickups due")
+        render_jobs_panel()
     
     if StorageHandler.get_repo() is None:
         st.error("⚠️ GitHub Secrets Missing")
 
 # --- UI FRAGMENTS (Optimized Rendering) ---
 
-@st.fragment
-def render_history_list(tasks):
-    """Renders the history list without reloading the full page"""
-    if not tasks:
-        st.info("No execution tasks yet.")
-        return
+def open_planning_task(t):
+    st.session_state['plan_task_id'] = t['id']
+    # The editor works on plain columns; categoricals would turn into fixed-choice dropdowns
+    plain = t.get('data', pd.DataFrame())
+    st.session_state['plan_results'] = plain.astype({c: str for c in plain.columns if isinstance(plain[c].dtype, pd.CategoricalDtype)})
+    st.session_state['plan_summary'] = t.get('original_data', pd.DataFrame()).copy() if isinstance(t.get('original_data', None), pd.DataFrame) else pd.DataFrame()
+    ed = st.session_state['plan_results'].copy() if isinstance(st.session_state['plan_results'], pd.DataFrame) else pd.DataFrame()
+    if 'Select' not in ed.columns: ed.insert(0, 'Select', True)
+    if 'Qty_Booked' not in ed.columns: ed['Qty_Booked'] = 0
+    for c in ['Editable Boxes','Editable Qty','PPCN','Stock','Required Qty','Qty_Booked']:
+        if c in ed.columns: ed[c] = pd.to_numeric(ed[c], errors='coerce').fillna(0).astype(int)
+    if 'SKU Id' in ed.columns: ed = ed.sort_values(by='SKU Id', key=lambda s: s.str.upper()).reset_index(drop=True)
+    st.session_state['plan_editor_df'] = ed.reset_index(drop=True)
+    st.session_state['plan_rev'] = st.session_state.get('plan_rev', 0) + 1
+    for k in ['plan_inputs', 'plan_whatif_params', 'plan_whatif_diff']: st.session_state.pop(k, None)
+    st.session_state['plan_mode_key'] = t.get('mode_key', 'single')
+    st.session_state['plan_channel'] = t.get('channel', 'Flipkart')
+    nav('plan_flipkart' if st.session_state['plan_channel'] == 'Flipkart' else 'plan_generic')
+
+def _render_planning_card(t):
+    st.subheader(f"Task: {t['id']} | Date: {t.get('date','-')} | Channel: {t.get('channel','-')}")
+    if isinstance(t.get('data', None), pd.DataFrame):
+        df_preview = t['data'].head(6).copy()
+        if 'Qty_Booked' not in df_preview.columns: df_preview['Qty_Booked'] = 0
+        st.dataframe(df_preview, use_container_width=True)
+    if st.button(f"Open {t['id']}", key=f"open_plan_{t['id']}"): open_planning_task(t)
+
+def _render_execution_card(t):
+    with st.container(border=True):
+        col_info, col_act = st.columns([0.7, 0.3])
+        with col_info:
+            st.markdown(f"**{t['id']}**")
+            st.caption(f"📅 {t.get('date','-')} | 🏷️ {t.get('channel','-')}")
+            is_b = t.get('is_booked', True)
+            st.caption(f"Status: **{'✅ BOOKED' if is_b else '❌ UNBOOKED'}**")
         
-    for t in tasks:
-        # Visual Container per task
-        with st.container(border=True):
-            col_info, col_act = st.columns([0.7, 0.3])
-            with col_info:
-                st.markdown(f"**{t['id']}**")
-                st.caption(f"📅 {t.get('date','-')} | 🏷️ {t.get('channel','-')}")
-                is_b = t.get('is_booked', True)
-                st.caption(f"Status: **{'✅ BOOKED' if is_b else '❌ UNBOOKED'}**")
+        with col_act:
+            if st.button(f"Open", key=f"open_exec_{t['id']}", use_container_width=True):
+                st.session_state['curr_con'] = edit_consignment(t)
+                st.session_state['page'] = 'view_saved'
+                st.rerun() # Necessary to change page
             
-            with col_act:
-                if st.button(f"Open", key=f"open_exec_{t['id']}", use_container_width=True):
-                    st.session_state['curr_con'] = t
-                    st.session_state['page'] = 'view_saved'
-                    st.rerun() # Necessary to change page
-                
-                if st.button(f"Toggle Booked", key=f"toggle_booked_{t['id']}", use_container_width=True):
-                    # Toggle logic
-                    for idx, hh in enumerate(st.session_state['consignments']):
-                        if hh['id'] == t['id']:
-                            st.session_state['consignments'][idx]['is_booked'] = not st.session_state['consignments'][idx].get('is_booked', True)
-                            save_history(st.session_state['consignments'])
-                            st.rerun()
+            if st.button(f"Toggle Booked", key=f"toggle_booked_{t['id']}", use_container_width=True):
+                t = edit_consignment(t)
+                t['is_booked'] = not t.get('is_booked', True)
+                t['booked_updated_at'] = pd.Timestamp.now().isoformat()
+                put_consignment(t)
+                save_history(st.session_state['consignments'])
+                st.rerun(scope="fragment")
+
+@st.fragment
+def render_history_list(task_type='execution'):
+    """Searchable, paginated history index for one task type; only the visible page of tasks gets widgets"""
+    idx_key, idx = session_history_index()
+    idx = idx[idx['Type'] == task_type]
+    if idx.empty:
+        st.info(f"No {task_type} tasks yet.")
+        return
+    
+    k = f"hist_{task_type}"
+    f1, f2, f3, f4, f5 = st.columns([2, 2, 2, 1.2, 1.4])
+    query = f1.text_input("Search ID", key=f"{k}_q")
+    channels = f2.multiselect("Channel", sorted(idx['Channel'].unique()), key=f"{k}_ch")
+    dates = f3.date_input("Date range", value=(), key=f"{k}_dt")
+    booked = f4.selectbox("Status", ['All', 'Booked', 'Unbooked'], key=f"{k}_bk")
+    sort = f5.selectbox("Sort", list(HISTORY_SORTS), key=f"{k}_sort")
+    date_range = (pd.Timestamp(dates[0]), pd.Timestamp(dates[-1]) + pd.Timedelta(days=1) - pd.Timedelta(1)) if dates else None
+    # Filtered view is reused across reruns until the index or the filters change (e.g. paging only)
+    view_key = (idx_key, query, tuple(channels), date_range, booked, sort)
+    views = st.session_state.setdefault('history_views', {})
+    if views.get(task_type, (None,))[0] != view_key: views[task_type] = (view_key, filter_history_index(idx, query, channels, date_range, booked, sort))
+    view = views[task_type][1]
+    
+    n_pages = max(1, math.ceil(len(view) / HISTORY_PAGE_SIZE))
+    if st.session_state.get(f"{k}_page", 1) > n_pages: st.session_state[f"{k}_page"] = n_pages
+    p1, p2 = st.columns([1, 4])
+    page = p1.number_input(f"Page (of {n_pages})", min_value=1, max_value=n_pages, step=1, key=f"{k}_page")
+    p2.caption(f"{len(view)} of {len(idx)} tasks match")
+    visible = view.iloc[(page - 1) * HISTORY_PAGE_SIZE: page * HISTORY_PAGE_SIZE]
+    st.dataframe(visible.drop(columns=['Type']).assign(Date=visible['Date'].dt.date), hide_index=True, use_container_width=True)
+    
+    render_card = _render_execution_card if task_type == 'execution' else _render_planning_card
+    for cid in visible['ID']:
+        t = session_record(cid)
+        if t is not None: render_card(t)
 
 @st.fragment
-def render_scan_interface(df_boxes, pkg, merged_pdf_bytes):
+def render_scan_interface(df_boxes, pkg, label_reader):
     """Renders the scanning table and input to prevent full page reload"""
+    c_id = pkg['id']; svc = box_claim_service(); station = station_id()
     
-    # Init Tracking in Fragment
-    if 'printed_temp_set' not in st.session_state:
+    # Init Tracking in Fragment (per consignment; claims are shared with other stations)
+    if st.session_state.get('printed_temp_cid') != c_id:
         st.session_state['printed_temp_set'] = set(pkg.get('printed_boxes', []))
+        st.session_state['printed_temp_cid'] = c_id
+        svc.seed_printed(c_id, pkg.get('printed_boxes', []))
     
     # 1. Scanning Logic (Instant, no Cloud Save)
     def process_scan():
@@ -760,18 +3107,18 @@ def render_scan_interface(df_boxes, pkg, merged_pdf_bytes):
         if matches.empty: 
             st.toast(f"❌ Product not found: {scan_val}", icon="⚠️")
         else:
-            # Check against local temp set
-            valid_boxes = matches[~matches['Box No'].isin(st.session_state['printed_temp_set'])]
+            # Atomic claim across all stations scanning this consignment
+            target_box = svc.claim_next(c_id, matches['Box No'].tolist(), station)
             
-            if valid_boxes.empty: 
+            if target_box is None: 
                 st.toast(f"✅ All boxes for {scan_val} already printed!", icon="ℹ️")
             else:
-                target_box = valid_boxes.iloc[0]['Box No']
-                pdf_data = extract_label_pdf_bytes(merged_pdf_bytes, int(target_box)-1)
+                pdf_data = extract_label_pdf_bytes(label_reader, int(target_box)-1)
                 
                 if pdf_data:
                     # Trigger Print JS
                     qz_tray_print_component(pdf_data, st.session_state.get('selected_printer_name', 'ZDesigner GK420t'))
+                    svc.mark_printed(c_id, target_box, station)
                     
                     # Update Local State
                     st.session_state['last_printed_box'] = int(target_box)
@@ -779,6 +3126,7 @@ def render_scan_interface(df_boxes, pkg, merged_pdf_bytes):
                     st.session_state['unsaved_scan_changes'] = True
                     st.toast(f"🖨️ Sent Box {target_box} to QZ Tray", icon="✅")
                 else: 
+                    svc.release(c_id, target_box, station)
                     st.toast("Error extracting label PDF", icon="❌")
         
         st.session_state.scan_input = ""
@@ -790,7 +3138,9 @@ def render_scan_interface(df_boxes, pkg, merged_pdf_bytes):
     if st.session_state.get('unsaved_scan_changes'):
         if st.button("💾 Save Progress to Cloud", type="primary", use_container_width=True):
             # Update main package object
-            pkg['printed_boxes'] = list(st.session_state['printed_temp_set'])
+            shared_printed, _ = svc.progress(c_id)
+            pkg['printed_boxes'] = sorted(st.session_state['printed_temp_set'] | shared_printed)
+            put_consignment(pkg)
             # Save to Cloud
             if save_history(st.session_state['consignments']):
                 st.session_state['unsaved_scan_changes'] = False
@@ -806,8 +3156,11 @@ def render_scan_interface(df_boxes, pkg, merged_pdf_bytes):
         st.success(f"🖨️ Last Printed: **BOX {last_p}**")
 
     # TABLE
+    shared_printed, claimed = svc.progress(c_id)
+    printed_all = st.session_state['printed_temp_set'] | shared_printed
     df_display = df_boxes.copy()
-    df_display['Status'] = df_display['Box No'].apply(lambda x: '✅ PRINTED' if x in st.session_state['printed_temp_set'] else 'WAITING')
+    box_nos = df_display['Box No'].to_numpy()
+    df_display['Status'] = np.where(np.isin(box_nos, list(printed_all)), '✅ PRINTED', np.where(np.isin(box_nos, list(claimed)), '⏳ CLAIMED', 'WAITING'))
 
     def highlight_rows(row):
         box_num = row['Box No']
@@ -832,38 +3185,53 @@ def render_scan_interface(df_boxes, pkg, merged_pdf_bytes):
         with col_act1: st.warning(f"Selected: **Box {selected_box}**")
         with col_act2:
             if st.button(f"🖨️ Reprint", type="primary", use_container_width=True):
-                pdf_data = extract_label_pdf_bytes(merged_pdf_bytes, int(selected_box)-1)
+                pdf_data = extract_label_pdf_bytes(label_reader, int(selected_box)-1)
                 if pdf_data:
                     qz_tray_print_component(pdf_data, st.session_state.get('selected_printer_name', 'ZDesigner GK420t'))
                     st.session_state['last_printed_box'] = int(selected_box)
                     st.toast(f"🖨️ Re-sent Box {selected_box}", icon="✅")
 
+@st.fragment(run_every=5)
+def render_claim_progress(c_id, total_boxes):
+    """Live progress shared by every station scanning this consignment"""
+    printed, claimed = box_claim_service().progress(c_id)
+    done = len(printed)
+    others = sum(1 for s in claimed.values() if s != station_id())
+    st.progress(min(1.0, done / total_boxes) if total_boxes else 0.0, text=f"Printed {done} / {total_boxes} boxes | {others} claimed by other stations")
+
 # --- PAGES ---
 
 # 1. HOME
 if st.session_state['page'] == 'home':
     st.title("Warehouse Dashboard")
-    if st.session_state['consignments']:
-        df_h_rows = []
-        for c in st.session_state['consignments']:
-            try:
-                boxes = c['data']['Editable Boxes'].sum() if isinstance(c.get('data', None), pd.DataFrame) and 'Editable Boxes' in c['data'].columns else 0
-                qty = c['data']['Editable Qty'].sum() if isinstance(c.get('data', None), pd.DataFrame) and 'Editable Qty' in c['data'].columns else 0
-                datev = pd.to_datetime(c['date'])
-            except: boxes = 0; qty = 0; datev = pd.NaT
-            df_h_rows.append({'Date': datev, 'Channel': c.get('channel','-'), 'Boxes': boxes, 'Qty': qty})
-        df_h = pd.DataFrame(df_h_rows)
-        m1, m2, m3 = st.columns(3)
-        m1.metric("📦 Total Boxes Sent", int(df_h['Boxes'].sum()) if not df_h.empty else 0)
-        m2.metric("👟 Total Pairs/Qty", int(df_h['Qty'].sum()) if not df_h.empty else 0)
-        m3.metric("📅 Last Shipment", df_h['Date'].max().strftime('%d-%b-%Y') if not df_h.empty and pd.notna(df_h['Date'].max()) else "N/A")
+    kpi = kpi_frame()
+    if not kpi.empty:
+        type_sel = st.radio("Tasks", ['All', 'Execution', 'Planning'], horizontal=True, key='dash_type')
+        if type_sel != 'All': kpi = kpi[kpi['Type'] == type_sel.lower()]
+        totals = kpi[KPI_COLUMNS].sum()
+        last_date = kpi['Date'].max()
+        m1, m2, m3, m4 = st.columns(4)
+        m1.metric("📦 Total Boxes Sent", int(totals['Boxes']))
+        m2.metric("👟 Total Pairs/Qty", int(totals['Qty']))
+        m3.metric("✅ Booked / ❌ Unbooked", f"{int(totals['Booked'])} / {int(totals['Unbooked'])}")
+        m4.metric("📅 Last Shipment", last_date.strftime('%d-%b-%Y') if pd.notna(last_date) else "N/A")
+        dated = kpi.dropna(subset=['Date'])
+        if not dated.empty:
+            st.subheader("Boxes per Channel per Week")
+            weekly = dated.groupby([pd.Grouper(key='Date', freq='W-MON', label='left', closed='left'), 'Channel'])['Boxes'].sum().unstack(fill_value=0)
+            st.bar_chart(weekly)
         st.subheader("Recent Activity")
-        st.dataframe(df_h.sort_values(by='Date', ascending=False).head(5), use_container_width=True)
+        recent = kpi.groupby(['Date', 'Channel'], dropna=False)[KPI_COLUMNS].sum().reset_index()
+        recent['Date'] = recent['Date'].dt.date
+        st.dataframe(recent.sort_values(by='Date', ascending=False, na_position='last').head(5), hide_index=True, use_container_width=True)
     else: st.info("No consignments found.")
 
 # 2. PLAN FLIPKART
-elif st.session_state['page'] == 'plan_flipkart':
-    st.title("Plan Flipkart Consignment")
+elif st.session_state['page'] in ('plan_flipkart', 'plan_generic'):
+    channel = 'Flipkart' if st.session_state['page'] == 'plan_flipkart' else st.session_state.get('plan_channel', 'Amazon')
+    if channel not in PLAN_CHANNELS: channel = 'Amazon'
+    st.session_state['plan_channel'] = channel
+    st.title(f"Plan {channel} Consignment")
     with st.expander("⚙️ Settings & Templates", expanded=False):
         c1, c2 = st.columns(2)
         cost_val = c1.number_input("Standard Cost (INR) [Col P]", value=350)
@@ -872,23 +3240,33 @@ elif st.session_state['page'] == 'plan_flipkart':
         t1, t2 = st.columns(2)
         with t1:
             st.markdown("**Single Warehouse Template**")
-            curr_s = load_template_db('single')
+            curr_s = load_template_db('single', channel)
             if not curr_s.empty: st.caption(f"✅ Loaded: {len(curr_s)} Rows")
             else: st.caption("❌ Not Found")
             up_s = st.file_uploader("Upload Single WH Template", type=['csv'], key='tpl_s')
             if up_s and st.button("Update Single Template"):
-                save_template_db(pd.read_csv(up_s, dtype=str), 'single'); st.success("Updated!"); st.rerun()
+                save_template_db(pd.read_csv(up_s, dtype=str), 'single', channel); st.success("Updated!"); st.rerun()
         with t2:
             st.markdown("**Multi Warehouse Template**")
-            curr_m = load_template_db('multi')
+            curr_m = load_template_db('multi', channel)
             if not curr_m.empty: st.caption(f"✅ Loaded: {len(curr_m)} Rows")
             else: st.caption("❌ Not Found")
             up_m = st.file_uploader("Upload Multi WH Template", type=['csv'], key='tpl_m')
             if up_m and st.button("Update Multi Template"):
-                save_template_db(pd.read_csv(up_m, dtype=str), 'multi'); st.success("Updated!"); st.rerun()
+                save_template_db(pd.read_csv(up_m, dtype=str), 'multi', channel); st.success("Updated!"); st.rerun()
+        if channel != 'Flipkart':
+            st.divider()
+            st.markdown(f"**{channel} FC Codes (multi-warehouse plans)**")
+            fcs = channel_fcs(channel) or {}
+            fc_cols = st.columns(len(ZONES_ORDER))
+            fc_vals = {z: col.text_input(z, value=fcs.get(z, ''), key=f'fc_{channel}_{z}') for col, z in zip(fc_cols, ZONES_ORDER)}
+            if not fcs: st.caption("❌ Not configured")
+            if st.button("Save FC Codes"):
+                if all(v.strip() for v in fc_vals.values()): save_channel_fcs(channel, fc_vals); st.success("Updated!"); st.rerun()
+                else: st.error("Enter an FC code for every zone.")
         st.divider()
         st.markdown("**Booked Summary (quick view)**")
-        bd, dates_av = compute_booked_details_from_history()
+        bd, dates_av = compute_booked_details_from_history(channel)
         if not bd: st.caption("No booked SKUs.")
         else:
             bm_df = pd.DataFrame([{'SKU': k, 'Qty_Booked': v['total_qty']} for k, v in bd.items()]).sort_values(by='SKU', key=lambda s: s.str.upper()).reset_index(drop=True)
@@ -904,43 +3282,144 @@ elif st.session_state['page'] == 'plan_flipkart':
     inc_dupe = st.checkbox("INCLUDE DUPLICATE LISTINGS", value=False)
     st.divider()
 
-    if wh_mode == "Single Warehouse File":
-        c1, c2 = st.columns(2)
-        sales_file = c1.file_uploader("Last 30 Days Sales (Excel)", type=['xlsx'])
-        inv_file = c2.file_uploader("Current FBF Inventory (CSV/Excel)", type=['csv', 'xlsx'])
-        prog_cont = st.empty()
-        if st.button("🚀 Generate Plan", type="primary"):
-            if not sales_file or not inv_file: st.error("Please upload both files.")
+    if channel == 'Flipkart':
+        with st.expander("📈 Demand Store", expanded=False):
+            cov = demand_store().coverage()
+            st.caption(f"Holds {cov[2]:,} order items from {cov[0]:%d %b %Y} to {cov[1]:%d %b %Y} (last {DEMAND_RETENTION_DAYS} days kept)." if cov else "Empty. Sales exports with 'Order Item ID' and 'Order Date' are added here when you generate a plan or upload them below.")
+            ds_files = st.file_uploader("Add Sales Exports (overlapping periods are fine)", type=['xlsx'], accept_multiple_files=True, key='demand_up')
+            if ds_files and st.button("➕ Add to Demand Store"):
+                for f in ds_files:
+                    try:
+                        stats = demand_store().ingest(cached_upload_frame(f, 'sales', parse_sales_upload)[0])
+                        st.success(f"{f.name}: {stats['new']:,} new order items, {stats['duplicate']:,} already known" + (f", {stats['skipped']:,} without ID/date skipped" if stats['skipped'] else ""))
+                    except Exception as e: st.error(f"{f.name}: {e}")
+        sales_src = st.radio("Sales Source", ["Upload Sales Export", "Demand Store"], horizontal=True, key='plan_sales_src')
+    else: sales_src = "Upload Sales Export"  # the demand store holds Flipkart order items only
+    c1, c2 = st.columns(2)
+    if sales_src == "Demand Store":
+        sales_file = None
+        win_label = c1.selectbox("Demand Window", list(DEMAND_WINDOWS), index=1, key='plan_demand_window')
+        c1.caption(f"Scaled to {PLAN_HORIZON_DAYS} days of demand.")
+    else: sales_file = c1.file_uploader("Last 30 Days Sales (Excel)" if channel == 'Flipkart' else f"Last 30 Days {channel} Sales Report (Excel/CSV/TXT)", type=['xlsx'] if channel == 'Flipkart' else ['xlsx', 'csv', 'txt'])
+    inv_file = c2.file_uploader("Current FBF Inventory (CSV/Excel)" if channel == 'Flipkart' else f"Current {channel} FC Inventory (CSV/Excel)", type=['csv', 'xlsx'])
+    if mode_key == 'multi' and not channel_warehouses(channel): c2.error(channel_fcs_missing(channel))
+    elif mode_key == 'multi': c2.caption(f"Per-warehouse stock from a warehouse/location column or one column per warehouse ({', '.join(channel_warehouses(channel))}); otherwise stock is split by each warehouse's sales share.")
+    prog_cont = st.empty()
+    g1, g2 = st.columns([1, 3])
+    if g2.button("⏳ Generate in Background", help="Runs on the server and keeps going if you refresh; load the plan below when it is done"):
+        if not inv_file or (sales_src != "Demand Store" and not sales_file): st.error("Please upload both files." if sales_src != "Demand Store" else "Please upload the inventory file.")
+        else:
+            job_scheduler().submit('plan_generate', {'inventory': stage_job_input(inv_file), 'sales': stage_job_input(sales_file) if sales_file is not None else None,
+                                                     'window': None if sales_file is not None else win_label, 'mode': mode_key, 'mult': float(mult), 'dupe': bool(inc_dupe), 'channel': channel}, station=station_id())
+            st.toast("Plan generation queued")
+    render_jobs_panel(['plan_generate'], on_load=load_plan_job)
+    if g1.button("🚀 Generate Plan", type="primary"):
+        if not inv_file or (sales_src != "Demand Store" and not sales_file): st.error("Please upload both files." if sales_src != "Demand Store" else "Please upload the inventory file.")
+        elif sales_src == "Demand Store" and demand_store().coverage() is None: st.error("The demand store is empty. Add a sales export first.")
+        else:
+            try:
+                sales_hit = ingest_note = None
+                if sales_file is not None:
+                    prog_bar = prog_cont.progress(0, text="Reading Sales File...")
+                    sales_df, sales_hit = cached_upload_frame(sales_file, channel_upload_kind('sales', channel), lambda buf: parse_sales_upload(buf, channel))
+                    if not sales_hit and channel == 'Flipkart':
+                        try: stats = demand_store().ingest(sales_df.copy()); ingest_note = f"📈 Demand store: {stats['new']:,} new order items ({stats['duplicate']:,} already known)"
+                        except ValueError: pass
+                prog_bar = prog_cont.progress(30, text="Reading Inventory File...")
+                is_csv = inv_file.name.endswith('.csv')
+                inv_df, inv_hit = cached_upload_frame(inv_file, channel_upload_kind('inventory-csv' if is_csv else 'inventory-xlsx', channel), lambda buf: parse_inventory_upload(buf, is_csv, channel))
+                prog_bar.progress(60, text="Calculating Logic...")
+                if sales_file is None: inputs, msg = plan_inputs_from_demand(demand_store().demand_window(DEMAND_WINDOWS[win_label]), inv_df, mode_key)
+                else: inputs, msg = build_plan_inputs(sales_df, inv_df, mode_key, channel)
+                if inputs is None: plan = _plan_fail(msg)
+                else: plan = allocate_plan(inputs, mult, inc_dupe)
+                res_df, msg = plan[0], plan[1]
+                prog_cont.empty()
+                store_plan_results(plan)
+                st.session_state['plan_inputs'] = inputs
+                st.session_state['plan_whatif_params'] = (float(mult), bool(inc_dupe), mode_key, (), (), ())
+                st.session_state.pop('plan_whatif_diff', None)
+                st.session_state['plan_mode_key'] = mode_key
+                st.session_state['plan_task_id'] = f"TASK_{int(time.time())}"
+                if sales_hit or inv_hit: st.caption(f"♻️ Re-used parsed {' and '.join(n for n, h in [('sales', sales_hit), ('inventory', inv_hit)] if h)} file (cached)")
+                if ingest_note: st.caption(ingest_note)
+                if isinstance(res_df, pd.DataFrame) and res_df.empty: st.warning(f"Calculation completed: {msg}")
+                else: st.success(f"Plan Generated! {len(res_df)} box rows.")
+                if mode_key == 'multi' and inputs is not None and inputs['wh_stock_split']: st.caption("ℹ️ Inventory has no per-warehouse breakdown; stock was split by each warehouse's sales share.")
+            except Exception as e: st.error(f"Error: {e}")
+
+    with st.expander("🔗 Combined Run (all channels, shared stock)", expanded=False):
+        st.caption("Plans every channel with uploads in one run. Each channel nets its own FC stock and booked consignments; with a warehouse stock file, boxes per SKU are capped to what is on hand after all booked units, shared pro rata.")
+        comb_cols = st.columns(len(PLAN_CHANNELS)); comb_files = {}
+        for col, ch in zip(comb_cols, PLAN_CHANNELS):
+            col.markdown(f"**{ch}**")
+            comb_files[ch] = (col.file_uploader(f"{ch} Sales", type=['xlsx', 'csv', 'txt'], key=f'comb_sales_{ch}'), col.file_uploader(f"{ch} Inventory", type=['csv', 'xlsx'], key=f'comb_inv_{ch}'))
+        comb_stock = st.file_uploader("Warehouse Stock (optional; SKU + quantity, CSV/Excel)", type=['csv', 'xlsx'], key='comb_stock')
+        if st.button("🚀 Run Combined Plan"):
+            ready = {ch: f for ch, f in comb_files.items() if f[0] and f[1]}
+            if not ready: st.error("Upload sales and inventory for at least one channel.")
             else:
                 try:
-                    prog_bar = prog_cont.progress(0, text="Reading Sales File...")
-                    time.sleep(0.2); sales_file.seek(0)
-                    try: sales_df = pd.read_excel(sales_file, sheet_name='Sales Report', engine='openpyxl')
-                    except Exception: sales_file.seek(0); sales_df = pd.read_excel(sales_file, sheet_name='Sales Report')
-                    prog_bar.progress(30, text="Reading Inventory File...")
-                    time.sleep(0.2); inv_file.seek(0)
-                    if inv_file.name.endswith('.csv'): inv_df = pd.read_csv(inv_file, dtype=str)
-                    else: inv_df = pd.read_excel(inv_file, dtype=str)
-                    prog_bar.progress(60, text="Calculating Logic...")
-                    settings = {'multiplier': mult}
-                    res_df, msg, summary_df, zone_summary_df, combined_zone_df = calculate_single_warehouse_plan(sales_df, inv_df, settings, inc_dupe, mode_key)
-                    prog_bar.progress(100, text="Done!"); time.sleep(0.2); prog_cont.empty()
-                    st.session_state['plan_results'] = res_df if isinstance(res_df, pd.DataFrame) else pd.DataFrame()
-                    st.session_state['plan_summary'] = summary_df if isinstance(summary_df, pd.DataFrame) else pd.DataFrame()
-                    st.session_state['plan_zone_summary'] = zone_summary_df if isinstance(zone_summary_df, pd.DataFrame) else pd.DataFrame()
-                    st.session_state['plan_combined_zone_working'] = combined_zone_df if isinstance(combined_zone_df, pd.DataFrame) else pd.DataFrame()
-                    st.session_state['plan_mode_key'] = mode_key
-                    st.session_state['plan_task_id'] = f"TASK_{int(time.time())}"
-                    if isinstance(res_df, pd.DataFrame) and res_df.empty: st.warning(f"Calculation completed: {msg}")
-                    else: st.success(f"Plan Generated! {len(res_df)} box rows.")
+                    with st.spinner("Planning channels..."):
+                        t0 = time.perf_counter(); uploads = {}
+                        for ch, (sf, inf) in ready.items():
+                            is_csv = inf.name.endswith('.csv')
+                            uploads[ch] = (cached_upload_frame(sf, channel_upload_kind('sales', ch), lambda buf, ch=ch: parse_sales_upload(buf, ch))[0],
+                                           cached_upload_frame(inf, channel_upload_kind('inventory-csv' if is_csv else 'inventory-xlsx', ch), lambda buf, ch=ch, is_csv=is_csv: parse_inventory_upload(buf, is_csv, ch))[0])
+                        shared = None
+                        if comb_stock:
+                            is_csv = comb_stock.name.endswith('.csv')
+                            shared = _plan_stock(cached_upload_frame(comb_stock, 'inventory-csv' if is_csv else 'inventory-xlsx', lambda buf: parse_inventory_upload(buf, is_csv))[0])
+                        rows, plans = plan_channels_combined(uploads, mode_key, mult, inc_dupe, shared)
+                    st.session_state['plan_combined'] = (rows, plans, time.perf_counter() - t0)
                 except Exception as e: st.error(f"Error: {e}")
-    else: st.info("Multi Warehouse Logic Coming Soon...")
+        comb = st.session_state.get('plan_combined')
+        if comb:
+            rows, plans, secs = comb
+            summary = pd.DataFrame([{'Channel': ch, 'Status': p if isinstance(p, str) else p[1], 'SKUs': rows.loc[rows['Channel'] == ch, 'SKU Id'].nunique() if not rows.empty else 0,
+                                     'Boxes': int(rows.loc[rows['Channel'] == ch, 'Editable Boxes'].sum()) if not rows.empty else 0, 'Units': int(rows.loc[rows['Channel'] == ch, 'Editable Qty'].sum()) if not rows.empty else 0} for ch, p in plans.items()])
+            st.markdown(f"**Combined plan** ({secs:.1f}s)")
+            st.dataframe(summary, hide_index=True, use_container_width=True)
+            if not rows.empty:
+                st.download_button("⬇ Download Combined Plan XLSX", export_xlsx([xlsx_sheet('All_Channels', rows)] + [xlsx_sheet(ch, rows[rows['Channel'] == ch]) for ch in plans if (rows['Channel'] == ch).any()]), f"Combined_Plan_{int(time.time())}.xlsx", mime=XLSX_MIME)
+                open_cols = st.columns(len(plans))
+                for col, ch in zip(open_cols, plans):
+                    if (rows['Channel'] == ch).any() and col.button(f"📝 Edit {ch} Plan", key=f'comb_open_{ch}'):
+                        plan = plans[ch]
+                        store_plan_results((rows[rows['Channel'] == ch].drop(columns=['Channel', 'Shared_Stock'], errors='ignore').reset_index(drop=True), plan[1], plan[2], plan[3], plan[4]))
+                        for k in ['plan_inputs', 'plan_whatif_params', 'plan_whatif_diff']: st.session_state.pop(k, None)
+                        st.session_state['plan_mode_key'] = mode_key; st.session_state['plan_task_id'] = f"TASK_{int(time.time())}_{ch.upper()}"
+                        st.session_state['plan_channel'] = ch; nav('plan_flipkart' if ch == 'Flipkart' else 'plan_generic')
+
+    inputs = st.session_state.get('plan_inputs')
+    if inputs is not None and 'plan_results' in st.session_state:
+        with st.expander("🔁 What-if Re-planning", expanded=True):
+            st.caption("Sales Multiplier, duplicate listings and warehouse mode re-plan instantly from the loaded files. Re-planning replaces manual edits in the editor.")
+            w1, w2 = st.columns(2)
+            ex_zones = w1.multiselect("Exclude Zones", inputs['zones'], key='wi_zones')
+            ex_skus = w2.multiselect("Exclude SKUs", sorted(inputs['skus'], key=lambda x: str(x).upper()), key='wi_skus')
+            ppcn_ed = st.data_editor(pd.DataFrame({'SKU': pd.Series(dtype=object), 'PPCN': pd.Series(dtype='Int64')}), num_rows='dynamic', key='wi_ppcn', column_config={'SKU': st.column_config.SelectboxColumn('SKU', options=list(inputs['skus'])), 'PPCN': st.column_config.NumberColumn('PPCN Override', min_value=1, step=1)})
+            overrides = {str(r.SKU): int(r.PPCN) for r in ppcn_ed.dropna().itertuples(index=False)}
+            if inputs['mode_type'] != mode_key:
+                inputs['ppcn'] = plan_ppcn(pd.Index(inputs['skus']), mode_key, inputs.get('channel', 'Flipkart')); inputs['mode_type'] = mode_key
+            params = (float(mult), bool(inc_dupe), mode_key, tuple(sorted(ex_zones)), tuple(sorted(ex_skus)), tuple(sorted(overrides.items())))
+            if params != st.session_state.get('plan_whatif_params'):
+                before = st.session_state['plan_results']; t0 = time.perf_counter()
+                plan = allocate_plan(inputs, mult, inc_dupe, overrides, ex_zones, ex_skus)
+                store_plan_results(plan)
+                st.session_state['plan_mode_key'] = mode_key
+                st.session_state['plan_whatif_params'] = params
+                st.session_state['plan_whatif_diff'] = (plan_zone_diff(before, plan[0]), (time.perf_counter() - t0) * 1000)
+            wi_diff = st.session_state.get('plan_whatif_diff')
+            if wi_diff:
+                st.markdown(f"**Boxes per Zone: before → after** (re-planned in {wi_diff[1]:.0f} ms)")
+                st.dataframe(wi_diff[0], hide_index=True, use_container_width=True)
 
     if 'plan_results' in st.session_state:
-        df_res = st.session_state['plan_results'].copy()
-        summary_df = st.session_state.get('plan_summary', pd.DataFrame()).copy()
-        combined_zone_df = st.session_state.get('plan_combined_zone_working', pd.DataFrame()).copy()
-        zone_summary_df = st.session_state.get('plan_zone_summary', pd.DataFrame()).copy()
+        # Read-only here; the editor and the saved task take their own copies
+        df_res = st.session_state['plan_results']
+        summary_df = st.session_state.get('plan_summary', pd.DataFrame())
+        combined_zone_df = st.session_state.get('plan_combined_zone_working', pd.DataFrame())
         task_id = st.session_state.get('plan_task_id', f"TASK_{int(time.time())}")
         st.divider()
         st.subheader(f"Results & Editor (Task: {task_id})")
@@ -956,7 +3435,7 @@ elif st.session_state['page'] == 'plan_flipkart':
 
         tabs = st.tabs(["All"] + ZONES_ORDER)
         with tabs[0]:
-            edited = st.data_editor(st.session_state['plan_editor_df'], key="editor_all", use_container_width=True, hide_index=True)
+            edited = st.data_editor(st.session_state['plan_editor_df'], key=f"editor_all_{st.session_state.get('plan_rev', 0)}", use_container_width=True, hide_index=True)
             st.session_state['plan_editor_df'] = edited
 
         if st.button("💾 SAVE TASK", type="primary"):
@@ -965,89 +3444,63 @@ elif st.session_state['page'] == 'plan_flipkart':
             if save_df.empty: st.error("No rows selected.")
             else:
                 if 'Qty_Booked' not in save_df.columns: save_df['Qty_Booked'] = 0
-                pack = {'id': task_id, 'date': str(pd.Timestamp.now().date()), 'channel': st.session_state.get('plan_channel','Flipkart'), 'data': save_df.reset_index(drop=True), 'original_data': summary_df, 'backup_data': pd.DataFrame(), 'sender': {}, 'receiver': {}, 'saved': True, 'printed_boxes': [], 'task_type': 'planning', 'mode_key': st.session_state.get('plan_mode_key','single'), 'is_booked': False}
-                st.session_state['consignments'].append(pack)
+                pack = {'id': task_id, 'date': str(pd.Timestamp.now().date()), 'channel': st.session_state.get('plan_channel','Flipkart'), 'original_data': summary_df.copy(), 'sender': {}, 'receiver': {}, 'saved': True, 'printed_boxes': [], 'task_type': 'planning', 'mode_key': st.session_state.get('plan_mode_key','single'), 'is_booked': False}
+                try: set_consignment_data(pack, save_df)
+                except ValueError as e: st.error(str(e)); st.stop()
+                put_consignment(pack)
                 save_history(st.session_state['consignments'])
                 st.success(f"Task saved: {task_id}")
 
         st.divider()
-        tpl_db = load_template_db(mode_key)
+        tpl_db = load_template_db(mode_key, channel)
         if not combined_zone_df.empty:
-            def zone_working_xlsx_bytes(combined_df, zone_summary_df):
-                out = io.BytesIO()
-                export_combined = combined_df.copy()
-                if 'Boxes' in export_combined.columns: export_combined['Boxes'] = export_combined['Boxes'].apply(lambda x: max(0, int(x)))
-                if 'Final_Qty' in export_combined.columns: export_combined['Final_Qty'] = export_combined['Final_Qty'].apply(lambda x: max(0, int(x)))
-                with pd.ExcelWriter(out, engine='xlsxwriter') as writer:
-                    export_combined = export_combined.sort_values(by='SKU', key=lambda s: s.str.upper()).reset_index(drop=True)
-                    export_combined.to_excel(writer, index=False, sheet_name='Complete_Working')
-                    for zone in ZONES_ORDER:
-                        zone_col = zone
-                        if zone_col not in export_combined.columns: continue
-                        zone_only = export_combined[export_combined[zone_col] > 0].copy()
-                        if not zone_only.empty:
-                            zone_only = zone_only[['SKU','Sales_30','FBF_Qty','Qty_Booked','Needed_Qty',zone_col,'PPCN']].copy()
-                            zone_only = zone_only.rename(columns={zone_col:'Boxes'})
-                            zone_only['Boxes'] = zone_only['Boxes'].apply(lambda x: max(0,int(x)))
-                            zone_only['Final_Qty'] = zone_only['Boxes'] * zone_only['PPCN']
-                            zone_only = zone_only[['SKU','Sales_30','FBF_Qty','Qty_Booked','Needed_Qty','Boxes','Final_Qty','PPCN']]
-                            zone_only = zone_only.sort_values(by='SKU', key=lambda s: s.str.upper()).reset_index(drop=True)
-                            zone_only.to_excel(writer, index=False, sheet_name=zone)
-                return out.getvalue()
-            st.download_button("⬇ Download Complete Working (Zone-wise) XLSX", zone_working_xlsx_bytes(combined_zone_df, zone_summary_df), f"Complete_Working_ZoneWise_{task_id}.xlsx", mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
+            def zone_working_xlsx_bytes(combined_df):
+                # One sorted row order and clipped box arrays shared by every sheet
+                order = np.argsort(combined_df['SKU'].astype(str).str.upper().to_numpy(), kind='stable')
+                ppcn = combined_df['PPCN'].to_numpy() if 'PPCN' in combined_df.columns else None
+                cols = []
+                for c in combined_df.columns:
+                    if c in ('Boxes', 'Final_Qty'): cols.append((c, np.maximum(combined_df[c].to_numpy().astype(int), 0)))
+                    else: cols.append(c)
+                sheets = [xlsx_sheet('Complete_Working', combined_df, cols, rows=order)]
+                for zone in ZONES_ORDER:
+                    if zone not in combined_df.columns or ppcn is None: continue
+                    z_boxes = combined_df[zone].to_numpy().astype(int)
+                    z_rows = order[z_boxes[order] > 0]
+                    if len(z_rows) == 0: continue
+                    z_boxes = np.maximum(z_boxes, 0)
+                    sheets.append(xlsx_sheet(zone, combined_df, ['SKU','Sales_30','FBF_Qty','Qty_Booked','Needed_Qty',('Boxes', z_boxes),('Final_Qty', z_boxes * ppcn),'PPCN'], rows=z_rows))
+                return export_xlsx(sheets)
+            st.download_button("⬇ Download Complete Working (Zone-wise) XLSX", lambda df=combined_zone_df: zone_working_xlsx_bytes(df), f"Complete_Working_ZoneWise_{task_id}.xlsx", mime=XLSX_MIME)
         else: st.info("Complete Working (zone-wise) not available - run plan first.")
 
+        # Listing files are cut from one template join; CSV/ZIP bytes are only rendered when a download is clicked
+        master = st.session_state['plan_editor_df']
+        # Multi-warehouse plans get one listing per warehouse, single plans one per zone
+        group_col, group_names = ('Warehouse', channel_warehouses(channel)) if 'Warehouse' in master.columns else ('Zone', ZONES_ORDER)
+        tpl_error = listing_template_error(tpl_db, channel) if not tpl_db.empty else "Template empty. Upload a template in settings to generate Active Listings."
+        listing_rows, listing_files = None, []
+        if not tpl_error:
+            groups = [('All Zone', dict(zip(summary_df['SKU'], np.maximum(pd.to_numeric(summary_df['Final_Qty'], errors='coerce').fillna(0).astype(int), 0))) if not summary_df.empty else {})]
+            if not master.empty:
+                per_group = master.groupby([group_col, 'SKU Id'])['Editable Qty'].sum()
+                groups += [(g, per_group.loc[g].clip(lower=0).astype(int).to_dict()) for g in group_names if g in per_group.index.get_level_values(0)]
+            listing_rows, listing_files = plan_listing_files(tpl_db, groups, channel, cost_val)
+        if listing_files: st.download_button(f"⬇ Download All Active Listings (ZIP, {len(listing_files)} files)", lambda: listing_zip_bytes(listing_rows, listing_files, task_id), f"Active_Listings_{task_id}.zip", "application/zip")
+
         st.markdown("**Active Listings (All Zones)**")
-        if tpl_db.empty: st.error("Template empty. Upload a template in settings to generate Active Listings.")
-        elif tpl_db.shape[1] < 16: st.error("Template must have at least 16 columns (so Column O and P exist).")
-        else:
-            sku_qty_map = {}
-            if not summary_df.empty:
-                for _, r in summary_df.iterrows(): sku_qty_map[r['SKU']] = max(0, int(r['Final_Qty']))
-            tpl_filtered = tpl_db[tpl_db['SKU'].isin(sku_qty_map.keys())].copy().reset_index(drop=True)
-            if tpl_filtered.empty: st.info("No template rows match SKUs requiring boxes.")
-            else:
-                tpl_filtered = tpl_filtered.sort_values(by='SKU', key=lambda s: s.str.upper()).reset_index(drop=True)
-                tpl_filtered.iloc[:, 14] = tpl_filtered['SKU'].map(sku_qty_map).fillna(0).astype(int)
-                tpl_filtered.iloc[:, 15] = cost_val
-                tpl_filtered = tpl_filtered[tpl_filtered.iloc[:, 14] > 0].copy().reset_index(drop=True)
-                if tpl_filtered.empty: st.info("No template rows with quantity > 0.")
-                else:
-                    tmp = tpl_filtered.copy()
-                    tmp['__Q__'] = tmp.iloc[:,14].astype(int)
-                    chunks = split_df_by_quantity_limit(tmp, '__Q__', 4999)
-                    for idx, chunk in enumerate(chunks, start=1):
-                        chunk = chunk.drop(columns=['__Q__'], errors='ignore')
-                        csvb = io.BytesIO(); chunk.to_csv(csvb, index=False)
-                        fname = f"Download_All_Zone_{idx}_{task_id}.csv"
-                        st.download_button(label=f"⬇ Download All Zone {idx} ({task_id})", data=csvb.getvalue(), file_name=fname, mime="text/csv")
+        if tpl_error: st.error(tpl_error)
+        elif not tpl_db[PLAN_CHANNELS[channel]['template_cols'][0]].isin(groups[0][1].keys()).any(): st.info("No template rows match SKUs requiring boxes.")
+        elif not any(f[0] == 'All Zone' for f in listing_files): st.info("No template rows with quantity > 0.")
+        for group, idx, start, stop in listing_files:
+            if group == 'All Zone': st.download_button(label=f"⬇ Download All Zone {idx} ({task_id})", data=lambda a=start, z=stop: listing_csv_bytes(listing_rows, a, z), file_name=listing_file_name(group, idx, task_id), mime="text/csv")
 
         st.divider()
-        st.markdown("**Active Listings (Per Zone)**")
-        if tpl_db.empty or tpl_db.shape[1] < 16: st.info("Upload or fix template to generate zone-wise active listings.")
-        else:
-            master = st.session_state['plan_editor_df'].copy()
-            if not master.empty:
-                for zone in ZONES_ORDER:
-                    zone_sum = master[master['Zone'] == zone].groupby('SKU Id')['Editable Qty'].sum().reset_index().rename(columns={'SKU Id':'SKU','Editable Qty':'CALC_QTY'})
-                    if zone_sum.empty: continue
-                    zone_sum['CALC_QTY'] = zone_sum['CALC_QTY'].apply(lambda x: max(0,int(x)))
-                    merged_zone = tpl_db[tpl_db['SKU'].isin(zone_sum['SKU'])].copy().reset_index(drop=True)
-                    if merged_zone.empty: continue
-                    merged_zone = merged_zone.sort_values(by='SKU', key=lambda s: s.str.upper()).reset_index(drop=True)
-                    merged_zone.iloc[:,14] = merged_zone['SKU'].map(dict(zip(zone_sum['SKU'], zone_sum['CALC_QTY']))).fillna(0).astype(int)
-                    merged_zone.iloc[:,15] = cost_val
-                    merged_zone = merged_zone[merged_zone.iloc[:,14] > 0].copy().reset_index(drop=True)
-                    if merged_zone.empty: continue
-                    tmp = merged_zone.copy()
-                    tmp['__Q__'] = tmp.iloc[:,14].astype(int)
-                    chunks = split_df_by_quantity_limit(tmp, '__Q__', 4999)
-                    for idx, chunk in enumerate(chunks, start=1):
-                        chunk = chunk.drop(columns=['__Q__'], errors='ignore')
-                        csvb = io.BytesIO(); chunk.to_csv(csvb, index=False)
-                        fname = f"Download_{zone}_{idx}_{task_id}.csv"
-                        st.download_button(label=f"⬇ Download {zone} {idx} ({task_id})", data=csvb.getvalue(), file_name=fname, mime="text/csv")
-            else: st.info("No allocation rows to build per-zone listings.")
+        st.markdown(f"**Active Listings (Per {group_col})**")
+        if tpl_error: st.info(f"Upload or fix template to generate {group_col.lower()}-wise active listings.")
+        elif master.empty: st.info("No allocation rows to build per-zone listings.")
+        for group, idx, start, stop in listing_files:
+            if group != 'All Zone': st.download_button(label=f"⬇ Download {group} {idx} ({task_id})", data=lambda a=start, z=stop: listing_csv_bytes(listing_rows, a, z), file_name=listing_file_name(group, idx, task_id), mime="text/csv")
 
         st.divider()
         with st.expander("🚫 Danger Zone — Delete Planning Task", expanded=False):
@@ -1060,7 +3513,7 @@ elif st.session_state['page'] == 'plan_flipkart':
                     st.session_state['consignments'] = [c for c in st.session_state['consignments'] if c.get('id') != task_id]
                     after = len(st.session_state['consignments'])
                     save_history(st.session_state['consignments'])
-                    for k in ['plan_results','plan_summary','plan_zone_summary','plan_combined_zone_working','plan_editor_df','plan_task_id','plan_mode_key']:
+                    for k in ['plan_results','plan_summary','plan_combined_zone_working','plan_editor_df','plan_task_id','plan_mode_key','plan_inputs','plan_whatif_params','plan_whatif_diff']:
                         if k in st.session_state: del st.session_state[k]
                     st.success(f"Deleted task {task_id}. Redirecting to History...")
                     time.sleep(0.8); nav('history')
@@ -1075,7 +3528,7 @@ elif st.session_state['page'] == 'channel':
         col1, col2 = st.columns([0.8, 0.2])
         with col1:
             if st.button(f"📄 {c['id']} | Date: {c['date']} | Boxes: {boxes_sum}", key=c['id'], use_container_width=True):
-                st.session_state['curr_con'] = c; nav('view_saved')
+                st.session_state['curr_con'] = edit_consignment(c); nav('view_saved')
     st.divider()
     if st.button("➕ Create Manual Shipment"): nav('add')
 
@@ -1111,25 +3564,28 @@ elif st.session_state['page'] == 'add':
             df_raw = pd.read_csv(uploaded); uploaded.seek(0); df_c = pd.read_csv(uploaded)
             if not df_m.empty: merged = pd.merge(df_c, df_m, left_on='SKU Id', right_on='SKU', how='left')
             else: merged = df_c
+            merged = merged[merged['SKU Id'].notna()].reset_index(drop=True)
             merged['Editable Qty'] = merged['Quantity Sent'].fillna(0)
             if 'PPCN' in merged.columns: merged['PPCN'] = pd.to_numeric(merged['PPCN'], errors='coerce').fillna(16)
             else: merged['PPCN'] = 16
-            merged['Editable Boxes'] = (merged['Editable Qty'] / merged['PPCN']).apply(lambda x: float(x)).round(2)
-            st.session_state['curr_con'] = {'id': c_id, 'date': str(p_date), 'channel': st.session_state.get('current_channel'), 'data': merged, 'original_data': df_raw, 'backup_data': pd.DataFrame(), 'sender': df_s[df_s['Code']==s_sel].iloc[0].to_dict(), 'receiver': df_r[df_r['Code']==r_sel].iloc[0].to_dict(), 'saved': False, 'printed_boxes': [], 'task_type': 'execution', 'is_booked': True}
+            # whole boxes only; a SKU with less than one full box ships its units in the MIX boxes
+            merged['Editable Boxes'] = np.floor(pd.to_numeric(merged['Editable Qty'], errors='coerce') / merged['PPCN'].where(merged['PPCN'] > 0))
+            pkg = {'id': c_id, 'date': str(p_date), 'channel': st.session_state.get('current_channel'), 'original_data': df_raw, 'sender': df_s[df_s['Code']==s_sel].iloc[0].to_dict(), 'receiver': df_r[df_r['Code']==r_sel].iloc[0].to_dict(), 'saved': False, 'printed_boxes': [], 'task_type': 'execution', 'is_booked': True}
+            try: set_consignment_data(pkg, merged)
+            except ValueError as e: st.error(str(e)); st.stop()
+            st.session_state['curr_con'] = pkg
             nav('preview')
 
 # 5. PREVIEW
 elif st.session_state['page'] == 'preview':
     pkg = st.session_state['curr_con']; st.title(f"Review: {pkg['id']}")
-    disp = pkg['data'][['SKU Id', 'Editable Qty', 'Editable Boxes']].copy()
-    try: disp['Editable Boxes'] = disp['Editable Boxes'].astype(int)
-    except: pass
+    disp = pkg['data'][['SKU Id', 'Editable Qty', 'Editable Boxes']]
     st.dataframe(disp, hide_index=True, use_container_width=True)
     if st.button("💾 SAVE CONSIGNMENT", type="primary"):
         pkg['saved'] = True
         pkg['task_type'] = pkg.get('task_type', 'execution')
         if 'is_booked' not in pkg: pkg['is_booked'] = True
-        st.session_state['consignments'].append(pkg)
+        put_consignment(pkg)
         save_history(st.session_state['consignments']); nav('view_saved')
 
 # 6. VIEW SAVED
@@ -1138,20 +3594,57 @@ elif st.session_state['page'] == 'view_saved':
     if st.button("🔙 Back to Channel", use_container_width=True): nav('channel')
     st.title(f"Consignment: {c_id}")
     if pkg.get('edit_timestamp'): st.info(f"ℹ️ This consignment has been edited on {pkg['edit_timestamp']}")
+    # Every document below is keyed on this one fingerprint and only built when its button is clicked
+    fp = artifact_fingerprint(pkg)
+    doc = lambda kind, pkg=pkg, fp=fp: (lambda: artifact_bytes(pkg, kind, fp))
+
+    b1, b2 = st.columns([1, 2])
+    if b1.button("📦 Build Dispatch Bundle (ZIP)", type="primary", use_container_width=True):
+        old = st.session_state.pop('dispatch_bundle', None)
+        if old: old[2].close()
+        with st.spinner("Building documents..."):
+            st.session_state['dispatch_bundle'] = (c_id, fp, *build_consignment_bundle(pkg, fingerprint=fp))
+    bundle = st.session_state.get('dispatch_bundle')
+    if bundle and bundle[0] == c_id:
+        with b2:
+            if bundle[1] != fp: st.caption("⚠️ Consignment changed since this bundle was built; rebuild for current documents.")
+            # The archive stays in its spool (on disk past SPOOL_MEMORY_LIMIT) until the download is clicked
+            st.download_button("⬇ Download Bundle", lambda spool=bundle[2]: spool_bytes(spool), f"Dispatch_{c_id}.zip",
+                               "application/zip", use_container_width=True)
+            files = bundle[3]['files']; missing = [f['file'] for f in files if f['source'] in ('missing', 'error')]
+            st.caption(f"{len(files) - len(missing)} files in {bundle[3]['build_seconds']}s ({sum(f['source'] == 'cache' for f in files)} from cache)" + (f" · not available: {', '.join(missing)}" if missing else ""))
 
     # Files
     with st.expander("📂 Files & Downloads", expanded=True):
         c1, c2, c3 = st.columns(3)
         with c1:
-            orig_csv = io.BytesIO()
-            if isinstance(pkg.get('original_data', None), pd.DataFrame) and not pkg['original_data'].empty: pkg['original_data'].to_csv(orig_csv, index=False)
-            st.download_button("⬇ Consignment CSV (Raw)", orig_csv.getvalue(), f"{c_id}.csv", "text/csv")
-        with c2: st.download_button("⬇ Consignment Data PDF", generate_consignment_data_pdf(pkg['data'], pkg), f"Data_{c_id}.pdf")
-        with c3: st.download_button("⬇ Confirm CSV", generate_confirm_consignment_csv(pkg['data']), f"Confirm_{c_id}.csv", "text/csv")
+            st.download_button("⬇ Consignment CSV (Raw)", doc('raw_csv'), f"{c_id}.csv", "text/csv")
+        with c2: st.download_button("⬇ Consignment Data PDF", doc('data_pdf'), f"Data_{c_id}.pdf", "application/pdf")
+        with c3: st.download_button("⬇ Confirm CSV", doc('confirm_csv'), f"Confirm_{c_id}.csv", "text/csv")
     
     c1, c2 = st.columns(2)
-    with c1: st.download_button("⬇ Product Labels (Bartender)", generate_bartender_full(pkg['data']), f"Bartender_All_{c_id}.xlsx")
-    with c2: st.download_button("⬇ Ewaybill Data (Excel)", generate_excel_simple(pkg['data'], ['SKU Id', 'Editable Qty', 'Cost Price'], f"Eway_{c_id}.xlsx"), f"Eway_{c_id}.xlsx")
+    with c1:
+        bt_mode = st.radio("Bartender Rows", ["Per SKU", "Per Unit", "Per Label Sheet"], horizontal=True, key='bt_mode')
+        if bt_mode == "Per SKU":
+            st.download_button("⬇ Product Labels (Bartender)", doc('bartender'), f"Bartender_All_{c_id}.xlsx", XLSX_MIME)
+        else:
+            per_sheet = 1
+            if bt_mode == "Per Label Sheet":
+                per_sheet = st.number_input("Labels per Sheet", min_value=1, value=2, key='bt_per_sheet')
+            unit_csv = lambda df=pkg['data'], key=(c_id, f'bartender_units_{per_sheet}', fp), n=per_sheet: cached_artifact(
+                key, lambda: generate_bartender_full(df, per_unit=True, per_sheet=n, fmt='csv'))[0]
+            st.download_button("⬇ Product Labels (Bartender CSV)", unit_csv, f"Bartender_Units_{c_id}.csv", "text/csv")
+    with c2: st.download_button("⬇ Ewaybill Data (Excel)", doc('eway'), f"Eway_{c_id}.xlsx", XLSX_MIME)
+
+    with st.expander("🏷️ Unit Barcode Labels (PDF)", expanded=False):
+        lc1, lc2, lc3 = st.columns(3)
+        lbl_layout = lc1.selectbox("Layout", list(LABEL_LAYOUTS.keys()), key='unit_lbl_layout')
+        lbl_sym = lc2.selectbox("Barcode", ['auto', 'EAN13', 'Code128'], key='unit_lbl_sym')
+        if lc3.button("Generate Unit Labels", use_container_width=True):
+            with st.spinner("Generating labels..."):
+                st.session_state['unit_labels_pdf'] = (c_id, generate_unit_labels_pdf(pkg['data'], lbl_layout, lbl_sym))
+        ul = st.session_state.get('unit_labels_pdf')
+        if ul and ul[0] == c_id: st.download_button("⬇ Download Unit Labels PDF", ul[1], f"Unit_Labels_{c_id}.pdf", "application/pdf")
 
     # Labels Merge - FIXED
     st.divider()
@@ -1160,32 +3653,45 @@ elif st.session_state['page'] == 'view_saved':
     
     with uc1:
         f_lbl = st.file_uploader("Upload Flipkart Box Labels PDF", type=['pdf'], key='u_lbl')
+        merge_cancel = st.session_state.get('merge_cancel')
+        if merge_cancel is not None and merge_cancel.is_set():
+            st.session_state.pop('merge_cancel')
+            st.toast("Label merge cancelled", icon="🚫")
         if f_lbl:
-            if st.button("Process & Merge Labels"):
-                # 1. Process IN MEMORY
-                raw_bytes = f_lbl.getvalue()
+            mb1, mb2 = st.columns(2)
+            if mb2.button("⏳ Merge in Background", help="Saves the source labels and merges them on the server; keeps running if you leave or refresh the page"):
+                if StorageHandler.upload_large_file(f"{c_id}_box_labels.pdf", f_lbl, "Source Labels"):
+                    job_scheduler().submit('merge_labels', {'c_id': c_id}, station=station_id()); st.toast("Label merge queued")
+                else: st.error("Could not save the source labels.")
+            if mb1.button("Process & Merge Labels"):
+                # 1. Merge into a temp file; the merge polls this session's cancel flag, which the Cancel
+                # button (or leaving the page mid-merge) sets
                 progress_bar = st.progress(0, text="Merging Labels...")
-                snd = pkg.get('sender', {}); rcv = pkg.get('receiver', {})
-                
-                merged_bytes = generate_merged_box_labels(pkg['data'], pkg, snd, rcv, raw_bytes, progress_bar)
+                merge_cancel = st.session_state['merge_cancel'] = threading.Event()
+                st.button("✖ Cancel Merge", key='cancel_merge', on_click=merge_cancel.set)
+                merged = merge_labels_in_session(pkg, f_lbl, progress_bar, merge_cancel)
                 
-                if merged_bytes:
-                    # 2. Save Results to Cloud in Background
-                    try:
-                        StorageHandler.upload_file(f"{c_id}_box_labels.pdf", raw_bytes, "Source Labels")
-                        StorageHandler.upload_file(f"{c_id}_merged_labels.pdf", merged_bytes, "Merged Labels")
+                if merged is not None:
+                    # 2. Save source and merged labels to cloud, streamed in parts from the files
+                    with merged:
+                        try:
+                            saved = (StorageHandler.upload_large_file(f"{c_id}_box_labels.pdf", f_lbl, "Source Labels")
+                                     and StorageHandler.upload_large_file(f"{c_id}_merged_labels.pdf", merged, "Merged Labels"))
+                        except Exception: saved = False
+                    st.session_state.pop('merge_cancel', None)
+                    if saved:
                         st.success("Merged & Saved!")
                         time.sleep(1)
                         st.rerun()
-                    except:
-                        st.warning("Merged successfully but failed to save to cloud. You can still download/print.")
+                    st.warning("Merged successfully but failed to save to cloud. Please try again.")
                 else:
                     st.error("Merge failed.")
 
     with uc2:
-        path_merged = get_merged_labels_bytes(c_id)
-        if path_merged:
-            st.download_button("⬇ Download MERGED PDF", path_merged, f"Merged_{c_id}.pdf", "application/pdf")
+        render_jobs_panel(['merge_labels', 'prefetch'], c_id)
+        if get_stored_file_exists(c_id, 'merged_labels'):
+            # Fetched only when clicked; the page itself never downloads the merged file
+            st.download_button("⬇ Download MERGED PDF", lambda: get_stored_file_bytes(c_id, 'merged_labels'), f"Merged_{c_id}.pdf", "application/pdf")
             if st.button("🖨️ SCAN & PRINT MODE", type="primary", use_container_width=True): nav('scan_print')
         else:
             st.info("Upload and merge labels to enable printing.")
@@ -1197,75 +3703,71 @@ elif st.session_state['page'] == 'view_saved':
         f_apt = st.file_uploader("Upload Appt PDF", type=['pdf'], key='u_apt')
         if f_apt:
             if st.button("Save Appt"): save_uploaded_file(f_apt, c_id, 'appointment'); st.rerun()
-        path_apt = get_stored_file_bytes(c_id, 'appointment')
-        if path_apt: st.download_button("⬇ Download Appt", path_apt, f"Appt_{c_id}.pdf")
-        else: st.download_button("⬇ Generate Appointment Letter", generate_appointment_letter(pkg, pkg.get('sender',{}), pkg.get('receiver',{})), f"Appt_Gen_{c_id}.pdf")
+        # Stored upload if there is one, otherwise the generated letter (cached like the bundle's copy)
+        if get_stored_file_exists(c_id, 'appointment'):
+            st.download_button("⬇ Download Appt", doc('appointment'), f"Appt_{c_id}.pdf", "application/pdf")
+        else:
+            st.download_button("⬇ Generate Appointment Letter", doc('appointment'), f"Appt_Gen_{c_id}.pdf", "application/pdf")
 
     with c_chal:
         f_ch = st.file_uploader("Upload Challan PDF", type=['pdf'], key='u_ch')
         if f_ch:
             if st.button("Save Challan"): save_uploaded_file(f_ch, c_id, 'challan'); st.rerun()
-        path_ch = get_stored_file_bytes(c_id, 'challan')
-        if path_ch: st.download_button("⬇ Download Challan", path_ch, f"Challan_{c_id}.pdf")
-        else: st.download_button("⬇ Generate Challan", generate_challan(pkg['data'], pkg, pkg.get('sender',{}), pkg.get('receiver',{})), f"Challan_Gen_{c_id}.pdf")
+        if get_stored_file_exists(c_id, 'challan'):
+            st.download_button("⬇ Download Challan", doc('challan'), f"Challan_{c_id}.pdf", "application/pdf")
+        else:
+            st.download_button("⬇ Generate Challan", doc('challan'), f"Challan_Gen_{c_id}.pdf", "application/pdf")
 
     st.divider()
     st.subheader("4. Edit Qty in Consignment (Available Boxes)")
     st.info("Download the Excel, modify 'Available Box (Edit)', and upload to update the consignment. Set boxes to 0 if inventory is missing.")
     c_edit_1, c_edit_2, c_edit_3 = st.columns(3)
     with c_edit_1:
-        edit_buffer = io.BytesIO()
-        edit_export = pkg['data'][['SKU Id', 'Editable Qty', 'Editable Boxes']].copy()
-        edit_export = edit_export.rename(columns={'Editable Qty': 'Original Qty', 'Editable Boxes': 'Box Qty'})
-        edit_export['Available Box (Edit)'] = edit_export['Box Qty']
-        edit_export = edit_export.sort_values(by='SKU Id', key=lambda col: col.str.upper())
-        with pd.ExcelWriter(edit_buffer, engine='xlsxwriter') as writer:
-            edit_export.to_excel(writer, index=False, sheet_name='Sheet1')
-            workbook = writer.book; worksheet = writer.sheets['Sheet1']
-            worksheet.set_column(0, 0, 40); worksheet.set_column(1, 3, 20)
-        st.download_button("⬇ Download Edit Excel", edit_buffer.getvalue(), f"Edit_Inventory_{c_id}.xlsx", "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
+        edit_src = pkg['data']
+        edit_order = np.argsort(edit_src['SKU Id'].astype(str).str.upper().to_numpy(), kind='stable')
+        edit_xlsx = export_xlsx([xlsx_sheet('Sheet1', edit_src, ['SKU Id', ('Original Qty', 'Editable Qty'), ('Box Qty', 'Editable Boxes'), ('Available Box (Edit)', 'Editable Boxes')], rows=edit_order, widths={'SKU Id': 40, 'Original Qty': 20, 'Box Qty': 20, 'Available Box (Edit)': 20})])
+        st.download_button("⬇ Download Edit Excel", edit_xlsx, f"Edit_Inventory_{c_id}.xlsx", XLSX_MIME)
     with c_edit_2:
         up_edit = st.file_uploader("Upload Edited Excel", type=['xlsx'], key='up_edit_inv')
         if up_edit:
             if st.button("✅ Confirm & Update Consignment"):
                 try:
-                    prog_bar = st.progress(0, text="Reading File..."); time.sleep(0.3)
                     new_df = pd.read_excel(up_edit)
-                    required_cols = ['SKU Id', 'Available Box (Edit)']
-                    if not all(col in new_df.columns for col in required_cols):
-                        st.error("Uploaded file missing required columns: 'SKU Id', 'Available Box (Edit)'"); prog_bar.empty()
+                    if not all(col in new_df.columns for col in ['SKU Id', 'Available Box (Edit)']):
+                        st.error("Uploaded file missing required columns: 'SKU Id', 'Available Box (Edit)'")
                     else:
-                        prog_bar.progress(40, text="Applying Logic...")
-                        if 'backup_data' not in pkg or not isinstance(pkg['backup_data'], pd.DataFrame) or pkg['backup_data'].empty:
-                             pkg['backup_data'] = pkg['data'].copy()
-                        curr_data = pkg['data'].copy()
-                        box_map = dict(zip(new_df['SKU Id'].astype(str), new_df['Available Box (Edit)']))
-                        for idx, row in curr_data.iterrows():
-                            sku = str(row['SKU Id'])
-                            if sku in box_map:
-                                new_boxes = int(float(box_map[sku]))
-                                ppcn = int(float(row['PPCN'])) if row['PPCN'] > 0 else 1
-                                curr_data.at[idx, 'Editable Boxes'] = new_boxes
-                                curr_data.at[idx, 'Editable Qty'] = new_boxes * ppcn
-                        pkg['data'] = curr_data
-                        pkg['edit_timestamp'] = pd.Timestamp.now().strftime('%d-%b-%Y %I:%M %p')
-                        prog_bar.progress(80, text="Saving..."); time.sleep(0.2)
-                        for i, h in enumerate(st.session_state['consignments']):
-                            if h['id'] == c_id: st.session_state['consignments'][i] = pkg
-                        save_history(st.session_state['consignments'])
-                        prog_bar.progress(100, text="Done!"); time.sleep(0.5)
-                        st.success("Consignment Updated! Generator files (Section 1) are now updated."); st.rerun()
+                        delta = compute_box_edit(pkg['data'], new_df)
+                        if delta is None: st.info("No box counts differ from the current version; nothing to update.")
+                        else:
+                            record_edit(pkg, delta, edit_author(), up_edit.name)
+                            put_consignment(pkg); save_history(st.session_state['consignments'])
+                            st.success(f"Consignment updated to version {edit_head(pkg)} ({len(delta['row'])} rows). Generator files (Section 1) are now updated."); st.rerun()
                 except Exception as e: st.error(f"Error reading file: {e}")
     with c_edit_3:
+        head, n_edits = edit_head(pkg), len(pkg.get('edits', []))
+        valid = edit_history_valid(pkg)
+        u1, u2 = st.columns(2)
+        for col, label, target, enabled in [(u1, "↩️ Undo", head - 1, head > 0), (u2, "↪️ Redo", head + 1, head < n_edits)]:
+            if col.button(label, disabled=not (valid and enabled), use_container_width=True):
+                checkout_edit_version(pkg, target)
+                put_consignment(pkg); save_history(st.session_state['consignments']); st.rerun()
         if st.button("🗑️ Delete Uploaded Data (Reset)"):
-            if 'backup_data' in pkg and isinstance(pkg['backup_data'], pd.DataFrame) and not pkg['backup_data'].empty:
-                pkg['data'] = pkg['backup_data'].copy(); pkg['backup_data'] = pd.DataFrame()
-                pkg.pop('edit_timestamp', None)
-                for i, h in enumerate(st.session_state['consignments']):
-                    if h['id'] == c_id: st.session_state['consignments'][i] = pkg
-                save_history(st.session_state['consignments'])
-                st.success("Consignment reset to original state."); st.rerun()
-            else: st.warning("No backup data found. Cannot reset (or data is already original).")
+            if valid and head > 0:
+                checkout_edit_version(pkg, 0)
+                put_consignment(pkg); save_history(st.session_state['consignments'])
+                st.success("Consignment reset to original state (edits kept for redo)."); st.rerun()
+            else: st.warning("No edits applied. Cannot reset (or data is already original).")
+    if pkg.get('edits'):
+        with st.expander(f"🕓 Edit History (version {edit_head(pkg)} of {len(pkg['edits'])})"):
+            if not edit_history_valid(pkg): st.warning("Consignment rows changed since these edits were recorded; versions can no longer be restored.")
+            st.dataframe(edit_log_frame(pkg), hide_index=True, use_container_width=True)
+            v_sel = st.selectbox("Inspect version", list(range(len(pkg['edits']), -1, -1)), format_func=lambda v: f"v{v}" + (" (original)" if v == 0 else ""), key=f"edit_v_{c_id}")
+            if v_sel and edit_history_valid(pkg):
+                e = pkg['edits'][v_sel - 1]
+                st.dataframe(pd.DataFrame({'SKU Id': e['sku'], 'Boxes Before': e['old_boxes'], 'Boxes After': e['new_boxes'], 'Qty Before': e['old_qty'], 'Qty After': e['new_qty']}), hide_index=True, use_container_width=True)
+            if st.button(f"⏪ Restore v{v_sel}", disabled=not edit_history_valid(pkg) or v_sel == edit_head(pkg)):
+                checkout_edit_version(pkg, v_sel)
+                put_consignment(pkg); save_history(st.session_state['consignments']); st.rerun()
 
     st.divider()
     with st.expander("🚫 Danger Zone"):
@@ -1276,7 +3778,8 @@ elif st.session_state['page'] == 'view_saved':
 # 7. SCAN & PRINT PAGE
 elif st.session_state['page'] == 'scan_print':
     pkg = st.session_state['curr_con']; c_id = pkg['id']
-    merged_pdf_bytes = get_merged_labels_bytes(c_id)
+    # Labels are streamed to a spool once per page run; the scan fragment reads single pages from it
+    label_reader = open_label_reader(c_id)
 
     c_back, c_spacer, c_print = st.columns([1, 4, 2])
     with c_back:
@@ -1287,70 +3790,35 @@ elif st.session_state['page'] == 'scan_print':
     st.divider()
 
     # Prepare Data
-    if 'scan_box_data' not in st.session_state or st.session_state.get('scan_c_id') != c_id:
-        box_data = []
-        active_df = pkg['data'][pkg['data']['Editable Boxes'] > 0].sort_values(by='SKU Id')
-        zero_df = pkg['data'][pkg['data']['Editable Boxes'] == 0].sort_values(by='SKU Id')
-        current_box = 1
-        for _, row in active_df.iterrows():
-            try: boxes = int(row['Editable Boxes'])
-            except: boxes = 0
-            for _ in range(boxes):
-                box_data.append({'Box No': current_box, 'SKU': str(row['SKU Id']), 'FSN': str(row.get('FSN','')), 'EAN': str(row.get('EAN',''))})
-                current_box += 1
-        if not zero_df.empty:
-            for _ in range(math.ceil(len(zero_df)/20)):
-                box_data.append({'Box No': current_box, 'SKU': "MIX SKU", 'FSN': "MIX FSN", 'EAN': ""})
-                current_box += 1
-        st.session_state['scan_box_data'] = pd.DataFrame(box_data)
-        st.session_state['scan_c_id'] = c_id
+    # Shares the cached box manifest with the Confirm CSV and merged labels, so numbering always agrees
+    st.session_state['scan_box_data'] = box_manifest(pkg['data'])['boxes'][['Box No', 'SKU', 'FSN', 'EAN']]
 
     # RENDER FRAGMENT
-    if merged_pdf_bytes:
-        render_scan_interface(st.session_state['scan_box_data'], pkg, merged_pdf_bytes)
+    if label_reader is not None:
+        render_claim_progress(c_id, len(st.session_state['scan_box_data']))
+        render_scan_interface(st.session_state['scan_box_data'], pkg, label_reader)
     else:
         st.error("Merged PDF not found. Please merge labels first.")
 
 # ---------------- History Page ----------------
 if st.session_state['page'] == 'history':
     st.title("Task History")
-    tasks = st.session_state.get('consignments', [])
     tabs = st.tabs(["New Task", "Planning", "Execution", "Booked Summary"])
     # ... [Tabs 0, 1 same]
     with tabs[0]:
         st.header("Create New Task")
         if st.button("➕ New Plan (Flipkart)"):
             st.session_state['plan_channel'] = 'Flipkart'; nav('plan_flipkart')
+        for ch in ('Amazon', 'Myntra'):
+            if st.button(f"➕ New Plan ({ch})"):
+                st.session_state['plan_channel'] = ch; nav('plan_generic')
     with tabs[1]:
         st.header("Planning Tasks")
-        planning = [t for t in tasks if t.get('task_type') == 'planning']
-        if not planning: st.info("No planning tasks yet.")
-        else:
-            for t in planning:
-                st.subheader(f"Task: {t['id']} | Date: {t.get('date','-')} | Channel: {t.get('channel','-')}")
-                if isinstance(t.get('data', None), pd.DataFrame):
-                    df_preview = t['data'].copy()
-                    if 'Qty_Booked' not in df_preview.columns: df_preview['Qty_Booked'] = 0
-                    st.dataframe(df_preview.head(6), use_container_width=True)
-                if st.button(f"Open {t['id']}", key=f"open_plan_{t['id']}"):
-                    st.session_state['plan_task_id'] = t['id']
-                    st.session_state['plan_results'] = t.get('data', pd.DataFrame()).copy()
-                    st.session_state['plan_summary'] = t.get('original_data', pd.DataFrame()).copy() if isinstance(t.get('original_data', None), pd.DataFrame) else pd.DataFrame()
-                    ed = st.session_state['plan_results'].copy() if isinstance(st.session_state['plan_results'], pd.DataFrame) else pd.DataFrame()
-                    if 'Select' not in ed.columns: ed.insert(0, 'Select', True)
-                    if 'Qty_Booked' not in ed.columns: ed['Qty_Booked'] = 0
-                    for c in ['Editable Boxes','Editable Qty','PPCN','Stock','Required Qty','Qty_Booked']:
-                        if c in ed.columns: ed[c] = pd.to_numeric(ed[c], errors='coerce').fillna(0).astype(int)
-                    if 'SKU Id' in ed.columns: ed = ed.sort_values(by='SKU Id', key=lambda s: s.str.upper()).reset_index(drop=True)
-                    st.session_state['plan_editor_df'] = ed.reset_index(drop=True)
-                    st.session_state['plan_mode_key'] = t.get('mode_key', 'single')
-                    st.session_state['plan_channel'] = t.get('channel', 'Flipkart')
-                    nav('plan_flipkart')
+        render_history_list('planning')
     with tabs[2]:
         st.header("Execution (Shipments / Manual) Tasks")
-        execs = [t for t in tasks if t.get('task_type') == 'execution']
         # Use fragment for smooth scrolling/clicking
-        render_history_list(execs) 
+        render_history_list('execution')
     with tabs[3]:
         st.header("Booked Summary")
         booked_details, available_dates = compute_booked_details_from_history()
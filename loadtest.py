@@ -0,0 +1,364 @@
+"""Concurrent-session load test for app.py.
+
+Drives N simulated Streamlit sessions (AppTest) through packing-station and planner flows against an in-process
+stand-in for the GitHub storage repo, at increasing concurrency, and reports rerun latency percentiles, storage
+API call counts and memory per session.
+
+    python loadtest.py --levels 1,2,4,8 --rounds 2 --storage-latency 80
+
+Stations open a consignment from history, merge labels, scan a burst of boxes and save progress; planners
+generate a plan, re-plan what-if scenarios and browse/search history. AppTest cannot drive st.file_uploader, so
+the upload-backed steps (plan generation, label merge) call the same app functions the button handlers call
+and are reported as `op:` steps next to the reruns.
+
+AppTest swaps process-wide state (the Runtime singleton, st.secrets, config) for the duration of each run, so
+two sessions' reruns cannot overlap in one process: reruns are serialized on APPTEST_LOCK and timed from when
+the lock is acquired, while the `op:` steps and background work still run concurrently. Session state is
+reported as the bytes a session owns; objects it shares with the process-wide consignment store are not
+counted.
+"""
+import argparse
+import base64
+import contextlib
+import gc
+import hashlib
+import io
+import json
+import logging
+import os
+import pickle
+import random
+import resource
+import sys
+import tempfile
+import threading
+import time
+import warnings
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+import github
+from github import GithubException
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+APP_PATH = os.path.join(APP_DIR, "app.py")
+REPO_NAME = "loadtest/local"
+APPTEST_LOCK = threading.Lock()
+INLINE_LIMIT = 1024 * 1024  # contents API only inlines files below 1 MB
+STATES = ['Maharashtra', 'Karnataka', 'Delhi', 'Uttar Pradesh', 'West Bengal', 'Tamil Nadu', 'Gujarat', 'Telangana', 'Rajasthan', 'Kerala']
+
+# --- LOCAL STORAGE STAND-IN ---
+def _git_sha(data):
+    return hashlib.sha1(f"blob {len(data)}\0".encode() + data).hexdigest()
+
+class _Contents:
+    def __init__(self, path, data):
+        self.path = path; self.sha = _git_sha(data); self.size = len(data)
+        inline = len(data) < INLINE_LIMIT
+        self.encoding = 'base64' if inline else 'none'
+        self.content = base64.b64encode(data).decode() if inline else ''
+        self.decoded_content = data if inline else b''
+
+class _Blob:
+    def __init__(self, data):
+        self.size = len(data); self.content = base64.b64encode(data).decode()
+
+class LocalRepo:
+    """The subset of PyGithub's Repository that StorageHandler uses, kept in memory with GitHub's sha / conflict
+    semantics, an optional per-call latency and a per-method call counter."""
+    def __init__(self, latency=0.0):
+        self.files = {}; self.latency = latency; self.calls = Counter(); self.lock = threading.Lock()
+
+    def _call(self, name):
+        with self.lock: self.calls[name] += 1
+        if self.latency: time.sleep(self.latency)
+
+    def seed(self, path, data):
+        self.files[path] = data if isinstance(data, bytes) else data.encode('utf-8')
+
+    def get_contents(self, path):
+        self._call('get_contents')
+        with self.lock: data = self.files.get(path)
+        if data is None: raise GithubException(404, {'message': 'Not Found'}, None)
+        return _Contents(path, data)
+
+    def get_git_blob(self, sha):
+        self._call('get_git_blob')
+        with self.lock: data = next((d for d in self.files.values() if _git_sha(d) == sha), None)
+        if data is None: raise GithubException(404, {'message': 'Not Found'}, None)
+        return _Blob(data)
+
+    def create_file(self, path, message, content):
+        self._call('create_file')
+        data = content if isinstance(content, bytes) else bytes(content) if isinstance(content, (bytearray, memoryview)) else content.encode('utf-8')
+        with self.lock:
+            if path in self.files: raise GithubException(422, {'message': 'sha wasn\'t supplied'}, None)
+            self.files[path] = data
+        return {'content': _Contents(path, data)}
+
+    def update_file(self, path, message, content, sha):
+        self._call('update_file')
+        data = content if isinstance(content, bytes) else bytes(content) if isinstance(content, (bytearray, memoryview)) else content.encode('utf-8')
+        with self.lock:
+            if path not in self.files: raise GithubException(404, {'message': 'Not Found'}, None)
+            if _git_sha(self.files[path]) != sha: raise GithubException(409, {'message': 'does not match'}, None)
+            self.files[path] = data
+        return {'content': _Contents(path, data)}
+
+    def delete_file(self, path, message, sha):
+        self._call('delete_file')
+        with self.lock:
+            if path not in self.files: raise GithubException(404, {'message': 'Not Found'}, None)
+            del self.files[path]
+
+REPO = LocalRepo()
+
+class LocalGithub:
+    """Replaces github.Github so `Github(token).get_repo(name)` in app.py returns REPO."""
+    def __init__(self, *args, **kwargs): pass
+    def get_repo(self, name): return REPO
+
+# --- SEED DATA ---
+def seed_storage(n_consignments, seed=0):
+    """Master data, addresses and a history of the sample consignment cloned to `n_consignments` (execution and
+    planning tasks). Returns the execution template record."""
+    rng = random.Random(seed)
+    for name in ("master_data.csv", "senders.xlsx", "receivers.xlsx"):
+        with open(os.path.join(APP_DIR, name), 'rb') as f: REPO.seed(name, f.read())
+    with open(os.path.join(APP_DIR, "consignment_history.json")) as f: sample = json.load(f)[0]
+    master = pd.read_csv(os.path.join(APP_DIR, "master_data.csv"), dtype=str)
+    history = []
+    for i in range(n_consignments):
+        h = json.loads(json.dumps(sample)); h.pop('backup_data', None)
+        h['id'] = str(int(sample['id']) + i) if i else sample['id']
+        h['date'] = str((pd.Timestamp('2026-01-01') + pd.Timedelta(days=rng.randrange(280))).date())
+        h['channel'] = rng.choice(['Flipkart', 'Amazon', 'Myntra']); h['printed_boxes'] = []
+        if i % 4 == 3:
+            rows = master.sample(40, random_state=i)
+            h['task_type'] = 'planning'; h['is_booked'] = False; h['mode_key'] = 'single'
+            h['data'] = [{'SKU Id': s, 'Zone': rng.choice(['North', 'South', 'East', 'West']), 'Editable Qty': int(p or 0) * 2, 'Editable Boxes': 2, 'PPCN': int(p or 0), 'Stock': 100} for s, p in zip(rows['SKU'], rows['PPCN'].fillna('0'))]
+            h['original_data'] = []
+        history.append(h)
+    REPO.seed("consignment_history.json", json.dumps(history, default=str))
+    template = pd.DataFrame({'SKU': master['SKU'], 'PPCN': master['PPCN']})
+    REPO.seed("active_listing_single.csv", template.to_csv(index=False))
+    return sample
+
+def synthetic_uploads(rows, seed):
+    """A month of sales and the matching inventory export, shaped like the Flipkart reports."""
+    rng = np.random.default_rng(seed)
+    skus = pd.read_csv(os.path.join(APP_DIR, "master_data.csv"), dtype=str)['SKU'].to_numpy()
+    sales = pd.DataFrame({'SKU': rng.choice(skus, rows), 'Quantity': rng.integers(1, 4, rows), 'Delivery State': rng.choice(STATES, rows)})
+    inv = pd.DataFrame({'SKU': skus, 'Live on Website': rng.integers(0, 80, len(skus)).astype(str)})
+    return sales, inv
+
+# --- SESSIONS ---
+def _value_bytes(v):
+    if isinstance(v, pd.DataFrame): return int(v.memory_usage(deep=True).sum())
+    try: return len(pickle.dumps(v))
+    except Exception: return sys.getsizeof(v)
+
+def stores():
+    """Every ConsignmentStore in the process: the sessions run app.py as __main__, so their cached store is not
+    the one of the bare-mode `app` import."""
+    return [o for o in gc.get_objects() if type(o).__name__ == 'ConsignmentStore']
+
+def state_bytes(at):
+    """{session_state key: bytes this session owns}. The history base and unedited records are references to
+    the consignment store's objects and are skipped, as are the entries of lists and dicts shared with it by
+    identity (a session one version behind still shares every unchanged record)."""
+    shared = set()
+    for store in stores():
+        shared |= {id(store.base)} | {id(r) for r in store.records.values()} | {id(r) for r in store.base.values()}
+    sizes = {}
+    for k, v in at.session_state._state.filtered_state.items():
+        if id(v) in shared: continue
+        if isinstance(v, list) and any(id(x) in shared for x in v): v = [x for x in v if id(x) not in shared]
+        if isinstance(v, dict) and any(id(x) in shared for x in v.values()):
+            v = {i: x for i, x in v.items() if id(x) not in shared}
+        sizes[k] = _value_bytes(v)
+    return sizes
+
+class Session:
+    """One simulated browser session: an AppTest plus the latencies of every rerun / op it performed."""
+    def __init__(self, name, timeout):
+        from streamlit.testing.v1 import AppTest
+        self.name = name; self.samples = []; self.errors = []
+        self.at = AppTest.from_file(APP_PATH, default_timeout=timeout)
+        self.at.secrets['github_token'] = 'local'; self.at.secrets['repo_name'] = REPO_NAME
+
+    def step(self, label, action, serialize=False):
+        with APPTEST_LOCK if serialize else contextlib.nullcontext():
+            t0 = time.perf_counter()
+            try: action()
+            except Exception as e: self.errors.append(f"{label}: {e}")
+            self.samples.append((label, time.perf_counter() - t0))
+        for e in self.at.exception: self.errors.append(f"{label}: {str(e.value)[:200]}")
+
+    def rerun(self, label, widget=None):
+        self.step(label, (widget.run if widget is not None else self.at.run), serialize=True)
+
+    def widget(self, label, kind, key):
+        """The `kind` widget (e.g. 'text_input') with `key`, rerunning once if it has not rendered yet (fragments
+        such as the scan input fill in after the page body); None, recorded as an error, if it still is missing."""
+        for attempt in range(2):
+            try: return getattr(self.at, kind)(key=key)
+            except KeyError:
+                if not attempt: self.rerun(f"{label}:wait")
+        self.errors.append(f"{label}: {kind} {key} not rendered")
+        return None
+
+    def button(self, label, key=None, text=None):
+        match = [b for b in self.at.button if (key and b.key == key) or (text and b.label == text)]
+        if not match: self.errors.append(f"{label}: button {key or text} not rendered"); return False
+        self.rerun(label, match[0].click()); return True
+
+def station_flow(s, app, sample, scans):
+    """History -> open consignment -> merge labels -> scan burst -> save progress."""
+    c_id = sample['id']
+    s.at.session_state['page'] = 'history'; s.rerun('history:load')
+    search = s.widget('history:search', 'text_input', 'hist_execution_q')
+    if search is None: return
+    s.rerun('history:search', search.input(c_id))
+    if not s.button('history:open', key=f"open_exec_{c_id}"): return
+    s.rerun('view_saved:render')
+    pkg = s.at.session_state['curr_con']
+    with open(os.path.join(APP_DIR, f"{c_id}_box_labels.pdf"), 'rb') as f: raw = f.read()
+    def merge():
+        with app.generate_merged_box_labels(pkg['data'], pkg, pkg.get('sender', {}), pkg.get('receiver', {}), raw) as merged:
+            app.StorageHandler.upload_large_file(f"{c_id}_merged_labels.pdf", merged, "Merged labels")
+    s.step('op:label_merge', merge)
+    s.rerun('view_saved:render')
+    if not s.button('scan:enter', text="🖨️ SCAN & PRINT MODE"): return
+    boxes = app.box_manifest(pkg['data'])['boxes']
+    codes = boxes.loc[boxes['Dummy Group'] < 0, 'SKU'].astype(str).tolist()
+    for code in random.Random(s.name).choices(codes, k=scans):
+        scan = s.widget('scan:box', 'text_input', 'scan_input')
+        if scan is None: return
+        s.rerun('scan:box', scan.input(code))
+    s.button('scan:save_progress', text="💾 Save Progress to Cloud")
+
+def planner_flow(s, app, uploads, whatifs):
+    """Plan generation -> what-if re-planning -> history browsing/search."""
+    sales, inv = uploads
+    box = {}
+    def generate():
+        inputs, msg = app.build_plan_inputs(sales.copy(), inv.copy(), 'single')
+        if inputs is None: raise RuntimeError(msg)
+        box['inputs'] = inputs; box['plan'] = app.allocate_plan(inputs, 1.0, False)
+    s.step('op:plan_generate', generate)
+    if 'plan' in box:
+        s.at.session_state['page'] = 'plan_flipkart'; s.at.session_state['plan_inputs'] = box['inputs']
+        s.at.session_state['plan_task_id'] = f"TASK_{int(time.time())}_{s.name}"
+        for key, df in zip(app.PLAN_STATE_KEYS, box['plan']):
+            if key: s.at.session_state[key] = df
+        s.at.session_state['plan_whatif_params'] = (1.0, False, 'single', (), (), ())
+        s.rerun('plan:render')
+        mult = [n for n in s.at.number_input if n.label == "Sales Multiplier"]
+        for m in [1.5, 2.0, 0.8][:whatifs]:
+            if mult: s.rerun('plan:whatif_multiplier', s.at.number_input(key=mult[0].key).set_value(m) if mult[0].key else mult[0].set_value(m))
+        if whatifs > 3 and box['inputs']['zones']: s.rerun('plan:whatif_zone', s.at.multiselect(key='wi_zones').select(box['inputs']['zones'][0]))
+    s.at.session_state['page'] = 'history'; s.rerun('history:load')
+    for q in ['569', '5690', '']:
+        search = s.widget('history:search', 'text_input', 'hist_execution_q')
+        if search is None: return
+        s.rerun('history:search', search.input(q))
+    sort = s.widget('history:sort', 'selectbox', 'hist_execution_sort')
+    if sort is not None: s.rerun('history:sort', sort.select_index(1))
+
+def run_level(n, args, app, sample):
+    """Runs n sessions concurrently (half stations, half planners) for args.rounds rounds."""
+    calls_before = Counter(REPO.calls); rss_before = rss_mb()
+    sessions = [Session(f"s{n}-{i}", args.timeout) for i in range(n)]
+    uploads = synthetic_uploads(args.sales_rows, seed=n)
+    def drive(i):
+        s = sessions[i]
+        for _ in range(args.rounds):
+            try:
+                if i % 2 == 0: station_flow(s, app, sample, args.scans)
+                else: planner_flow(s, app, uploads, args.whatifs)
+            except Exception as e: s.errors.append(f"flow aborted: {type(e).__name__}: {e}")
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=n) as pool: list(pool.map(drive, range(n)))
+    wall = time.perf_counter() - t0
+    calls = Counter(REPO.calls); calls.subtract(calls_before)
+    return {'sessions': n, 'wall_s': round(wall, 2), 'samples': [x for s in sessions for x in s.samples],
+            'errors': [e for s in sessions for e in s.errors], 'storage_calls': {k: v for k, v in calls.items() if v},
+            'rss_mb': round(rss_mb(), 1), 'rss_delta_mb': round(rss_mb() - rss_before, 1),
+            **state_report([state_bytes(s.at) for s in sessions])}
+
+def state_report(per_session):
+    """Mean owned session state per session, and the largest keys behind it."""
+    by_key = defaultdict(list)
+    for sizes in per_session:
+        for k, b in sizes.items(): by_key[k].append(b)
+    mean_kb = {k: round(sum(v) / len(per_session) / 1024, 1) for k, v in by_key.items()}
+    top = dict(sorted(mean_kb.items(), key=lambda kv: -kv[1])[:5])
+    return {'state_kb_per_session': round(np.mean([sum(s.values()) for s in per_session]) / 1024, 1),
+            'state_top_keys_kb': top}
+
+# --- REPORT ---
+def rss_mb():
+    try:
+        with open('/proc/self/status') as f:
+            return next(int(l.split()[1]) for l in f if l.startswith('VmRSS')) / 1024
+    except OSError: return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def percentiles(values):
+    v = np.asarray(values) * 1000
+    return {'n': len(v), 'p50': round(float(np.percentile(v, 50)), 1), 'p95': round(float(np.percentile(v, 95)), 1), 'p99': round(float(np.percentile(v, 99)), 1), 'max': round(float(v.max()), 1)} if len(v) else {'n': 0}
+
+def summarize(level):
+    reruns = [t for label, t in level['samples'] if not label.startswith('op:')]
+    by_step = defaultdict(list)
+    for label, t in level['samples']: by_step[label].append(t)
+    return {**{k: v for k, v in level.items() if k != 'samples'}, 'rerun_ms': percentiles(reruns), 'steps_ms': {k: percentiles(v) for k, v in sorted(by_step.items())}}
+
+def print_report(results):
+    print(f"\n{'sessions':>8} {'reruns':>7} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'max ms':>8} {'storage calls':>14} {'RSS MB':>8} {'state KB/sess':>14} {'errors':>7}")
+    for r in results:
+        q = r['rerun_ms']
+        print(f"{r['sessions']:>8} {q.get('n', 0):>7} {q.get('p50', 0):>8} {q.get('p95', 0):>8} {q.get('p99', 0):>8} {q.get('max', 0):>8} {sum(r['storage_calls'].values()):>14} {r['rss_mb']:>8} {r['state_kb_per_session']:>14} {len(r['errors']):>7}")
+    top = results[-1]
+    print(f"\nPer step at {top['sessions']} sessions (ms):")
+    for label, q in top['steps_ms'].items(): print(f"  {label:<28} n={q['n']:<5} p50={q['p50']:<9} p95={q['p95']:<9} p99={q['p99']}")
+    print(f"Storage calls at {top['sessions']} sessions: {dict(sorted(top['storage_calls'].items()))}")
+    print(f"Largest session state keys at {top['sessions']} sessions (KB): {top['state_top_keys_kb']}")
+    for e in top['errors'][:10]: print(f"  ! {e}")
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    ap.add_argument('--levels', default='1,2,4,8', help="comma-separated session counts")
+    ap.add_argument('--rounds', type=int, default=1, help="flow repetitions per session")
+    ap.add_argument('--scans', type=int, default=15, help="boxes scanned per station burst")
+    ap.add_argument('--whatifs', type=int, default=3, help="what-if re-plans per planner round")
+    ap.add_argument('--sales-rows', type=int, default=20000)
+    ap.add_argument('--consignments', type=int, default=60, help="records in the seeded history")
+    ap.add_argument('--storage-latency', type=float, default=0.0, help="ms added to every storage API call")
+    ap.add_argument('--timeout', type=float, default=120, help="seconds per rerun before AppTest gives up")
+    ap.add_argument('--json', help="also write the full report to this file")
+    args = ap.parse_args()
+    if args.json: args.json = os.path.abspath(args.json)
+
+    warnings.filterwarnings('ignore'); logging.disable(logging.CRITICAL)
+    workdir = tempfile.mkdtemp(prefix="hike_loadtest_"); os.chdir(workdir)  # claims DB and secrets stay out of the repo
+    os.environ.setdefault("HIKE_STATE_DIR", workdir)
+    os.makedirs(".streamlit"); open(".streamlit/secrets.toml", "w").write(f'github_token = "local"\nrepo_name = "{REPO_NAME}"\n')
+    github.Github = LocalGithub
+    REPO.latency = args.storage_latency / 1000
+    sample = seed_storage(args.consignments)
+    sys.path.insert(0, APP_DIR)
+    import app  # bare-mode import for the upload-backed ops; shares the seeded storage with the sessions
+
+    results = []
+    for n in [int(x) for x in args.levels.split(',') if x.strip()]:
+        print(f"running {n} concurrent session(s)...", flush=True)
+        results.append(summarize(run_level(n, args, app, sample)))
+    print_report(results)
+    if args.json:
+        with open(args.json, 'w') as f: json.dump(results, f, indent=2)
+
+if __name__ == '__main__':
+    main()
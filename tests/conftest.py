@@ -0,0 +1,48 @@
+"""Shared fixtures. app.py is a Streamlit script, so it is imported once in bare mode; storage goes to the
+in-memory LocalRepo from loadtest.py instead of GitHub."""
+import json
+import logging
+import os
+import sys
+import tempfile
+import warnings
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+# Keep the app's SQLite state files out of the checkout
+os.environ.setdefault("HIKE_STATE_DIR", tempfile.mkdtemp(prefix="hike_test_state_"))
+
+import loadtest  # noqa: E402
+
+
+@pytest.fixture(scope="session")
+def app():
+    warnings.filterwarnings("ignore")
+    logging.disable(logging.CRITICAL)
+    import app as module
+    return module
+
+
+@pytest.fixture
+def repo(app, monkeypatch):
+    """An empty storage repo behind StorageHandler, with a fresh shared consignment store."""
+    local = loadtest.LocalRepo()
+    monkeypatch.setattr(app.StorageHandler, "get_repo", staticmethod(lambda: local))
+    app.consignment_store.clear()
+    yield local
+    app.consignment_store.clear()
+
+
+def consignment(cid, **fields):
+    """A small serialised execution consignment as stored in the history file."""
+    rec = {'id': cid, 'date': '2026-03-02', 'channel': 'Flipkart', 'task_type': 'execution', 'is_booked': True, 'printed_boxes': [],
+           'data': [{'SKU Id': 'KBRV-1', 'Editable Qty': 8, 'Editable Boxes': 2, 'PPCN': 4},
+                    {'SKU Id': 'KBRV-2', 'Editable Qty': 0, 'Editable Boxes': 0, 'PPCN': 6}]}
+    rec.update(fields)
+    return rec
+
+
+def seed_history(repo, records):
+    repo.seed("consignment_history.json", json.dumps(records))
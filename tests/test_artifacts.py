@@ -0,0 +1,77 @@
+import hashlib
+import json
+import zipfile
+
+import pytest
+
+from conftest import consignment
+
+
+@pytest.fixture
+def pkg(app, repo):
+    app.artifact_cache.clear()
+    rec = consignment('A1', sender={'Code': 'MAIN', 'Address1': 'Addr', 'City': 'City'},
+                      receiver={'Code': 'BLR', 'Address1': 'FC', 'City': 'Bengaluru'})
+    yield app._hydrate_consignment(rec)
+    app.artifact_cache.clear()
+
+
+def count_calls(monkeypatch, app, name):
+    calls = []
+    real = getattr(app, name)
+    monkeypatch.setattr(app, name, lambda *a, **k: calls.append(1) or real(*a, **k))
+    return calls
+
+
+def test_bundle_spool_matches_manifest(app, pkg):
+    spool, manifest = app.build_consignment_bundle(pkg)
+    with spool, zipfile.ZipFile(spool) as zf:
+        assert json.loads(zf.read('manifest.json')) == json.loads(json.dumps(manifest, default=str))
+        for entry in manifest['files']:
+            if entry['source'] == 'missing': continue
+            data = zf.read(entry['file'])
+            assert (len(data), hashlib.sha256(data).hexdigest()) == (entry['bytes'], entry['sha256'])
+    sources = {e['kind']: e['source'] for e in manifest['files']}
+    assert sources['labels'] == 'missing' and sources['challan'] == 'generated'
+
+
+def test_large_bundle_spills_to_disk(app, pkg, monkeypatch):
+    monkeypatch.setattr(app, 'SPOOL_MEMORY_LIMIT', 1024)
+    spool, _ = app.build_consignment_bundle(pkg)
+    with spool:
+        assert spool._rolled and spool.tell() == 0
+        assert app.spool_bytes(spool)[:2] == b'PK'
+
+
+def test_fingerprint_passed_through(app, pkg, monkeypatch):
+    fp = app.artifact_fingerprint(pkg)
+    calls = count_calls(monkeypatch, app, 'artifact_fingerprint')
+    _, manifest = app.build_consignment_bundle(pkg, kinds=['confirm_csv'], fingerprint=fp)
+    app.artifact_bytes(pkg, 'confirm_csv', fp)
+    assert calls == [] and manifest['fingerprint'] == fp
+
+
+def test_generated_documents_come_from_the_cache(app, pkg, monkeypatch):
+    fp = app.artifact_fingerprint(pkg)
+    appt = count_calls(monkeypatch, app, 'generate_appointment_letter')
+    challan = count_calls(monkeypatch, app, 'generate_challan')
+    first = app.artifact_bytes(pkg, 'appointment', fp)
+    assert first.startswith(b'%PDF') and app.artifact_bytes(pkg, 'appointment', fp) == first
+    _, manifest = app.build_consignment_bundle(pkg, kinds=['appointment', 'challan'], fingerprint=fp)
+    app.artifact_bytes(pkg, 'challan', fp)
+    assert [e['source'] for e in manifest['files']] == ['cache', 'generated']
+    assert len(appt) == 1 and len(challan) == 1
+
+
+def test_stored_upload_wins_over_generated(app, pkg, repo):
+    repo.seed('A1_appointment.pdf', b'%PDF-uploaded')
+    assert app.artifact_bytes(pkg, 'appointment') == b'%PDF-uploaded'
+
+
+def test_cached_artifact_keys_units_csv(app, pkg):
+    build = lambda n: app.generate_bartender_full(pkg['data'], per_unit=True, per_sheet=n, fmt='csv')
+    one, source = app.cached_artifact(('A1', 'bartender_units_1', 'fp'), lambda: build(1))
+    assert source == 'generated' and isinstance(one, bytes)
+    assert app.cached_artifact(('A1', 'bartender_units_1', 'fp'), lambda: build(1)) == (one, 'cache')
+    two, _ = app.cached_artifact(('A1', 'bartender_units_2', 'fp'), lambda: build(2))
+    assert two != one
@@ -0,0 +1,90 @@
+import io
+
+import pandas as pd
+import pytest
+
+MASTER = pd.DataFrame({'SKU': ['KBRV-1', 'KBRV-2', 'KBRV-3', 'KBRV-4'], 'EAN': ['8901030865275', '4006381333931', '5901234123457', '9780201379624'],
+                       'UK Size': ['6', '7', '8', '9'], 'color': ['Black', 'Tan', 'Navy', 'Red'], 'MRP': [1999, 2499, 999, 1499]})
+
+
+@pytest.fixture
+def bartender(app, repo):
+    """Bartender exports with MASTER as the synced master data."""
+    repo.seed(app.CACHE_FILE, MASTER.to_csv(index=False))
+    app.master_data_index.clear()
+    yield app
+    app.master_data_index.clear()
+
+
+@pytest.fixture
+def consignment_df():
+    return pd.DataFrame({'SKU Id': ['KBRV-3', 'KBRV-1', 'KBRV-2', 'KBRV-4'], 'Editable Boxes': [2, 1, 0, 1],
+                         'Editable Qty': [23, 10, 12, 0], 'PPCN': [12, 10, 12, 6], 'FSN': ['F3', 'F1', 'F2', 'F4']})
+
+
+# The export as it was before the vectorised frame and per-unit rows, kept as the Per SKU reference.
+def generate_bartender_full_baseline(app, df):
+    active_df = df[df['Editable Boxes'] > 0].copy()
+    output = io.BytesIO(); master_df = app.load_master_data()
+    temp_df = active_df[['SKU Id', 'Editable Qty']].copy()
+    if 'FSN' in active_df.columns: temp_df['FSN_Temp'] = active_df['FSN']
+    elif 'Product Name' in active_df.columns: temp_df['FSN_Temp'] = active_df['Product Name']
+    else: temp_df['FSN_Temp'] = ''
+    export_df = pd.merge(temp_df, master_df, left_on='SKU Id', right_on='SKU', how='left')
+    if 'EAN' in export_df.columns: export_df['EAN'] = export_df['EAN'].astype(str).str.replace(r'\.0$', '', regex=True)
+    export_df['EAN'] = export_df.apply(lambda x: x['FSN_Temp'] if pd.isna(x.get('EAN')) else x['EAN'], axis=1)
+    export_df['QTY'] = export_df['Editable Qty']
+    if 'SKU' in export_df.columns: export_df['SKU'] = export_df['SKU'].fillna(export_df['SKU Id'])
+    else: export_df['SKU'] = export_df['SKU Id']
+    with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
+        export_df.to_excel(writer, index=False)
+    return output.getvalue()
+
+
+def read(data, fmt='xlsx'):
+    if fmt == 'csv': return pd.read_csv(io.BytesIO(data), dtype=str, keep_default_na=False)
+    return pd.read_excel(io.BytesIO(data), dtype=str, keep_default_na=False)
+
+
+def test_unit_rows_expand_and_drop_zero(app):
+    rows, qty = app.bartender_unit_rows([3, 0, 2, -4, float('nan')])
+    assert rows.tolist() == [0, 0, 0, 2, 2] and qty.tolist() == [1] * 5
+
+
+@pytest.mark.parametrize('per_sheet, expected', [(1, [1] * 8), (3, [3, 2, 3]), (5, [5, 3]), (10, [5, 3])])
+def test_unit_rows_sheet_remainders(app, per_sheet, expected):
+    rows, qty = app.bartender_unit_rows([5, 0, 3], per_sheet)
+    assert qty.tolist() == expected and qty.sum() == 8
+    assert rows.tolist() == [r for r, n in ((0, 5), (2, 3)) for _ in range(-(-n // per_sheet))]
+
+
+def test_per_sku_matches_baseline_export(bartender, consignment_df):
+    got = read(bartender.generate_bartender_full(consignment_df))
+    pd.testing.assert_frame_equal(got, read(generate_bartender_full_baseline(bartender, consignment_df)))
+    assert got['EAN'].tolist() == ['5901234123457', '8901030865275', '9780201379624']
+
+
+def test_missing_ean_falls_back_to_fsn(bartender, consignment_df):
+    # the baseline wrote the string 'nan' here: astype(str) ran before its isna() fallback
+    df = consignment_df.assign(**{'SKU Id': ['KBRV-3', 'KBRV-9', 'KBRV-2', 'KBRV-4']})
+    got = read(bartender.generate_bartender_full(df))
+    assert got['EAN'].tolist() == ['5901234123457', 'F1', '9780201379624']
+    assert got['SKU'].tolist() == ['KBRV-3', 'KBRV-9', 'KBRV-4']
+
+
+@pytest.mark.parametrize('fmt', ['xlsx', 'csv'])
+@pytest.mark.parametrize('per_sheet', [1, 4])
+def test_per_unit_preserves_units(bartender, consignment_df, fmt, per_sheet):
+    got = read(bartender.generate_bartender_full(consignment_df, per_unit=True, per_sheet=per_sheet, fmt=fmt), fmt)
+    qty = got['QTY'].astype(int)
+    assert qty.sum() == 33 and (qty <= per_sheet).all()
+    assert got.groupby('SKU Id', sort=False)['QTY'].apply(lambda s: s.astype(int).sum()).to_dict() == {'KBRV-3': 23, 'KBRV-1': 10}
+    assert 'KBRV-4' not in set(got['SKU Id'])  # boxes but no units
+    assert (got['Editable Qty'] == got['SKU Id'].map({'KBRV-3': '23', 'KBRV-1': '10'})).all()
+
+
+def test_csv_matches_xlsx(bartender, consignment_df):
+    for per_unit in (False, True):
+        xlsx = read(bartender.generate_bartender_full(consignment_df, per_unit, 4))
+        csv = read(bartender.generate_bartender_full(consignment_df, per_unit, 4, fmt='csv'), 'csv')
+        pd.testing.assert_frame_equal(csv, xlsx)
@@ -0,0 +1,95 @@
+import threading
+import time
+
+import pytest
+
+
+@pytest.fixture
+def db(tmp_path):
+    return str(tmp_path / "claims.sqlite3")
+
+
+@pytest.fixture
+def svc(app, db):
+    return app.BoxClaimService(db)
+
+
+def test_stations_get_different_boxes(svc):
+    assert svc.claim_next('C1', [1, 2, 3], 'a') == 1
+    assert svc.claim_next('C1', [1, 2, 3], 'b') == 2
+    # Re-scanning at the same station returns its own live claim
+    assert svc.claim_next('C1', [1, 2, 3], 'a') == 1
+    assert svc.progress('C1') == (set(), {1: 'a', 2: 'b'})
+
+
+def test_claims_are_per_consignment(svc):
+    assert svc.claim_next('C1', [1], 'a') == 1
+    assert svc.claim_next('C2', [1], 'b') == 1
+
+
+def test_printed_boxes_are_never_claimed_again(svc):
+    box = svc.claim_next('C1', [1, 2], 'a')
+    svc.mark_printed('C1', box, 'a')
+    assert svc.claim_next('C1', [1, 2], 'a') == 2
+    svc.mark_printed('C1', 2, 'a')
+    assert svc.claim_next('C1', [1, 2], 'b') is None
+    assert svc.progress('C1') == ({1, 2}, {})
+
+
+def test_expired_lease_is_reclaimed(app, db):
+    svc = app.BoxClaimService(db, lease_seconds=0.05)
+    assert svc.claim_next('C1', [1, 2], 'a') == 1
+    assert svc.claim_next('C1', [1, 2], 'b') == 2
+    time.sleep(0.1)
+    assert svc.progress('C1') == (set(), {})
+    assert svc.claim_next('C1', [1, 2], 'c') == 1
+
+
+def test_release_frees_only_own_claim(svc):
+    svc.claim_next('C1', [1], 'a')
+    svc.release('C1', 1, 'b')
+    assert svc.claim_next('C1', [1], 'b') is None
+    svc.release('C1', 1, 'a')
+    assert svc.claim_next('C1', [1], 'b') == 1
+
+
+def test_release_keeps_printed_box(svc):
+    svc.claim_next('C1', [1], 'a')
+    svc.mark_printed('C1', 1, 'a')
+    svc.release('C1', 1, 'a')
+    assert svc.progress('C1')[0] == {1}
+
+
+def test_seed_printed_keeps_existing_rows(svc):
+    svc.claim_next('C1', [1, 2, 3], 'a')
+    svc.seed_printed('C1', [2, 3])
+    printed, claimed = svc.progress('C1')
+    assert printed == {2, 3} and claimed == {1: 'a'}
+    svc.seed_printed('C1', [2, 3])
+    assert svc.claim_next('C1', [1, 2, 3], 'b') is None
+
+
+def test_racing_stations_never_print_a_box_twice(app, db):
+    boxes = list(range(1, 61))
+    printed = {f"s{i}": [] for i in range(8)}
+    start = threading.Barrier(len(printed))
+
+    def station(name):
+        svc = app.BoxClaimService(db)  # one connection per station, as separate servers would have
+        start.wait()
+        while True:
+            box = svc.claim_next('C1', boxes, name)
+            if box is None: return
+            printed[name].append(box)
+            svc.mark_printed('C1', box, name)
+
+    threads = [threading.Thread(target=station, args=(name,)) for name in printed]
+    for t in threads: t.start()
+    for t in threads: t.join()
+    all_boxes = [b for got in printed.values() for b in got]
+    assert sorted(all_boxes) == boxes
+    assert app.BoxClaimService(db).progress('C1')[0] == set(boxes)
+
+
+def test_default_path_is_in_state_dir(app):
+    assert app.os.path.dirname(app.CLAIMS_DB_FILE) == app.STATE_DIR
@@ -0,0 +1,80 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+
+def frame(**cols):
+    base = {'SKU Id': ['KBRV-1', 'KBRV-2'], 'Editable Qty': [24, 5], 'Editable Boxes': [2, 0], 'PPCN': [12, 6]}
+    base.update(cols)
+    return pd.DataFrame(base)
+
+
+def test_schema_dtypes_and_optional_columns(app):
+    data, extras = app.normalize_consignment_frame(frame(Zone=['South', None]))
+    assert list(data.columns) == ['SKU Id', 'Zone', 'Editable Qty', 'Editable Boxes', 'PPCN']
+    assert {c: str(data[c].dtype) for c in data.columns} == {c: app.CONSIGNMENT_SCHEMA[c] for c in data.columns}
+    assert extras.shape == (2, 0)
+    assert app.is_canonical_frame(data)
+
+
+def test_nan_ean_and_fsn_stay_missing(app):
+    data, _ = app.normalize_consignment_frame(frame(EAN=[np.nan, 8901030865275.0], FSN=[None, 'F2']))
+    assert data['EAN'].isna().tolist() == [True, False] and data['EAN'][1] == '8901030865275'
+    assert data['FSN'].isna().tolist() == [True, False] and data['FSN'][1] == 'F2'
+
+
+def test_ean_read_as_number_into_an_object_column(app):
+    data, _ = app.normalize_consignment_frame(frame(EAN=pd.Series([8901030865275.0, '4006381333931'], dtype=object)))
+    assert data['EAN'].tolist() == ['8901030865275', '4006381333931']
+
+
+def test_numeric_strings_are_coerced(app):
+    data, _ = app.normalize_consignment_frame(frame(**{'Editable Qty': ['24', '5.0'], 'Editable Boxes': ['2', ' 0 '],
+                                                        'Cost Price': ['350.5', 'n/a']}))
+    assert data['Editable Qty'].tolist() == [24, 5] and data['Editable Boxes'].tolist() == [2, 0]
+    assert data['Cost Price'][0] == 350.5 and np.isnan(data['Cost Price'][1])
+
+
+@pytest.mark.parametrize('col, values, problem', [
+    ('Editable Boxes', [0.5, 2], "fractional values in 'Editable Boxes'"),
+    ('Editable Qty', [24, 2.5], "fractional values in 'Editable Qty'"),
+    ('Editable Boxes', ['two', 0], "non-numeric values in 'Editable Boxes'"),
+    ('PPCN', ['12', 'x'], "non-numeric values in 'PPCN'"),
+    ('Editable Qty', [-1, 5], "negative values in 'Editable Qty'"),
+])
+def test_strict_rejects_counts_that_would_be_coerced(app, col, values, problem):
+    with pytest.raises(ValueError, match=problem):
+        app.normalize_consignment_frame(frame(**{col: values}))
+
+
+def test_strict_rejects_missing_columns_and_skus(app):
+    with pytest.raises(ValueError, match="missing column 'PPCN'.*1 rows without SKU Id"):
+        app.normalize_consignment_frame(frame(**{'SKU Id': ['KBRV-1', None]}).drop(columns='PPCN'))
+
+
+def test_extra_columns_move_to_extras(app):
+    h = {'data_extras': pd.DataFrame({'Select': [True, False], 'Brand': ['Old', 'Old']})}
+    app.set_consignment_data(h, frame(Brand=['Hike', 'Hike'], **{'UK Size': [7, 8]}))
+    assert 'Brand' not in h['data'].columns
+    assert list(h['data_extras'].columns) == ['Select', 'Brand', 'UK Size']
+    assert h['data_extras']['Brand'].tolist() == ['Hike', 'Hike'] and h['data_extras']['Select'].tolist() == [True, False]
+    joined = app.consignment_frame(h, ['UK Size', 'Missing'])
+    assert joined['UK Size'].tolist() == [7, 8] and 'Missing' not in joined.columns
+
+
+def test_extras_of_another_length_are_dropped(app):
+    h = {'data_extras': pd.DataFrame({'Select': [True]})}
+    app.set_consignment_data(h, frame())
+    assert h['data_extras'].shape == (2, 0)
+
+
+def test_lenient_mode_for_legacy_history(app):
+    legacy = pd.DataFrame({'SKU Id': ['KBRV-1', None, 'KBRV-3'], 'Editable Qty': [24.0, 'x', -3],
+                           'Editable Boxes': [1.5, 0.5, np.inf]})
+    data, _ = app.normalize_consignment_frame(legacy, strict=False)
+    # old records load as they are: counts floored, non-numbers and inf zeroed, missing PPCN defaulted
+    assert data['Editable Boxes'].tolist() == [1, 0, 0]
+    assert data['Editable Qty'].tolist() == [24, 0, -3]
+    assert data['PPCN'].tolist() == [0, 0, 0]
+    assert data['SKU Id'].isna().tolist() == [False, True, False]
+    assert app.normalize_consignment_frame(None, strict=False)[0].empty
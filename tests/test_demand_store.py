@@ -0,0 +1,79 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+
+def sales(items):
+    """A sales export from (order item id, sku, state, date, qty) tuples."""
+    return pd.DataFrame(items, columns=['Order Item ID', 'SKU', 'Delivery State', 'Order Date', 'Quantity'])
+
+
+def daily(start, days, sku='KBRV-1', state='Maharashtra', qty=1):
+    dates = pd.date_range(start, periods=days)
+    return [(f"{sku}-{d.date()}", sku, state, str(d.date()), qty) for d in dates]
+
+
+@pytest.fixture
+def store(app, tmp_path):
+    return app.DemandStore(str(tmp_path / "demand.sqlite3"))
+
+
+def window(store, *args, **kwargs):
+    df = store.demand_window(*args, **kwargs)
+    return {(r.Clean_SKU, r.Zone): (round(r.Quantity, 6), r.Rows) for r in df.itertuples()}
+
+
+def test_overlapping_exports_are_counted_once(store):
+    first = sales(daily('2026-03-01', 20))
+    second = sales(daily('2026-03-11', 20))
+    assert store.ingest(first) == {'rows': 20, 'new': 20, 'duplicate': 0, 'skipped': 0}
+    assert store.ingest(second) == {'rows': 20, 'new': 10, 'duplicate': 10, 'skipped': 0}
+    assert store.ingest(first)['new'] == 0
+    start, end, n = store.coverage()
+    assert (start, end, n) == (pd.Timestamp('2026-03-01'), pd.Timestamp('2026-03-30'), 30)
+
+
+def test_returns_are_separate_items_and_unlisted_rows_ignored(store):
+    df = sales([('I1', 'KBRV-1', 'Delhi', '2026-03-01', 2), ('I1', 'KBRV-1', 'Delhi', '2026-03-02', -2),
+                ('I2', 'OTHER-1', 'Delhi', '2026-03-01', 5), (None, 'KBRV-2', 'Delhi', '2026-03-01', 1)])
+    df['Event Type'] = ['Sale', 'Return', 'Sale', 'Sale']
+    assert store.ingest(df) == {'rows': 2, 'new': 2, 'duplicate': 0, 'skipped': 1}
+    assert window(store, 7, horizon=7) == {('KBRV-1', 'north'): (0.0, 2)}
+
+
+def test_rolling_windows_match_a_direct_sum(store):
+    rng = np.random.default_rng(3)
+    days = pd.date_range('2026-01-01', periods=120)
+    items = [(f"I{i}", f"KBRV-{rng.integers(1, 4)}", rng.choice(['Delhi', 'Kerala']), str(d.date()), int(rng.integers(1, 4)))
+             for i, d in enumerate(days[rng.integers(0, len(days), 600)])]
+    store.ingest(sales(items))
+    df = sales(items).assign(Zone=lambda d: d['Delivery State'].map({'Delhi': 'north', 'Kerala': 'south'}),
+                             Day=lambda d: pd.to_datetime(d['Order Date']))
+    end = pd.Timestamp('2026-04-15')
+    for n in (7, 30, 90):
+        recent = df[(df['Day'] > end - pd.Timedelta(days=n)) & (df['Day'] <= end)]
+        want = recent.groupby(['SKU', 'Zone'])['Quantity'].agg(['sum', 'size'])
+        want = {k: (round(float(v['sum']) * 30 / n, 6), int(v['size'])) for k, v in want.iterrows()}
+        assert window(store, n, end=end) == want
+
+
+def test_blend_weights_daily_rates(store):
+    store.ingest(sales(daily('2026-03-01', 60)))
+    store.ingest(sales([('X1', 'KBRV-1', 'Maharashtra', '2026-04-29', 7)]))
+    # Up to 2026-04-29: the last 7 days hold 7 + 7 = 14 units (2/day), the last 30 days 37 (37/30 per day)
+    got = window(store, {7: 0.5, 30: 0.5})
+    assert got == {('KBRV-1', 'west'): (round((14 / 7 * 0.5 + 37 / 30 * 0.5) * 30, 6), 31)}
+
+
+def test_retention_drops_old_days(app, tmp_path):
+    store = app.DemandStore(str(tmp_path / "demand.sqlite3"), retention_days=10)
+    store.ingest(sales(daily('2026-03-01', 5)))
+    store.ingest(sales(daily('2026-03-20', 5)))
+    start, end, n = store.coverage()
+    assert start == pd.Timestamp('2026-03-20') and n == 5
+    assert window(store, 90) == {('KBRV-1', 'west'): (round(5 * 30 / 90, 6), 5)}
+
+
+def test_missing_columns_rejected(store):
+    with pytest.raises(ValueError, match='Order Item ID'):
+        store.ingest(pd.DataFrame({'SKU': ['KBRV-1'], 'Quantity': [1], 'Delivery State': ['Delhi']}))
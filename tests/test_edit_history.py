@@ -0,0 +1,79 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from conftest import consignment
+
+
+def task(app, n=6):
+    rows = [{'SKU Id': f"KBRV-{i}", 'Editable Qty': 4 * (i + 1), 'Editable Boxes': i + 1, 'PPCN': 4} for i in range(n)]
+    return app._hydrate_consignment(consignment('E1', data=rows))
+
+
+def upload(skus, boxes):
+    return pd.DataFrame({'SKU Id': skus, 'Available Box (Edit)': boxes})
+
+
+def counts(h):
+    return h['data']['Editable Qty'].tolist(), h['data']['Editable Boxes'].tolist()
+
+
+def test_compute_box_edit_only_changed_rows(app):
+    h = task(app)
+    delta = app.compute_box_edit(h['data'], upload(['KBRV-1', 'KBRV-2', 'NOPE'], [2, 7.9, 5]))
+    assert delta == {'row': [2], 'sku': ['KBRV-2'], 'old_boxes': [3], 'new_boxes': [7], 'old_qty': [12], 'new_qty': [28]}
+    assert app.compute_box_edit(h['data'], upload(['KBRV-0'], [1])) is None
+    with pytest.raises(ValueError, match='KBRV-3'):
+        app.compute_box_edit(h['data'], upload(['KBRV-3'], ['x']))
+
+
+def test_replay_matches_every_recorded_version(app):
+    h = task(app)
+    rng = np.random.default_rng(7)
+    seen = [counts(h)]
+    for _ in range(2 * app.EDIT_SNAPSHOT_EVERY + 3):
+        skus = [f"KBRV-{i}" for i in rng.choice(6, size=2, replace=False)]
+        delta = app.compute_box_edit(h['data'], upload(skus, rng.integers(0, 9, size=2)))
+        if delta is None: continue
+        app.record_edit(h, delta, 'tester')
+        seen.append(counts(h))
+    every = app.EDIT_SNAPSHOT_EVERY
+    assert set(h['edit_snapshots']) == {str(v) for v in range(every, len(seen), every)} != set()
+    for v, (qty, boxes) in enumerate(seen):
+        q, b = app.edit_counts_at(h, v)
+        assert (q.tolist(), b.tolist()) == (qty, boxes)
+
+
+def test_undo_redo_and_branch(app):
+    h = task(app)
+    v0 = counts(h)
+    app.record_edit(h, app.compute_box_edit(h['data'], upload(['KBRV-0'], [5])), 'a', 'first')
+    v1 = counts(h)
+    app.record_edit(h, app.compute_box_edit(h['data'], upload(['KBRV-1'], [9])), 'b', 'second')
+    v2 = counts(h)
+    assert app.edit_head(h) == 2 and h['edit_timestamp']
+    app.checkout_edit_version(h, 1)
+    assert counts(h) == v1 and app.edit_log_frame(h)['State'].tolist() == ['current', 'undone']
+    app.checkout_edit_version(h, 2)
+    assert counts(h) == v2
+    app.checkout_edit_version(h, 0)
+    assert counts(h) == v0 and 'edit_timestamp' not in h
+    app.record_edit(h, app.compute_box_edit(h['data'], upload(['KBRV-2'], [1])), 'c', 'branch')
+    assert [e['note'] for e in h['edits']] == ['branch'] and app.edit_head(h) == 1
+    log = app.edit_log_frame(h)
+    assert log[['Version', 'By', 'SKUs', 'Box Change', 'State']].values.tolist() == [[1, 'c', 1, -2, 'current']]
+
+
+def test_legacy_backup_becomes_one_edit(app):
+    h = task(app)
+    backup = h['data'].copy()
+    h['data'] = h['data'].assign(**{'Editable Boxes': [1, 2, 0, 4, 5, 1], 'Editable Qty': [4, 8, 0, 16, 20, 4]})
+    h['backup_data'] = backup
+    h['edit_timestamp'] = '02-Mar-2026 10:15 AM'
+    app._legacy_backup_to_edits(h)
+    assert 'backup_data' not in h and app.edit_head(h) == 1
+    (e,) = h['edits']
+    assert e['row'] == [2, 5] and e['old_boxes'] == [3, 6] and e['new_boxes'] == [0, 1]
+    assert e['at'] == '2026-03-02T10:15:00'
+    q, b = app.edit_counts_at(h, 0)
+    assert b.tolist() == backup['Editable Boxes'].tolist()
@@ -0,0 +1,62 @@
+import pandas as pd
+import pytest
+import streamlit as st
+
+from conftest import consignment, seed_history
+
+
+@pytest.fixture
+def history(app, repo):
+    recs = [
+        consignment(f"C{i}", date=f"2026-03-{i + 1:02d}",
+                    channel=['Flipkart', 'Amazon'][i % 2], is_booked=i % 3 != 0)
+        for i in range(12)
+    ]
+    seed_history(repo, recs)
+    app.init_history_session()
+    return recs
+
+
+def test_index_built_once_per_version(app, history):
+    store = app.consignment_store()
+    v1, idx1 = store.index()
+    assert store.index()[1] is idx1
+    assert len(idx1) == 12 and list(idx1.columns) == app.HISTORY_INDEX_COLUMNS
+    assert idx1.loc[idx1['ID'] == 'C1', ['Boxes', 'Qty', 'SKUs']].values.tolist() == [[2, 8, 2]]
+
+
+def test_save_recomputes_only_changed_rows(app, history, monkeypatch):
+    rec = app.edit_consignment(app.session_record('C4'))
+    rec['is_booked'] = not rec['is_booked']
+    app.put_consignment(rec)
+    calls = []
+    real = app.history_row
+    monkeypatch.setattr(app, 'history_row', lambda h: calls.append(h.get('id')) or real(h))
+    assert app.save_history(st.session_state['consignments'])
+    assert calls == ['C4']
+    _, idx = app.consignment_store().index()
+    assert bool(idx.loc[idx['ID'] == 'C4', 'Booked'].iat[0]) == rec['is_booked']
+
+
+def test_unsaved_edit_patched_into_session_index(app, history):
+    version, shared = app.consignment_store().index()
+    rec = app.edit_consignment(app.session_record('C2'))
+    rec['channel'] = 'Myntra'
+    app.put_consignment(rec)
+    key, idx = app.session_history_index()
+    assert key[0] == version and len(idx) == 12
+    assert idx.loc[idx['ID'] == 'C2', 'Channel'].iat[0] == 'Myntra'
+    assert shared.loc[shared['ID'] == 'C2', 'Channel'].iat[0] == 'Flipkart'
+    assert app.session_record('C2') is rec
+    assert app.session_history_index()[1] is idx
+
+
+def test_filters_and_sorts(app, history):
+    _, idx = app.session_history_index()
+    view = app.filter_history_index(idx, query='c1', channels=['Amazon'],
+                                    booked='Booked', sort='Task ID')
+    assert view['ID'].tolist() == ['C1', 'C11']
+    window = (pd.Timestamp('2026-03-02'), pd.Timestamp('2026-03-04'))
+    dated = app.filter_history_index(idx, date_range=window, sort='Oldest first')
+    assert dated['ID'].tolist() == ['C1', 'C2', 'C3']
+    assert app.filter_history_index(idx)['ID'].iat[0] == 'C11'
@@ -0,0 +1,168 @@
+import json
+
+import pytest
+import streamlit as st
+
+from conftest import consignment, seed_history
+
+SESSION_KEYS = ['history_version', 'history_sha', 'history_base', 'history_dirty', 'consignments']
+
+
+def open_session(app):
+    """Loads the history like a new browser session and returns that session's state."""
+    st.session_state.pop('curr_con', None)
+    app.init_history_session()
+    return {k: st.session_state[k] for k in SESSION_KEYS}
+
+
+def use_session(state):
+    for k, v in state.items(): st.session_state[k] = v
+
+
+def edit(app, cid, **fields):
+    rec = app.edit_consignment(next(h for h in st.session_state['consignments'] if h['id'] == cid))
+    rec.update(fields)
+    app.put_consignment(rec)
+
+
+def stored(repo):
+    return {r['id']: r for r in json.loads(repo.files["consignment_history.json"])}
+
+
+@pytest.fixture
+def two_stations(app, repo):
+    seed_history(repo, [consignment('C1'), consignment('C2')])
+    return open_session(app), open_session(app)
+
+
+def test_concurrent_scans_union_printed_boxes(app, repo, two_stations):
+    a, b = two_stations
+    use_session(a)
+    edit(app, 'C1', printed_boxes=[1, 2])
+    assert app.save_history(st.session_state['consignments'])
+    use_session(b)
+    edit(app, 'C1', printed_boxes=[3])
+    assert app.save_history(st.session_state['consignments'])
+    assert stored(repo)['C1']['printed_boxes'] == [1, 2, 3]
+    assert sorted(h['printed_boxes'] for h in st.session_state['consignments']) == [[], [1, 2, 3]]
+
+
+def test_unprint_on_one_side_survives_merge(app, repo):
+    seed_history(repo, [consignment('C1', printed_boxes=[1, 2, 3])])
+    a, b = open_session(app), open_session(app)
+    use_session(a)
+    edit(app, 'C1', printed_boxes=[1, 2, 3, 4])
+    assert app.save_history(st.session_state['consignments'])
+    use_session(b)
+    edit(app, 'C1', printed_boxes=[1, 3])
+    assert app.save_history(st.session_state['consignments'])
+    assert stored(repo)['C1']['printed_boxes'] == [1, 3, 4]
+
+
+def test_booked_flag_takes_latest_toggle(app, repo, two_stations):
+    a, b = two_stations
+    use_session(a)
+    edit(app, 'C1', is_booked=False, booked_updated_at='2026-03-02T10:00:05')
+    assert app.save_history(st.session_state['consignments'])
+    use_session(b)
+    edit(app, 'C1', is_booked=True, booked_updated_at='2026-03-02T10:00:01', printed_boxes=[5])
+    assert app.save_history(st.session_state['consignments'])
+    rec = stored(repo)['C1']
+    assert rec['is_booked'] is False and rec['printed_boxes'] == [5]
+
+
+def test_edits_to_different_consignments_both_kept(app, repo, two_stations):
+    a, b = two_stations
+    use_session(a)
+    edit(app, 'C1', printed_boxes=[1])
+    assert app.save_history(st.session_state['consignments'])
+    use_session(b)
+    edit(app, 'C2', printed_boxes=[2])
+    assert app.save_history(st.session_state['consignments'])
+    recs = stored(repo)
+    assert recs['C1']['printed_boxes'] == [1] and recs['C2']['printed_boxes'] == [2]
+
+
+def test_new_consignments_from_both_sides_kept(app, repo, two_stations):
+    a, b = two_stations
+    for state, cid in ((a, 'C3'), (b, 'C4')):
+        use_session(state)
+        rec = app._hydrate_consignment(consignment(cid))
+        app.put_consignment(rec)
+        assert app.save_history(st.session_state['consignments'])
+    assert sorted(stored(repo)) == ['C1', 'C2', 'C3', 'C4']
+
+
+def test_delete_wins_unless_other_side_edited(app):
+    base = {'C1': consignment('C1'), 'C2': consignment('C2')}
+    theirs = {'C1': consignment('C1'), 'C2': consignment('C2', printed_boxes=[1])}
+    mine = {}
+    assert list(app.merge_histories(base, mine, theirs)) == ['C2']
+    assert app.merge_histories(base, {'C1': base['C1']}, {'C1': base['C1']}) == {'C1': base['C1']}
+    assert app.merge_histories(base, {}, {'C1': base['C1']}) == {}
+
+
+def test_scalar_conflict_goes_to_latest_update(app):
+    base = consignment('C1', date='2026-03-02')
+    mine = consignment('C1', date='2026-03-05', updated_at='2026-03-02T11:00:00')
+    theirs = consignment('C1', date='2026-03-04', channel='Amazon', updated_at='2026-03-02T10:00:00')
+    merged = app.merge_consignment(base, mine, theirs)
+    assert merged['date'] == '2026-03-05'
+    assert merged['channel'] == 'Amazon'
+
+
+def test_save_gives_up_after_retries(app, repo, two_stations, monkeypatch):
+    a, _ = two_stations
+    use_session(a)
+    monkeypatch.setattr(app.StorageHandler, 'upload_file_if_match', staticmethod(lambda *args, **kw: ('conflict', None)))
+    edit(app, 'C1', printed_boxes=[1])
+    assert app.save_history(st.session_state['consignments']) is False
+
+
+def test_saved_session_shares_the_store_records(app, repo, two_stations):
+    a, b = two_stations
+    use_session(a)
+    before = dict(st.session_state['history_base'])
+    edit(app, 'C1', printed_boxes=[2])
+    assert app.save_history(st.session_state['consignments'])
+    store = app.consignment_store()
+    assert all(h is store.records[h['id']] for h in st.session_state['consignments'])
+    assert st.session_state['history_base'] is store.base
+    assert store.base['C2'] is before['C2'] and store.base['C1'] is not before['C1']
+
+
+def test_sync_merges_unsaved_edits_with_other_station(app, repo, two_stations):
+    a, b = two_stations
+    use_session(a)
+    edit(app, 'C1', printed_boxes=[1])
+    a = {k: st.session_state[k] for k in SESSION_KEYS}
+    use_session(b)
+    edit(app, 'C1', printed_boxes=[2], is_booked=False, booked_updated_at='2026-03-02T10:00:05')
+    edit(app, 'C2', printed_boxes=[3])
+    assert app.save_history(st.session_state['consignments'])
+    use_session(a)
+    assert app.sync_history_session()
+    assert st.session_state['history_sha'] == app.consignment_store().sha
+    rec = next(h for h in st.session_state['consignments'] if h['id'] == 'C1')
+    assert rec['printed_boxes'] == [1, 2] and rec['is_booked'] is False
+    assert app.save_history(st.session_state['consignments'])
+    recs = stored(repo)
+    assert recs['C1']['printed_boxes'] == [1, 2] and recs['C1']['is_booked'] is False
+    assert recs['C2']['printed_boxes'] == [3]
+
+
+def test_sync_keeps_unsaved_edit_of_untouched_record(app, repo, two_stations):
+    a, b = two_stations
+    use_session(a)
+    edit(app, 'C1', printed_boxes=[1])
+    mine = next(h for h in st.session_state['consignments'] if h['id'] == 'C1')
+    a = {k: st.session_state[k] for k in SESSION_KEYS}
+    use_session(b)
+    edit(app, 'C2', printed_boxes=[3])
+    assert app.save_history(st.session_state['consignments'])
+    use_session(a)
+    assert app.sync_history_session()
+    assert next(h for h in st.session_state['consignments'] if h['id'] == 'C1') is mine
+    assert app.save_history(st.session_state['consignments'])
+    recs = stored(repo)
+    assert recs['C1']['printed_boxes'] == [1] and recs['C2']['printed_boxes'] == [3]
@@ -0,0 +1,110 @@
+import json
+import os
+import threading
+import time
+
+import pytest
+
+
+def wait_for(sched, job_id, statuses=('done', 'failed', 'cancelled'), timeout=10):
+    end = time.time() + timeout
+    while time.time() < end:
+        if sched.status(job_id) in statuses: return sched.status(job_id)
+        time.sleep(0.02)
+    raise AssertionError(f"job {job_id} still {sched.status(job_id)}")
+
+
+@pytest.fixture
+def handlers(app, monkeypatch):
+    table = {}
+    monkeypatch.setattr(app, 'JOB_HANDLERS', table)
+    return table
+
+
+@pytest.fixture
+def sched(app, tmp_path):
+    return app.JobScheduler(str(tmp_path / "jobs.sqlite3"), workers=0)
+
+
+def start_worker(sched):
+    threading.Thread(target=sched._worker, daemon=True).start()
+
+
+def test_state_files_live_in_state_dir(app):
+    assert os.path.dirname(app.JOBS_DB_FILE) == app.STATE_DIR
+    assert os.path.dirname(app.DEMAND_DB_FILE) == app.STATE_DIR
+
+
+def test_identical_active_jobs_are_deduplicated(sched):
+    a = sched.submit('prefetch', {'c_id': 'C1'})
+    assert sched.submit('prefetch', {'c_id': 'C1'}, priority=50) == a
+    assert sched.submit('prefetch', {'c_id': 'C2'}) != a
+    assert sched.jobs().set_index('id').loc[a, 'priority'] == 50
+    sched.cancel(a)
+    assert sched.status(a) == 'cancelled'
+    assert sched.submit('prefetch', {'c_id': 'C1'}) != a
+
+
+def test_handler_result_and_failure(app, sched, handlers):
+    handlers['ok'] = lambda params, job: {'echo': params['x']}
+    def failing(params, job):
+        app.StorageHandler.report("Cloud Save Error for X.pdf: boom")
+        raise RuntimeError("Could not save")
+    handlers['bad'] = failing
+    start_worker(sched)
+    ok, bad = sched.submit('ok', {'x': 3}), sched.submit('bad', {})
+    assert wait_for(sched, ok) == 'done' and wait_for(sched, bad) == 'failed'
+    jobs = sched.jobs().set_index('id')
+    assert json.loads(jobs.loc[ok, 'result']) == {'echo': 3}
+    assert jobs.loc[bad, 'error'] == "RuntimeError: Could not save (Cloud Save Error for X.pdf: boom)"
+
+
+def test_cancel_reaches_running_job_without_polling_the_table(app, sched, handlers, monkeypatch):
+    started = threading.Event()
+    polls = []
+    def loop(params, job):
+        started.set()
+        while True:
+            polls.append(1)
+            if job.cancelled(): raise app.JobCancelled()
+            time.sleep(0.001)
+    handlers['loop'] = loop
+    reads = []
+    real_status = sched.status
+    monkeypatch.setattr(sched, 'status', lambda job_id: reads.append(job_id) or real_status(job_id))
+    start_worker(sched)
+    job_id = sched.submit('loop', {})
+    assert started.wait(5)
+    time.sleep(0.2)
+    sched.cancel(job_id)
+    monkeypatch.setattr(sched, 'status', real_status)
+    assert wait_for(sched, job_id) == 'cancelled'
+    assert len(polls) > 50 and len(reads) <= 2
+
+
+def test_cancel_from_another_process_is_polled(app, sched):
+    job_id = sched.submit('loop', {})
+    sched._claim()
+    job = app.JobContext(sched, job_id)
+    assert not job.cancelled()
+    sched._update(job_id, status='cancelling')  # as cancel() in another server process writes it
+    assert not job.cancelled()  # within JOB_CANCEL_POLL_SECONDS of the last read
+    job.polled_at -= app.JOB_CANCEL_POLL_SECONDS
+    assert job.cancelled()
+
+
+def test_purge_removes_expired_jobs_and_result_files(app, sched, handlers, monkeypatch, tmp_path):
+    monkeypatch.setattr(app, 'UPLOAD_CACHE_DIR', str(tmp_path / "cache"))
+    os.makedirs(app.UPLOAD_CACHE_DIR)
+    def plan(params, job):
+        path = os.path.join(app.UPLOAD_CACHE_DIR, f"plan-{job.job_id}.pkl")
+        open(path, 'wb').write(b'plan')
+        return {'path': path}
+    handlers['plan'] = plan
+    start_worker(sched)
+    old, new = sched.submit('plan', {'n': 1}), sched.submit('plan', {'n': 2})
+    wait_for(sched, old), wait_for(sched, new)
+    sched._update(old, finished_at=time.time() - (app.JOB_RETENTION_DAYS + 1) * 86400)
+    assert sched.purge() == 1
+    assert sorted(os.listdir(app.UPLOAD_CACHE_DIR)) == [f"plan-{new}.pkl"]
+    assert list(sched.jobs()['id']) == [new]
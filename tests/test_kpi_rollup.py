@@ -0,0 +1,78 @@
+import pandas as pd
+import pytest
+import streamlit as st
+
+from conftest import consignment, seed_history
+
+
+def kpis_by_groupby(records):
+    """Reference: the dashboard aggregates recomputed from scratch."""
+    rows = []
+    for h in records:
+        data = pd.DataFrame(h['data'])
+        rows.append({'Date': pd.Timestamp(h['date']), 'Channel': h['channel'], 'Type': h['task_type'],
+                     'Tasks': 1, 'Booked': int(h['is_booked']), 'Unbooked': int(not h['is_booked']),
+                     'Boxes': int(data['Editable Boxes'].sum()), 'Qty': int(data['Editable Qty'].sum()),
+                     'SKU Lines': data['SKU Id'].nunique()})
+    out = pd.DataFrame(rows).groupby(['Date', 'Channel', 'Type'], as_index=False).sum()
+    return out.reset_index(drop=True)
+
+
+@pytest.fixture
+def records():
+    return [
+        consignment(f"C{i}", date=f"2026-03-{i % 4 + 1:02d}",
+                    channel=['Flipkart', 'Amazon', 'Myntra'][i % 3], is_booked=i % 2 == 0)
+        for i in range(15)
+    ]
+
+
+def check(frame, records, app):
+    want = kpis_by_groupby(records)
+    got = frame[['Date', 'Channel', 'Type'] + app.KPI_COLUMNS]
+    pd.testing.assert_frame_equal(got.reset_index(drop=True), want, check_dtype=False)
+
+
+def test_store_rollup_matches_full_recompute(app, repo, records):
+    seed_history(repo, records)
+    app.init_history_session()
+    check(app.kpi_frame(), records, app)
+
+
+def test_save_updates_only_changed_tasks(app, repo, records, monkeypatch):
+    seed_history(repo, records)
+    app.init_history_session()
+    store = app.consignment_store()
+    before = dict(store.kpi.parts)
+    rec = app.edit_consignment(app.session_record('C3'))
+    rec['is_booked'] = True
+    rec['channel'] = 'Flipkart'
+    app.put_consignment(rec)
+    assert app.save_history(st.session_state['consignments'])
+    changed = [cid for cid, part in store.kpi.parts.items() if part is not before[cid]]
+    assert changed == ['C3']
+    records[3].update(is_booked=True, channel='Flipkart')
+    check(app.kpi_frame(), records, app)
+
+
+def test_unsaved_edits_patch_a_copy(app, repo, records):
+    seed_history(repo, records)
+    app.init_history_session()
+    shared = app.consignment_store().kpi_frame()[1]
+    rec = app.edit_consignment(app.session_record('C0'))
+    rec['is_booked'] = False
+    app.put_consignment(rec)
+    mine = app.kpi_frame()
+    assert mine['Unbooked'].sum() == shared['Unbooked'].sum() + 1
+    assert app.consignment_store().kpi_frame()[1] is shared
+    assert app.kpi_frame() is mine
+
+
+def test_put_and_drop_cancel_out(app):
+    rollup = app.KpiRollup()
+    row = ('C1', 'execution', 'Flipkart', '2026-03-02', True, 4, 20, 2)
+    rollup.put(row)
+    rollup.put(row[:4] + (False, 5, 25, 3))
+    assert rollup.frame()[['Tasks', 'Booked', 'Unbooked', 'Boxes']].values.tolist() == [[1, 0, 1, 5]]
+    rollup.drop('C1')
+    assert rollup.cells == {} and rollup.frame().empty
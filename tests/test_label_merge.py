@@ -0,0 +1,119 @@
+import io
+import threading
+import warnings
+
+import pandas as pd
+import pytest
+from pypdf import PdfReader
+from reportlab.lib.pagesizes import A4
+from reportlab.pdfgen import canvas
+
+
+def source_labels(pages):
+    buf = io.BytesIO()
+    c = canvas.Canvas(buf, pagesize=A4)
+    for i in range(pages):
+        c.drawString(100, 700, f"FLIPKART LABEL {i}")
+        c.showPage()
+    c.save()
+    return buf.getvalue()
+
+
+@pytest.fixture
+def consignment_df():
+    return pd.DataFrame({'SKU Id': ['KBRV-2', 'KBRV-1', 'KBRV-3'], 'Editable Boxes': [3, 2, 0], 'Editable Qty': [24, 12, 0],
+                         'PPCN': [8, 6, 4], 'FSN': ['F2', 'F1', 'F3']})
+
+
+class ReadSpy(io.BytesIO):
+    def __init__(self, data):
+        super().__init__(data)
+        self.reads = []
+
+    def read(self, size=-1):
+        self.reads.append(size)
+        return super().read(size)
+
+
+def test_merge_returns_open_file_with_a_page_per_box(app, consignment_df):
+    merged = app.generate_merged_box_labels(consignment_df, {}, {}, {}, source_labels(3))
+    with merged:
+        assert merged.tell() == 0
+        reader = PdfReader(merged)
+        assert len(reader.pages) == 6  # 5 real boxes + 1 MIX SKU box
+        assert "BOX NO.- 1" in reader.pages[0].extract_text()
+    assert merged.closed
+
+
+def test_merge_reads_source_from_a_file(app, consignment_df):
+    with app.generate_merged_box_labels(consignment_df, {}, {}, {}, io.BytesIO(source_labels(3))) as merged:
+        assert len(PdfReader(merged).pages) == 6
+
+
+def test_merge_without_source_returns_none(app, consignment_df):
+    assert app.generate_merged_box_labels(consignment_df, {}, {}, {}, b'') is None
+
+
+def test_cancel_hook_stops_merge(app, consignment_df):
+    polls = []
+    def should_cancel():
+        polls.append(1)
+        return len(polls) > 2
+    with pytest.raises(app.MergeCancelled):
+        app.generate_merged_box_labels(consignment_df, {}, {}, {}, source_labels(3), should_cancel=should_cancel)
+    assert len(polls) == 3
+
+
+def test_session_merge_honours_cancel_flag(app, consignment_df):
+    class Bar:
+        def progress(self, *args, **kwargs): pass
+    pkg = {'id': 'C1', 'data': consignment_df}
+    cancel = threading.Event()
+    cancel.set()
+    with pytest.raises(app.MergeCancelled):
+        app.merge_labels_in_session(pkg, source_labels(3), Bar(), cancel)
+    with app.merge_labels_in_session(pkg, source_labels(3), Bar(), threading.Event()) as merged:
+        assert len(PdfReader(merged).pages) == 6
+
+
+def merged_bytes(app, df, source):
+    with app.generate_merged_box_labels(df, {}, {}, {}, source) as merged:
+        return merged.read()
+
+
+def test_merge_shares_one_form_per_source_page_and_shrinks(app, consignment_df, monkeypatch):
+    source = source_labels(3)
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        optimised = merged_bytes(app, consignment_df, source)
+    reader = PdfReader(io.BytesIO(optimised))
+    forms = {}
+    for i, page in enumerate(reader.pages):
+        xobjects = page['/Resources']['/XObject']
+        (name,) = [n for n in xobjects if n.startswith('/FkP')]
+        assert name == f'/FkP{i // 2}'  # two boxes per source page
+        forms.setdefault(name, set()).add(xobjects.raw_get(name).idnum)
+    assert list(forms) == ['/FkP0', '/FkP1', '/FkP2'] and all(len(ids) == 1 for ids in forms.values())
+    monkeypatch.setattr(app, 'optimise_pdf_writer', lambda writer: None)
+    assert len(optimised) < len(merged_bytes(app, consignment_df, source))
+
+
+
+def test_dedup_failure_is_reported(app, monkeypatch):
+    def broken(self, **kwargs): raise TypeError("unexpected keyword")
+    monkeypatch.setattr(app.PdfWriter, 'compress_identical_objects', broken)
+    writer = app.PdfWriter()
+    writer.add_blank_page(100, 100)
+    with pytest.warns(RuntimeWarning, match="deduplication skipped"):
+        app.optimise_pdf_writer(writer)
+
+def test_large_upload_streams_parts_from_file(app, repo, monkeypatch):
+    monkeypatch.setattr(app, 'LARGE_FILE_CHUNK_THRESHOLD', 1000)
+    monkeypatch.setattr(app, 'LARGE_FILE_PART_SIZE', 400)
+    data = bytes(range(256)) * 10
+    src = ReadSpy(data)
+    assert app.StorageHandler.upload_large_file("big.pdf", src, "test")
+    assert -1 not in src.reads and max(src.reads) == 400
+    assert sorted(repo.files) == ["big.pdf.manifest.json", "big.pdf.part000", "big.pdf.part001", "big.pdf.part002", "big.pdf.part003", "big.pdf.part004", "big.pdf.part005", "big.pdf.part006"]
+    with app.StorageHandler.download_to_spool("big.pdf") as spool:
+        assert spool.read() == data
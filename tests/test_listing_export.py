@@ -0,0 +1,90 @@
+import io
+import zipfile
+
+import numpy as np
+import pandas as pd
+import pytest
+
+LIMIT = 4999
+
+
+# The row-by-row listing export that quantity_chunk_bounds / plan_listing_files replaced, kept as the reference.
+def split_df_by_quantity_limit(df, qty_col, limit):
+    chunks = []; current_rows = []; current_sum = 0
+    for _, row in df.iterrows():
+        q = int(row[qty_col]) if pd.notna(row[qty_col]) else 0
+        if q > limit:
+            if current_rows:
+                chunks.append(pd.DataFrame(current_rows)); current_rows = []; current_sum = 0
+            chunks.append(pd.DataFrame([row])); continue
+        if current_sum + q > limit:
+            if current_rows: chunks.append(pd.DataFrame(current_rows))
+            current_rows = [row]; current_sum = q
+        else: current_rows.append(row); current_sum += q
+    if current_rows: chunks.append(pd.DataFrame(current_rows))
+    return [c.reset_index(drop=True) for c in chunks]
+
+
+def fill_listing_template(app, tpl_db, qty_map, channel, cost):
+    sku_col, qty_col, cost_col = app.PLAN_CHANNELS[channel]['template_cols']
+    out = tpl_db[tpl_db[sku_col].isin(qty_map.keys())].copy().reset_index(drop=True)
+    out = out.sort_values(by=sku_col, key=lambda s: s.str.upper()).reset_index(drop=True)
+    qty = out[sku_col].map(qty_map).fillna(0).astype(int)
+    for col, val in ((qty_col, qty), (cost_col, cost)):
+        if col is None: continue
+        if isinstance(col, int): out.iloc[:, col] = val
+        else: out[col] = val
+    keep = qty.to_numpy() > 0
+    return out[keep].reset_index(drop=True), qty[keep].reset_index(drop=True).to_numpy()
+
+
+def reference_files(app, tpl_db, groups, channel, cost):
+    """[(group, file no, CSV bytes)] as the old page rendered them."""
+    files = []
+    for name, qty_map in groups:
+        rows, qty = fill_listing_template(app, tpl_db, qty_map, channel, cost)
+        if rows.empty: continue
+        chunks = split_df_by_quantity_limit(rows.assign(__Q__=qty), '__Q__', LIMIT)
+        files += [(name, k, c.drop(columns=['__Q__']).to_csv(index=False).encode()) for k, c in enumerate(chunks, start=1)]
+    return files
+
+
+def chunk_sizes(app, q):
+    b = app.quantity_chunk_bounds(q, LIMIT)
+    return [stop - start for start, stop in zip(b[:-1], b[1:])]
+
+
+def test_chunk_bounds_match_row_by_row_split(app):
+    rng = np.random.default_rng(0)
+    for t in range(200):
+        q = rng.integers(1, 7000 if t % 3 == 0 else 1500, size=rng.integers(0, 40))
+        expected = [len(c) for c in split_df_by_quantity_limit(pd.DataFrame({'q': q}), 'q', LIMIT)]
+        assert chunk_sizes(app, q) == expected, q
+
+
+@pytest.mark.parametrize('q', [[], [LIMIT], [LIMIT, LIMIT], [LIMIT + 1], [1, LIMIT], [LIMIT - 1, 1, 1], [9000, 1, 9000]])
+def test_chunk_bounds_edges(app, q):
+    expected = [len(c) for c in split_df_by_quantity_limit(pd.DataFrame({'q': q}), 'q', LIMIT)]
+    assert chunk_sizes(app, q) == expected
+
+
+def templates(rng, n=600):
+    skus = [f'kbrv-{i}' if i % 2 else f'KBRV-{i}' for i in rng.permutation(n)]
+    flipkart = pd.DataFrame({f'c{k}': rng.integers(0, 9, n) for k in range(15)})
+    flipkart.insert(0, 'SKU', skus)
+    return {'Flipkart': flipkart, 'Amazon': pd.DataFrame({'SKU': skus, 'Title': 'x', 'Quantity': 0})}
+
+
+@pytest.mark.parametrize('channel', ['Flipkart', 'Amazon'])
+def test_listing_files_match_old_export(app, channel):
+    rng = np.random.default_rng(1)
+    tpl = templates(rng)[channel]
+    groups = [(g, {s: int(rng.integers(-5, 900)) for s in rng.choice(tpl['SKU'], 300, replace=False)})
+              for g in ['All Zone', 'South', 'West']]
+    groups.append(('East', {'KBRV-UNLISTED': 40}))
+    rows, files = app.plan_listing_files(tpl, groups, channel, 123, LIMIT)
+    got = [(g, k, app.listing_csv_bytes(rows, start, stop)) for g, k, start, stop in files]
+    assert got == reference_files(app, tpl, groups, channel, 123)
+    with zipfile.ZipFile(io.BytesIO(app.listing_zip_bytes(rows, files, 'T1'))) as zf:
+        assert zf.namelist() == [app.listing_file_name(g, k, 'T1') for g, k, _, _ in files]
+        assert [zf.read(app.listing_file_name(g, k, 'T1')) for g, k, _ in got] == [b for _, _, b in got]
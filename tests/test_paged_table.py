@@ -0,0 +1,71 @@
+import io
+import re
+
+import numpy as np
+import pandas as pd
+import pytest
+from pypdf import PdfReader
+from reportlab.lib.pagesizes import A4
+from reportlab.lib.units import mm
+from reportlab.pdfgen import canvas
+
+HEADER = ['ITEM', 'QTY', 'BOXES']
+
+
+def render(app, n, **kw):
+    qty = np.arange(1, n + 1, dtype=np.int64); box = np.full(n, 2, dtype=np.int64)
+    columns = [np.array([f'ROW-{i:04d}' for i in range(n)]), qty.astype(str), box.astype(str)]
+    buf = io.BytesIO(); c = canvas.Canvas(buf, pagesize=A4)
+    app.draw_paged_table(c, HEADER, [110*mm, 30*mm, 30*mm], columns, totals={1: qty, 2: box}, **kw)
+    c.save()
+    return [page.extract_text() for page in PdfReader(io.BytesIO(buf.getvalue())).pages]
+
+
+def page_rows(text):
+    return re.findall(r'ROW-\d{4}', text)
+
+
+@pytest.mark.parametrize('n', [0, 1, 35, 36, 70, 71, 120])  # an A4 page holds 35 rows
+def test_rows_split_over_pages(app, n):
+    caps = app._paged_table_capacities(n, A4[1] - 20*mm, A4[1] - 20*mm)
+    pages = render(app, n)
+    assert len(pages) == len(caps) == max(1, -(-n // caps[0]))
+    assert [r for text in pages for r in page_rows(text)] == [f'ROW-{i:04d}' for i in range(n)]
+    assert [len(page_rows(text)) for text in pages[:-1]] == caps[:-1]
+
+
+def test_header_repeats_and_totals_only_on_last_page(app):
+    pages = render(app, 120)
+    assert len(pages) > 2
+    for p, text in enumerate(pages, start=1):
+        assert all(label in text for label in HEADER), p
+        assert f'Page {p} of {len(pages)}' in text
+        assert ('TOTAL' in text) == (p == len(pages)) and ('C/F' in text) == (p < len(pages))
+    # carried-forward rows hold the running totals; the last page the grand totals
+    shown = 0
+    for text in pages[:-1]:
+        shown += len(page_rows(text))
+        assert re.search(rf'C/F\s*{shown * (shown + 1) // 2}\s*{2 * shown}', text)
+    assert re.search(rf'TOTAL\s*{120 * 121 // 2}\s*240', pages[-1])
+
+
+def test_first_page_top_and_continuation_callback(app):
+    h = A4[1]; seen = []
+    def contd(c, p):
+        seen.append(p); c.drawString(10*mm, h - 12*mm, f'CONTINUED {p}')
+    pages = render(app, 120, first_top=h - 100*mm, on_new_page=contd)
+    caps = app._paged_table_capacities(120, h - 100*mm, h - 20*mm)
+    assert caps[0] < caps[1] and [len(page_rows(t)) for t in pages[:-1]] == caps[:-1]
+    assert seen == list(range(1, len(pages)))
+    assert 'CONTINUED' not in pages[0] and all(f'CONTINUED {p}' in t for p, t in enumerate(pages[1:], start=1))
+
+
+def test_consignment_pdf_pages(app):
+    n = 90
+    df = pd.DataFrame({'SKU Id': [f'KBRV-{i:03d}' for i in range(n)], 'Editable Qty': 10, 'Editable Boxes': 1})
+    reader = PdfReader(io.BytesIO(app.generate_consignment_data_pdf(df, {'id': 'C1', 'date': '2026-03-02'})))
+    pages = [page.extract_text() for page in reader.pages]
+    assert len(pages) == len(app._paged_table_capacities(n, A4[1] - 30*mm, A4[1] - 20*mm)) > 1
+    assert all('SKU' in t and 'No. of Box' in t for t in pages)
+    assert all('(contd.)' in t for t in pages[1:]) and '(contd.)' not in pages[0]
+    assert sum('TOTAL' in t for t in pages) == 1 and re.search(r'TOTAL\s*900\s*90', pages[-1])
@@ -0,0 +1,166 @@
+import json
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from conftest import consignment, seed_history
+
+MULTIPLIER = 1.3
+
+
+@pytest.fixture
+def planner(app, repo):
+    """Planning against an empty repo: no template or master data (PPCN 16), no booked consignments and no
+    channel config."""
+    app.master_data_index.clear()
+    app.channel_config.clear()
+    yield app
+    app.master_data_index.clear()
+    app.channel_config.clear()
+
+
+def uploads(app, layout, nsku=40, nrows=3000, seed=3):
+    """Random sales plus an inventory export in one of the three layouts plan_warehouse_stock reads."""
+    rng = np.random.default_rng(seed)
+    skus = [f'KBRV-{i}' for i in range(nsku)]
+    states = np.array(list(app.STATE_TO_ZONE) + ['Unknownland', None], dtype=object)
+    sales = pd.DataFrame({'SKU': rng.choice(skus, nrows), 'Quantity': rng.integers(1, 4, nrows),
+                          'Delivery State': rng.choice(states, nrows)})
+    if layout == 'long':
+        inv = pd.DataFrame({'SKU': np.repeat(skus, 4), 'Warehouse Id': np.tile([w.upper() for w in app.WAREHOUSES], nsku),
+                            'Live on Website': rng.integers(0, 30, 4 * nsku).astype(str)})
+    elif layout == 'wide':
+        inv = pd.DataFrame({'SKU': skus, **{w: rng.integers(0, 30, nsku).astype(str) for w in app.WAREHOUSES}})
+    else:
+        inv = pd.DataFrame({'SKU': skus, 'Live on Website': rng.integers(0, 100, nsku).astype(str)})
+    return sales, inv
+
+
+def reference_boxes(app, sales, inv, layout, inputs, booked=None):
+    """Row-by-row baseline: boxes per (SKU, warehouse) = floor((demand * multiplier - stock - booked) / PPCN), with
+    booked qty of an unmapped receiver spread by the warehouse's share of the SKU's sales."""
+    booked = booked or {}
+    warehouse = sales['Delivery State'].map(lambda s: app.STATE_TO_ZONE.get(s, (None, None))[1])
+    demand = sales.assign(wh=warehouse).groupby(['SKU', 'wh'])['Quantity'].sum()
+    if layout == 'long':
+        stock = inv.assign(q=inv['Live on Website'].astype(float), wh=inv['Warehouse Id'].str.lower())
+        stock = stock.groupby(['SKU', 'wh'])['q'].sum()
+    elif layout == 'wide':
+        stock = inv.set_index('SKU')[app.WAREHOUSES].astype(float).stack()
+    skus = list(inputs['skus'])
+    expected = {}
+    for sku in skus:
+        d = {w: demand.get((sku, w), 0) for w in app.WAREHOUSES}
+        total = sum(d.values())
+        for j, w in enumerate(app.WAREHOUSES):
+            s = inputs['wh_stock'][skus.index(sku), j] if layout == 'none' else stock.get((sku, w), 0)
+            b = booked.get(sku, 0) * (d[w] / total if total else 1 / len(app.WAREHOUSES))
+            boxes = max(np.floor((d[w] * MULTIPLIER - s - b) / 16), 0)
+            if boxes > 0: expected[(sku, w)] = boxes
+    return expected
+
+
+def plan_boxes(rows):
+    return {(r['SKU Id'], r['Warehouse']): r['Editable Boxes'] for _, r in rows.iterrows()}
+
+
+@pytest.mark.parametrize('layout', ['long', 'wide', 'none'])
+def test_warehouse_plan_matches_reference(planner, layout):
+    sales, inv = uploads(planner, layout)
+    inputs, msg = planner.build_plan_inputs(sales.copy(), inv.copy(), 'multi')
+    assert msg == "Success" and inputs['wh_stock_split'] == (layout == 'none')
+    rows, msg, summary, zone_summary, combined = planner.allocate_plan(inputs, MULTIPLIER)
+    assert msg == "Success"
+    assert plan_boxes(rows) == reference_boxes(planner, sales, inv, layout, inputs)
+    assert summary['Boxes'].sum() == rows['Editable Boxes'].sum() == zone_summary['Boxes'].sum()
+    assert combined[planner.ZONES_ORDER].sum(axis=1).tolist() == summary['Boxes'].tolist()
+
+
+def test_booked_qty_goes_to_the_receiver_warehouse(planner, repo):
+    data = [{'SKU Id': 'KBRV-1', 'Editable Qty': 160, 'Editable Boxes': 10, 'PPCN': 16},
+            {'SKU Id': 'KBRV-2', 'Editable Qty': 32, 'Editable Boxes': 2, 'PPCN': 16}]
+    seed_history(repo, [consignment('B1', date='2099-01-01', receiver={'State': 'Karnataka'}, data=data),
+                        consignment('B2', date='2099-01-01', receiver={}, data=data)])
+    sales, inv = uploads(planner, 'long')
+    inputs, _ = planner.build_plan_inputs(sales.copy(), inv.copy(), 'multi')
+    south = planner.ZONES_ORDER.index('South')
+    skus = list(inputs['skus'])
+    placed = inputs['wh_booked'][skus.index('KBRV-1')]
+    assert placed.sum() == pytest.approx(320)
+    assert placed[south] >= 160
+    rows = planner.allocate_plan(inputs, MULTIPLIER)[0]
+    # the Karnataka booking is the reference's South stock; the unmapped one is split by share in both
+    inv_booked = pd.concat([inv, pd.DataFrame({'SKU': ['KBRV-1', 'KBRV-2'], 'Warehouse Id': 'MALUR_BTS',
+                                               'Live on Website': ['160', '32']})], ignore_index=True)
+    expected = reference_boxes(planner, sales, inv_booked, 'long', inputs, booked={'KBRV-1': 160, 'KBRV-2': 32})
+    assert plan_boxes(rows) == expected
+
+
+def test_single_warehouse_demand_matches_zone_allocator(planner):
+    """With every sale in one zone both engines reduce to the same per-SKU box count."""
+    sales, inv = uploads(planner, 'none')
+    sales['Delivery State'] = 'Karnataka'
+    inputs, _ = planner.build_plan_inputs(sales.copy(), inv.copy(), 'multi')
+    multi = planner.allocate_plan(inputs, MULTIPLIER)[0]
+    single = planner.allocate_plan(dict(inputs, mode_type='single'), MULTIPLIER)[0]
+    assert set(multi['Zone']) == set(single['Zone']) == {'South'}
+    assert set(multi['Warehouse']) == {planner.ZONE_WAREHOUSE['South']}
+    cols = ['SKU Id', 'Zone', 'Editable Boxes', 'Editable Qty', 'PPCN']
+    pd.testing.assert_frame_equal(multi[cols].reset_index(drop=True), single[cols].reset_index(drop=True), check_dtype=False)
+
+
+def test_exclusions_and_overrides(planner):
+    sales, inv = uploads(planner, 'wide')
+    inputs, _ = planner.build_plan_inputs(sales.copy(), inv.copy(), 'multi')
+    base = planner.allocate_plan(inputs, MULTIPLIER)[0]
+    rows = planner.allocate_plan(inputs, MULTIPLIER, False, None, ['South'], ['KBRV-3'])[0]
+    assert planner.ZONE_WAREHOUSE['South'] not in set(rows['Warehouse']) and 'KBRV-3' not in set(rows['SKU Id'])
+    kept = base[(base['Zone'] != 'South') & (base['SKU Id'] != 'KBRV-3')]
+    assert plan_boxes(rows) == plan_boxes(kept)
+    sku = base['SKU Id'].iloc[0]
+    doubled = planner.allocate_plan(inputs, MULTIPLIER, False, {sku: 32})[0]
+    assert set(doubled.loc[doubled['SKU Id'] == sku, 'PPCN']) == {32}
+    assert doubled.loc[doubled['SKU Id'] == sku, 'Editable Boxes'].sum() <= base.loc[base['SKU Id'] == sku, 'Editable Boxes'].sum()
+
+
+AMAZON_FCS = {'South': 'FC-S', 'West': 'FC-W', 'East': 'FC-E', 'North': 'FC-N'}
+
+
+def test_channel_without_fc_codes_is_refused(planner):
+    sales, inv = uploads(planner, 'none')
+    assert planner.channel_warehouses('Amazon') == []
+    inputs, msg = planner.build_plan_inputs(sales.copy(), inv.copy(), 'multi', 'Amazon')
+    assert inputs is None and 'No FC codes configured for Amazon' in msg
+    # zone plans need no FC codes, but switching them to multi-warehouse in the what-if is refused too
+    inputs, msg = planner.build_plan_inputs(sales.copy(), inv.copy(), 'single', 'Amazon')
+    assert msg == "Success" and not planner.allocate_plan(inputs, MULTIPLIER)[0].empty
+    rows, msg = planner.allocate_plan(dict(inputs, mode_type='multi'), MULTIPLIER)[:2]
+    assert rows.empty and 'No FC codes configured' in msg
+
+
+def test_partial_fc_config_is_not_used(planner, repo):
+    repo.seed(planner.PLAN_CHANNELS_FILE, json.dumps({'Myntra': {'fcs': {'South': 'BLR', 'West': ' '}}}))
+    assert planner.channel_fcs('Myntra') is None
+    assert planner.build_plan_inputs(*uploads(planner, 'none'), 'multi', 'Myntra')[0] is None
+
+
+def test_configured_fc_codes_name_the_warehouses(planner, repo):
+    planner.save_channel_fcs('Amazon', {z: f' {fc} ' for z, fc in AMAZON_FCS.items()})
+    assert json.loads(repo.files[planner.PLAN_CHANNELS_FILE])['Amazon']['fcs'] == AMAZON_FCS
+    assert planner.channel_warehouses('Amazon') == [AMAZON_FCS[z] for z in planner.ZONES_ORDER]
+    sales, inv = uploads(planner, 'none')
+    rows = planner.allocate_plan(planner.build_plan_inputs(sales.copy(), inv.copy(), 'multi', 'Amazon')[0], MULTIPLIER)[0]
+    flipkart = planner.allocate_plan(planner.build_plan_inputs(sales.copy(), inv.copy(), 'multi')[0], MULTIPLIER)[0]
+    assert set(rows['Warehouse']) <= set(AMAZON_FCS.values())
+    assert rows['Zone'].map(AMAZON_FCS).tolist() == rows['Warehouse'].tolist()
+    assert plan_boxes(rows.assign(Warehouse=rows['Zone'])) == plan_boxes(flipkart.assign(Warehouse=flipkart['Zone']))
+
+
+def test_flipkart_defaults_and_template_override(planner, repo):
+    assert planner.channel_warehouses('Flipkart') == planner.WAREHOUSES
+    assert planner.channel_template_file('Amazon', 'single') == "active_listing_amazon.csv"
+    repo.seed(planner.PLAN_CHANNELS_FILE, json.dumps({'Amazon': {'templates': {'single': 'amazon_listing.csv'}}}))
+    planner.channel_config.clear()
+    assert planner.channel_template_file('Amazon', 'single') == 'amazon_listing.csv'
+    assert planner.channel_template_file('Amazon', 'multi') == "active_listing_amazon_multi.csv"
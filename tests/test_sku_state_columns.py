@@ -0,0 +1,68 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+MESSY_SKUS = ['KBRV-1', ' KBRV-1 ', 'kbrv-1', 'SKU:KBRV-2', 'sku: KBRV-2', '"KBRV-3"', "'KBRV-3'", 'KBRVX-4', 'KBRV-5A',
+              'XKBRV-6', '', '   ', np.nan, None, 123.0, 123, 1, True, 4.5, 'nan', 'KBRV-1']
+
+
+# Row-wise state mapping of the planner before state_zone_columns
+def map_state(s, table):
+    if not isinstance(s, str): return (None, None)
+    res = table.get(s)
+    if not res: res = table.get(s.title())
+    if not res: res = table.get(s.strip().title())
+    return res if res else (None, None)
+
+
+def test_clean_sku_series_matches_clean_sku(app):
+    s = pd.Series(MESSY_SKUS, dtype=object, index=np.arange(100, 100 + len(MESSY_SKUS)))
+    out = app.clean_sku_series(s)
+    assert isinstance(out.dtype, pd.CategoricalDtype) and out.index.equals(s.index)
+    assert out.astype(str).tolist() == [app.clean_sku(v) for v in MESSY_SKUS]
+    assert sorted(out.cat.categories) == sorted({app.clean_sku(v) for v in MESSY_SKUS})
+
+
+def test_clean_sku_series_on_numeric_column(app):
+    s = pd.Series([123.0, np.nan, 7.0])
+    assert app.clean_sku_series(s).astype(str).tolist() == [app.clean_sku(v) for v in s]
+
+
+@pytest.mark.parametrize('dupes', [False, True])
+def test_listing_pattern_mask_matches_row_wise_search(app, dupes):
+    pattern = app.PLAN_SKU_PATTERNS[dupes]
+    s = pd.Series(MESSY_SKUS, dtype=object)
+    expected = s.str.contains(pattern, case=False, na=False, regex=True).astype(bool).to_numpy()
+    assert app.listing_pattern_mask(s, pattern).tolist() == expected.tolist()
+    cleaned = app.clean_sku_series(s)
+    expected = cleaned.astype(str).str.contains(pattern, case=False, na=False, regex=True).to_numpy()
+    assert app.listing_pattern_mask(cleaned, pattern).tolist() == expected.tolist()
+
+
+def messy_states(app):
+    states = list(app.STATE_TO_ZONE)
+    return (states + [s.upper() for s in states] + [s.lower() for s in states] + [f'  {s} ' for s in states]
+            + ['Unknownland', '', ' ', np.nan, None, 560001, 'Tamil  Nadu', 'NCT of Delhi'])
+
+
+def test_state_zone_columns_match_row_wise_mapping(app):
+    states = messy_states(app)
+    zone, warehouse = app.state_zone_columns(pd.Series(states, dtype=object))
+    got = list(zip(zone.astype(object).where(zone.notna(), None), warehouse.astype(object).where(warehouse.notna(), None)))
+    old = [map_state(s, app.STATE_TO_ZONE) for s in states]
+    for state, new, before in zip(states, got, old):
+        if before != (None, None): assert new == before, state
+    # every spelling of a known state maps now, including the lower-case ones the title() lookup missed
+    # ('andaman and nicobar islands' -> 'Andaman And Nicobar Islands') and runs of inner whitespace
+    assert all(new != (None, None) for new in got[:4 * len(app.STATE_TO_ZONE)])
+    assert got[states.index('Tamil  Nadu')] == app.STATE_TO_ZONE['Tamil Nadu']
+    assert got[-7:] == [(None, None)] * 5 + [app.STATE_TO_ZONE['Tamil Nadu'], (None, None)]
+
+
+def test_state_zone_columns_are_categorical(app):
+    s = pd.Series(['Karnataka', 'Unknownland', None], index=[7, 8, 9])
+    zone, warehouse = app.state_zone_columns(s)
+    assert zone.index.equals(s.index) and warehouse.index.equals(s.index)
+    assert zone.tolist()[0] == 'south' and warehouse.tolist()[0] == 'malur_bts'
+    assert zone.isna().tolist() == [False, True, True]
+    assert set(zone.cat.categories) <= {z for z, _ in app.STATE_TO_ZONE.values()}
@@ -0,0 +1,130 @@
+import base64
+import hashlib
+import io
+import json
+
+import pytest
+from pypdf import PdfReader
+
+import loadtest
+
+
+@pytest.fixture
+def small_parts(app, monkeypatch):
+    monkeypatch.setattr(app, 'LARGE_FILE_CHUNK_THRESHOLD', 64 * 1024)
+    monkeypatch.setattr(app, 'LARGE_FILE_PART_SIZE', 16 * 1024)
+
+
+def payload(n, seed=0):
+    return hashlib.sha256(str(seed).encode()).digest() * (n // 32) + b'x' * (n % 32)
+
+
+def read_spool(app, name):
+    spool = app.StorageHandler.download_to_spool(name)
+    if spool is None: return None
+    with spool:
+        assert spool.tell() == 0
+        return spool.read()
+
+
+def test_inline_round_trip(app, repo):
+    data = payload(1000)
+    assert app.StorageHandler.upload_large_file("a.pdf", data)
+    assert read_spool(app, "a.pdf") == data
+    assert repo.calls['get_git_blob'] == 0
+
+
+def test_files_over_inline_limit_use_blob_api(app, repo):
+    data = payload(loadtest.INLINE_LIMIT + 12345)
+    repo.seed("big.pdf", data)
+    assert read_spool(app, "big.pdf") == data
+    assert repo.calls['get_git_blob'] == 1
+
+
+def test_spool_spills_to_disk(app, repo, monkeypatch):
+    monkeypatch.setattr(app, 'SPOOL_MEMORY_LIMIT', 1024)
+    repo.seed("big.pdf", payload(50_000))
+    with app.StorageHandler.download_to_spool("big.pdf") as spool:
+        assert spool._rolled
+
+
+def test_chunked_upload_writes_parts_and_manifest(app, repo, small_parts):
+    data = payload(100_000)
+    assert app.StorageHandler.upload_large_file("labels.pdf", data)
+    manifest = json.loads(repo.files["labels.pdf.manifest.json"])
+    assert "labels.pdf" not in repo.files
+    assert manifest['size'] == len(data) and manifest['sha256'] == hashlib.sha256(data).hexdigest()
+    assert [p['size'] for p in manifest['parts']] == [16384] * 6 + [1696]
+    for part in manifest['parts']:
+        assert hashlib.sha256(repo.files[part['name']]).hexdigest() == part['sha256']
+    assert read_spool(app, "labels.pdf") == data
+    assert app.StorageHandler.file_exists("labels.pdf")
+
+
+def test_small_rewrite_replaces_chunked_copy(app, repo, small_parts):
+    assert app.StorageHandler.upload_large_file("labels.pdf", payload(100_000))
+    assert app.StorageHandler.upload_large_file("labels.pdf", b"small")
+    assert "labels.pdf.manifest.json" not in repo.files
+    assert read_spool(app, "labels.pdf") == b"small"
+
+
+def test_blob_sha_mismatch_is_rejected(app, repo, monkeypatch):
+    data = payload(loadtest.INLINE_LIMIT + 10)
+    repo.seed("big.pdf", data)
+    tampered = loadtest._Blob(data[:-1] + b'?')
+    monkeypatch.setattr(repo, 'get_git_blob', lambda sha: tampered)
+    assert read_spool(app, "big.pdf") is None
+
+
+def test_inline_sha_mismatch_is_rejected(app, repo, monkeypatch):
+    repo.seed("a.pdf", b"original")
+    contents = repo.get_contents("a.pdf")
+    contents.decoded_content = b"tampered"
+    monkeypatch.setattr(repo, 'get_contents', lambda path: contents)
+    assert read_spool(app, "a.pdf") is None
+
+
+def test_truncated_blob_is_rejected(app, repo, monkeypatch):
+    data = payload(loadtest.INLINE_LIMIT + 10)
+    repo.seed("big.pdf", data)
+    blob = loadtest._Blob(data)
+    blob.content = blob.content[:-3]
+    monkeypatch.setattr(repo, 'get_git_blob', lambda sha: blob)
+    assert read_spool(app, "big.pdf") is None
+
+
+def test_corrupt_part_is_rejected(app, repo, small_parts):
+    assert app.StorageHandler.upload_large_file("labels.pdf", payload(100_000))
+    repo.files["labels.pdf.part003"] = b"0" * 16384
+    assert read_spool(app, "labels.pdf") is None
+
+
+def test_missing_part_is_rejected(app, repo, small_parts):
+    assert app.StorageHandler.upload_large_file("labels.pdf", payload(100_000))
+    del repo.files["labels.pdf.part006"]
+    assert read_spool(app, "labels.pdf") is None
+
+
+def test_missing_file(app, repo):
+    assert read_spool(app, "nope.pdf") is None
+    assert not app.StorageHandler.file_exists("nope.pdf")
+
+
+def test_b64_decode_into_handles_wrapped_lines(app):
+    data = payload(10_000)
+    text = base64.encodebytes(data).decode()  # wrapped every 76 chars
+    out, digest = io.BytesIO(), hashlib.sha1()
+    app._b64_decode_into(text, out, digest, step=1000)
+    assert out.getvalue() == data and digest.hexdigest() == hashlib.sha1(data).hexdigest()
+
+
+def test_label_pages_extracted_from_stored_spool(app, repo, small_parts):
+    from test_label_merge import source_labels
+    pdf = source_labels(40)
+    assert app.StorageHandler.upload_large_file("C1_merged_labels.pdf", pdf)
+    reader = app.open_label_reader("C1")
+    assert isinstance(reader.stream, app.tempfile.SpooledTemporaryFile)
+    page = PdfReader(io.BytesIO(app.extract_label_pdf_bytes(reader, 7))).pages[0]
+    assert "LABEL 7" in page.extract_text()
+    assert app.extract_label_pdf_bytes(reader, 40) is None
+    assert app.open_label_reader("C2") is None
@@ -0,0 +1,102 @@
+import io
+import math
+import re
+
+import pandas as pd
+import pytest
+from pypdf import PdfReader
+from reportlab.graphics.barcode import eanbc
+from reportlab.graphics.shapes import Rect
+
+EAN = '4006381333931'
+# 4006381333931: first digit 4 -> LGLLGG parity on the left half
+EAN_MODULES = ('101' '0001101' '0100111' '0101111' '0111101' '0001001' '0110011' '01010'
+               '1000010' '1000010' '1000010' '1110100' '1000010' '1100110' '101')
+
+
+@pytest.fixture
+def labels(app, repo):
+    """Unit labels against an empty repo: no master data, so the EAN comes from the FSN column."""
+    app.master_data_index.clear()
+    yield app
+    app.master_data_index.clear()
+
+
+def reportlab_modules(ean):
+    """The 95-module pattern of reportlab's own EAN-13 widget, read back from its bar rectangles."""
+    widget = eanbc.Ean13BarcodeWidget(ean[:12], quiet=0, humanReadable=0)
+    rects = []
+    def walk(node):
+        for child in getattr(node, 'contents', []):
+            if isinstance(child, Rect): rects.append(child)
+            else: walk(child)
+    walk(widget.draw())
+    bars = [r for r in rects if r.width < 5 * widget.barWidth]
+    x0 = min(r.x for r in bars)
+    modules = ['0'] * 95
+    for r in bars:
+        start = round((r.x - x0) / widget.barWidth)
+        modules[start:start + round(r.width / widget.barWidth)] = '1' * round(r.width / widget.barWidth)
+    return ''.join(modules)
+
+
+@pytest.mark.parametrize('val, ok', [(EAN, True), ('4006381333932', False), ('5901234123457', True), ('0000000000000', True),
+                                     ('400638133393', False), ('40063813339310', False), ('400638133393A', False)])
+def test_ean13_check_digit(app, val, ok):
+    assert app.is_valid_ean13(val) is ok
+
+
+def test_ean13_modules_of_known_code(app):
+    assert app.ean13_modules(EAN) == EAN_MODULES
+    assert len(EAN_MODULES) == 95
+
+
+@pytest.mark.parametrize('ean', ['5901234123457', '8901030865275', '0012345678905', '9780201379624'])
+def test_ean13_modules_match_reportlab(app, ean):
+    assert app.is_valid_ean13(ean)
+    assert app.ean13_modules(ean) == reportlab_modules(ean)
+
+
+def consignment_rows(eans, qty):
+    return pd.DataFrame({'SKU Id': [f'KBRV-{i}' for i in range(len(eans))], 'Editable Boxes': [1] * len(eans),
+                         'Editable Qty': qty, 'FSN': eans})
+
+
+def drawn_symbologies(app, monkeypatch, df, symbology='auto'):
+    drawn = []
+    for name in ('_draw_ean13', '_draw_code128'):
+        real = getattr(app, name)
+        def spy(c, val, *args, _name=name, _real=real):
+            drawn.append((_name, val))
+            return _real(c, val, *args)
+        monkeypatch.setattr(app, name, spy)
+    app.generate_unit_labels_pdf(df, 'Zebra Roll 50x25mm', symbology)
+    return drawn
+
+
+def test_invalid_ean_falls_back_to_code128(labels, monkeypatch):
+    df = consignment_rows([EAN, '4006381333932', 'FSN123ABC'], [2, 1, 1])
+    assert drawn_symbologies(labels, monkeypatch, df) == [
+        ('_draw_ean13', EAN), ('_draw_code128', '4006381333932'), ('_draw_code128', 'FSN123ABC')]
+
+
+def test_code128_symbology_skips_ean13(labels, monkeypatch):
+    assert drawn_symbologies(labels, monkeypatch, consignment_rows([EAN], [1]), 'Code128') == [('_draw_code128', EAN)]
+
+
+@pytest.mark.parametrize('layout', ['Zebra Roll 50x25mm', 'Zebra Roll 2-up 100x25mm', 'A4 Sheet 40 (52.5x29.7mm)',
+                                    'A4 Sheet 65 (38.1x21.2mm)'])
+def test_page_and_label_count_per_layout(labels, layout):
+    qty = [37, 0, 50, 1]  # 88 units; the zero-quantity row prints nothing
+    df = consignment_rows([EAN, '5901234123457', 'FSN123ABC', '8901030865275'], qty)
+    df.loc[1, 'Editable Boxes'] = 0
+    spec = labels.LABEL_LAYOUTS[layout]
+    per_page = spec['cols'] * spec['rows']
+    reader = PdfReader(io.BytesIO(labels.generate_unit_labels_pdf(df, layout)))
+    assert len(reader.pages) == math.ceil(88 / per_page)
+    stamped = [len(re.findall(rb'/FormXob\.UL\d+ Do', page.get_contents().get_data())) for page in reader.pages]
+    assert sum(stamped) == 88
+    assert stamped[:-1] == [per_page] * (len(stamped) - 1) and 0 < stamped[-1] <= per_page
+    width, height = spec['page']
+    assert float(reader.pages[0].mediabox.width) == pytest.approx(width, abs=0.01)
+    assert float(reader.pages[0].mediabox.height) == pytest.approx(height, abs=0.01)
@@ -0,0 +1,79 @@
+import io
+import os
+
+import pandas as pd
+import pytest
+
+
+@pytest.fixture
+def cache(app, tmp_path, monkeypatch):
+    """cached_upload_frame against an empty cache directory."""
+    monkeypatch.setattr(app, 'UPLOAD_CACHE_DIR', str(tmp_path / "cache"))
+    return app
+
+
+class Parser:
+    """Counts its calls; parses the upload as CSV."""
+    def __init__(self): self.calls = 0
+
+    def __call__(self, buf):
+        self.calls += 1
+        return pd.read_csv(buf, dtype=str)
+
+
+def upload(text):
+    return io.BytesIO(text.encode())
+
+
+CSV = "SKU,Qty\nKBRV-1,4\nKBRV-2,7\n"
+
+
+def test_same_bytes_skip_parsing(cache):
+    parse = Parser()
+    first, hit = cache.cached_upload_frame(upload(CSV), 'sales', parse)
+    assert not hit and parse.calls == 1
+    again, hit = cache.cached_upload_frame(upload(CSV), 'sales', parse)
+    assert hit and parse.calls == 1
+    pd.testing.assert_frame_equal(again, first)
+    assert len(os.listdir(cache.UPLOAD_CACHE_DIR)) == 1
+
+
+def test_changed_bytes_or_kind_parse_again(cache):
+    parse = Parser()
+    cache.cached_upload_frame(upload(CSV), 'sales', parse)
+    changed, hit = cache.cached_upload_frame(upload(CSV.replace('7', '8')), 'sales', parse)
+    assert not hit and parse.calls == 2 and changed['Qty'].tolist() == ['4', '8']
+    _, hit = cache.cached_upload_frame(upload(CSV), 'inventory', parse)
+    assert not hit and parse.calls == 3
+    _, hit = cache.cached_upload_frame(upload(CSV), cache.channel_upload_kind('sales', 'Amazon'), parse)
+    assert not hit and parse.calls == 4
+    assert len(os.listdir(cache.UPLOAD_CACHE_DIR)) == 4
+
+
+def test_mutating_the_result_leaves_the_cache_intact(cache):
+    parse = Parser()
+    for _ in range(2):
+        df, _ = cache.cached_upload_frame(upload(CSV), 'sales', parse)
+        df.loc[0, 'Qty'] = '999'; df['Extra'] = 1; df.drop(index=1, inplace=True)
+    df, hit = cache.cached_upload_frame(upload(CSV), 'sales', parse)
+    assert hit and parse.calls == 1
+    pd.testing.assert_frame_equal(df, pd.read_csv(upload(CSV), dtype=str))
+
+
+def test_unreadable_snapshot_is_parsed_again(cache):
+    parse = Parser()
+    cache.cached_upload_frame(upload(CSV), 'sales', parse)
+    (path,) = [os.path.join(cache.UPLOAD_CACHE_DIR, n) for n in os.listdir(cache.UPLOAD_CACHE_DIR)]
+    with open(path, 'wb') as f: f.write(b'not a pickle')
+    df, hit = cache.cached_upload_frame(upload(CSV), 'sales', parse)
+    assert not hit and parse.calls == 2 and df['SKU'].tolist() == ['KBRV-1', 'KBRV-2']
+    assert cache.cached_upload_frame(upload(CSV), 'sales', parse)[1]
+
+
+def test_eviction_keeps_the_cache_under_its_cap(cache, monkeypatch):
+    parse = Parser()
+    cache.cached_upload_frame(upload(CSV), 'sales', parse)
+    size = sum(e.stat().st_size for e in os.scandir(cache.UPLOAD_CACHE_DIR))
+    monkeypatch.setattr(cache, 'UPLOAD_CACHE_MAX_BYTES', int(size * 2.5))
+    for k in range(4): cache.cached_upload_frame(upload(CSV.replace('7', str(k))), 'sales', parse)
+    assert len(os.listdir(cache.UPLOAD_CACHE_DIR)) == 2
@@ -0,0 +1,58 @@
+import io
+
+import numpy as np
+import pandas as pd
+import pytest
+
+
+@pytest.fixture
+def frame():
+    return pd.DataFrame({'SKU': ['KBRV-1', 'KBRV-2', None, 'KBRV-4', 'KBRV-5'], 'Qty': [4, 0, 7, 12, 3],
+                         'Cost': [350.5, np.nan, 99.0, np.nan, 12.25], 'Zone': pd.Categorical(['South', 'West', None, 'South', 'East']),
+                         'Day': pd.to_datetime(['2026-03-01', '2026-03-02', None, '2026-03-04', '2026-03-05'])})
+
+
+def read(data, **kw):
+    return pd.read_excel(io.BytesIO(data), sheet_name=None, **kw)
+
+
+@pytest.mark.parametrize('chunk', [5000, 2])
+def test_round_trip_plain_sheet(app, frame, monkeypatch, chunk):
+    monkeypatch.setattr(app, 'XLSX_CHUNK_ROWS', chunk)  # 2 splits the rows across write chunks
+    (name, got), = read(app.export_xlsx([app.xlsx_sheet('Plan', frame)])).items()
+    assert name == 'Plan' and list(got.columns) == list(frame.columns)
+    assert got['SKU'].isna().tolist() == [False, False, True, False, False]
+    assert got['Qty'].tolist() == [4, 0, 7, 12, 3]
+    assert got['Cost'].isna().tolist() == [False, True, False, True, False] and got['Cost'][4] == 12.25
+    assert got['Zone'].fillna('').tolist() == ['South', 'West', '', 'South', 'East']
+    assert got['Day'].fillna('').tolist() == ['2026-03-01', '2026-03-02', '', '2026-03-04', '2026-03-05']
+
+
+def test_renamed_columns_rows_and_arrays(app, frame):
+    rows = np.array([3, 0, 4])
+    columns = [('Seller SKU', 'SKU'), 'Qty', ('Units', frame['Qty'].to_numpy() * 2), ('Note', np.array(list('abcde'), dtype=object))]
+    sheet = app.xlsx_sheet('Picked', frame, columns, rows=rows)
+    (_, got), = read(app.export_xlsx([sheet])).items()
+    assert list(got.columns) == ['Seller SKU', 'Qty', 'Units', 'Note']
+    assert got['Seller SKU'].tolist() == ['KBRV-4', 'KBRV-1', 'KBRV-5']
+    assert got['Qty'].tolist() == [12, 4, 3] and got['Units'].tolist() == [24, 8, 6]
+    assert got['Note'].tolist() == ['d', 'a', 'e']
+
+
+def test_multiple_sheets_in_order(app, frame):
+    long_name = 'Consignment summary for all zones'
+    sheets = [app.xlsx_sheet('Plan', frame, ['SKU', 'Qty']), app.xlsx_sheet('Empty', frame.iloc[:0], ['SKU']),
+              app.xlsx_sheet(long_name, frame, ['Cost'], rows=np.flatnonzero(frame['Cost'].notna()))]
+    got = read(app.export_xlsx(sheets))
+    assert list(got) == ['Plan', 'Empty', long_name[:31]]
+    assert got['Plan']['Qty'].tolist() == [4, 0, 7, 12, 3]
+    assert got['Empty'].empty and list(got['Empty'].columns) == ['SKU']
+    assert got[long_name[:31]]['Cost'].tolist() == [350.5, 99.0, 12.25]
+
+
+def test_text_stays_text(app):
+    df = pd.DataFrame({'EAN': ['0012345678905', '=1+1', 'http://x.test']})
+    buf = io.BytesIO()
+    assert app.export_xlsx([app.xlsx_sheet('S', df)], out=buf) is buf
+    (_, got), = read(buf.getvalue(), dtype=str).items()
+    assert got['EAN'].tolist() == ['0012345678905', '=1+1', 'http://x.test']